@@ -20,12 +20,12 @@ SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'lookahead.c', 'msgdecode.c', 'movetransform.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h',
+    'trapq.h', 'lookahead.h', 'msgdecode.h', 'movetransform.h',
 ]
 
 defs_stepcompress = """
@@ -73,6 +73,38 @@ defs_trapq = """
     void trapq_free_moves(struct trapq *tq, double print_time);
 """
 
+defs_lookahead = """
+    struct lookahead_move {
+        double move_d, accel, max_cruise_v2, delta_v2, smooth_delta_v2;
+        double max_start_v2, max_smoothed_v2;
+        double start_v, cruise_v, end_v, accel_t, cruise_t, decel_t;
+        double start_v2, smoothed_v2;
+        int can_accel, is_peak;
+    };
+    struct lookahead_delayed {
+        int index;
+        double start_v2, end_v2;
+    };
+    struct lookahead {
+        struct lookahead_move *moves;
+        struct lookahead_delayed *delayed;
+        int move_count, move_alloc;
+        int *peaks;
+        int peak_count, cached_count;
+    };
+
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    void lookahead_add_move(struct lookahead *la, double move_d, double accel
+        , double max_cruise_v2, double delta_v2
+        , double smooth_delta_v2, double max_start_v2
+        , double max_smoothed_v2);
+    int lookahead_flush(struct lookahead *la, int lazy);
+    void lookahead_discard(struct lookahead *la, int count);
+    void lookahead_pop(struct lookahead *la);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
 """
@@ -139,6 +171,8 @@ defs_serialqueue = """
         int len;
         double sent_time, receive_time;
         uint64_t notify_id;
+        int param_count;
+        int64_t params[MESSAGE_MAX];
     };
 
     struct serialqueue *serialqueue_alloc(int serial_fd, int write_only);
@@ -149,8 +183,13 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    void serialqueue_send_multiple(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *data, int *lens
+        , uint64_t *min_clocks, uint64_t *req_clocks, int count);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    void serialqueue_set_decoder(struct serialqueue *sq
+        , struct msgdecode *md);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -162,6 +201,31 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgdecode = """
+    struct msgdecode *msgdecode_alloc(void);
+    void msgdecode_free(struct msgdecode *md);
+    int msgdecode_add_format(struct msgdecode *md, int msgid, char *types);
+    int msgdecode_decode(struct msgdecode *md, uint8_t *msg, int len
+        , int64_t *params, int max);
+"""
+
+defs_movetransform = """
+    struct move_transform *move_transform_alloc(void);
+    void move_transform_free(struct move_transform *mt);
+    void move_transform_set_matrix(struct move_transform *mt, double *matrix);
+    void move_transform_set_mesh(struct move_transform *mt, double *mesh
+        , int x_count, int y_count, double min_x, double min_y
+        , double dist_x, double dist_y);
+    void move_transform_set_mesh_params(struct move_transform *mt
+        , double mesh_offset, double split_delta_z, double fade_start
+        , double fade_end, double fade_dist, double fade_target);
+    void move_transform_set_position(struct move_transform *mt, double *pos);
+    void move_transform_get_position(struct move_transform *mt, double *pos);
+    int move_transform_move(struct move_transform *mt, double *newpos
+        , double *out, int max_out);
+    int move_transform_fade_complete(struct move_transform *mt);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -172,10 +236,12 @@ defs_std = """
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_kin_cartesian, defs_kin_corexy,
-    defs_kin_corexz, defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta,
-    defs_kin_winch, defs_kin_extruder, defs_kin_shaper,
+    defs_pyhelper, defs_serialqueue, defs_msgdecode, defs_std,
+    defs_stepcompress, defs_itersolve, defs_trapq, defs_lookahead,
+    defs_movetransform,
+    defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
+    defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch, defs_kin_extruder,
+    defs_kin_shaper,
 ]
 
 # Update filenames to an absolute path
@@ -0,0 +1,261 @@
+// Batched "look-ahead" junction velocity planning
+//
+// The junction speeds found by the backward pass over the queue are
+// cached with each move.  Adding a move can only raise the speeds of
+// earlier moves, so the pass over the queue stops at the first move
+// whose cached speeds are unchanged (the speeds of all earlier moves
+// then also remain unchanged).  The moves where a lazy flush may occur
+// are tracked as the cache is updated, so a lazy flush does not need
+// to walk the entire queue.
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+// The results of this code must be bit-for-bit identical to the
+// python MoveQueue implementation in toolhead.py - don't let the
+// compiler fuse multiplies and adds.
+#pragma GCC optimize ("fp-contract=off")
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "lookahead.h" // struct lookahead
+
+// Same semantics as python's min() - return 'a' unless 'b' is smaller
+#define PYMIN(a, b) ((b) < (a) ? (b) : (a))
+
+// Allocate a new 'lookahead' object
+struct lookahead * __visible
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    return la;
+}
+
+// Free memory associated with a 'lookahead' object
+void __visible
+lookahead_free(struct lookahead *la)
+{
+    free(la->moves);
+    free(la->delayed);
+    free(la->peaks);
+    free(la);
+}
+
+// Discard all pending moves
+void __visible
+lookahead_reset(struct lookahead *la)
+{
+    la->move_count = la->peak_count = la->cached_count = 0;
+}
+
+// Add a move (with its junction limits already calculated) to the queue
+void __visible
+lookahead_add_move(struct lookahead *la, double move_d, double accel
+                   , double max_cruise_v2, double delta_v2
+                   , double smooth_delta_v2, double max_start_v2
+                   , double max_smoothed_v2)
+{
+    if (la->move_count >= la->move_alloc) {
+        int alloc = la->move_alloc ? la->move_alloc * 2 : 1024;
+        la->moves = realloc(la->moves, alloc * sizeof(*la->moves));
+        la->delayed = realloc(la->delayed, alloc * sizeof(*la->delayed));
+        la->peaks = realloc(la->peaks, alloc * sizeof(*la->peaks));
+        la->move_alloc = alloc;
+    }
+    struct lookahead_move *m = &la->moves[la->move_count++];
+    memset(m, 0, sizeof(*m));
+    m->move_d = move_d;
+    m->accel = accel;
+    m->max_cruise_v2 = max_cruise_v2;
+    m->delta_v2 = delta_v2;
+    m->smooth_delta_v2 = smooth_delta_v2;
+    m->max_start_v2 = max_start_v2;
+    m->max_smoothed_v2 = max_smoothed_v2;
+}
+
+// Determine accel, cruise, and decel portions of a move
+static void
+set_junction(struct lookahead_move *m, double start_v2, double cruise_v2
+             , double end_v2)
+{
+    double half_inv_accel = .5 / m->accel;
+    double accel_d = (cruise_v2 - start_v2) * half_inv_accel;
+    double decel_d = (cruise_v2 - end_v2) * half_inv_accel;
+    double cruise_d = m->move_d - accel_d - decel_d;
+    double start_v = m->start_v = sqrt(start_v2);
+    double cruise_v = m->cruise_v = sqrt(cruise_v2);
+    double end_v = m->end_v = sqrt(end_v2);
+    m->accel_t = accel_d / ((start_v + cruise_v) * 0.5);
+    m->cruise_t = cruise_d / cruise_v;
+    m->decel_t = decel_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Update the cached junction speeds (assuming the robot comes to a
+// complete stop after the last move) until they no longer change.
+// Also note the moves that may accelerate and decelerate (the moves
+// that a full pass calculates a peak_cruise_v2 for) - this only
+// depends on the speeds of a move and the move following it.
+static void
+update_cache(struct lookahead *la)
+{
+    struct lookahead_move *moves = la->moves;
+    int cached = la->cached_count, i;
+    double next_end_v2 = 0., next_smoothed_v2 = 0.;
+    int next_can_accel = 1;
+    for (i = la->move_count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double start_v2 = PYMIN(m->max_start_v2, next_end_v2 + m->delta_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = PYMIN(m->max_smoothed_v2, reachable_smoothed_v2);
+        int can_accel = smoothed_v2 < reachable_smoothed_v2;
+        m->is_peak = can_accel && (
+            smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+            || !next_can_accel);
+        if (i < cached && start_v2 == m->start_v2
+            && smoothed_v2 == m->smoothed_v2 && can_accel == m->can_accel)
+            break;
+        m->start_v2 = start_v2;
+        m->smoothed_v2 = smoothed_v2;
+        m->can_accel = can_accel;
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+        next_can_accel = can_accel;
+    }
+    la->cached_count = la->move_count;
+    // Replace the peaks of all updated moves
+    if (i < 0)
+        i = 0;
+    int peak_count = la->peak_count;
+    while (peak_count && la->peaks[peak_count - 1] >= i)
+        peak_count--;
+    for (; i < la->move_count; i++)
+        if (moves[i].is_peak)
+            la->peaks[peak_count++] = i;
+    la->peak_count = peak_count;
+}
+
+// Determine accel, cruise, and decel portions of the first
+// 'flush_count' moves given the junction speeds of the move following
+// them.
+static void
+plan_moves(struct lookahead *la, int flush_count, double next_end_v2
+           , double next_smoothed_v2, double peak_cruise_v2)
+{
+    struct lookahead_move *moves = la->moves;
+    struct lookahead_delayed *delayed = la->delayed;
+    int delayed_count = 0, i;
+    for (i = flush_count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = PYMIN(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = PYMIN(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || delayed_count) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                peak_cruise_v2 = PYMIN(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed_count) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    double mc_v2 = peak_cruise_v2;
+                    int j;
+                    for (j = delayed_count - 1; j >= 0; j--) {
+                        struct lookahead_delayed *d = &delayed[j];
+                        mc_v2 = PYMIN(mc_v2, d->start_v2);
+                        set_junction(&moves[d->index]
+                                     , PYMIN(d->start_v2, mc_v2), mc_v2
+                                     , PYMIN(d->end_v2, mc_v2));
+                    }
+                    delayed_count = 0;
+                }
+            }
+            double cruise_v2 = PYMIN((start_v2 + reachable_start_v2) * .5
+                                     , m->max_cruise_v2);
+            cruise_v2 = PYMIN(cruise_v2, peak_cruise_v2);
+            set_junction(m, PYMIN(start_v2, cruise_v2), cruise_v2
+                         , PYMIN(next_end_v2, cruise_v2));
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_delayed *d = &delayed[delayed_count++];
+            d->index = i;
+            d->start_v2 = start_v2;
+            d->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+}
+
+// Determine the maximum junction speeds of the queued moves assuming
+// the robot comes to a complete stop after the last move.  Returns the
+// number of moves (from the start of the queue) that have final timing
+// and may be flushed.
+int __visible
+lookahead_flush(struct lookahead *la, int lazy)
+{
+    int flush_count = la->move_count;
+    if (!lazy) {
+        plan_moves(la, flush_count, 0., 0., 0.);
+        return flush_count;
+    }
+    if (!flush_count)
+        return 0;
+    update_cache(la);
+    if (la->peak_count < 2)
+        return 0;
+    // Moves prior to the second to last peak may be flushed
+    flush_count = la->peaks[la->peak_count - 2];
+    if (!flush_count)
+        return 0;
+    struct lookahead_move *m = &la->moves[flush_count];
+    double following_smoothed_v2 = 0.;
+    if (flush_count + 1 < la->move_count)
+        following_smoothed_v2 = la->moves[flush_count + 1].smoothed_v2;
+    double reachable_smoothed_v2 = following_smoothed_v2 + m->smooth_delta_v2;
+    double peak_cruise_v2 = PYMIN(m->max_cruise_v2, (
+        m->smoothed_v2 + reachable_smoothed_v2) * .5);
+    plan_moves(la, flush_count, m->start_v2, m->smoothed_v2, peak_cruise_v2);
+    return flush_count;
+}
+
+// Remove the first 'count' moves from the queue
+void __visible
+lookahead_discard(struct lookahead *la, int count)
+{
+    if (count >= la->move_count) {
+        lookahead_reset(la);
+        return;
+    }
+    la->move_count -= count;
+    memmove(la->moves, &la->moves[count]
+            , la->move_count * sizeof(la->moves[0]));
+    // The cached speeds of the remaining moves remain valid
+    la->cached_count = la->cached_count > count ? la->cached_count - count : 0;
+    int i, peak_count = 0;
+    for (i = 0; i < la->peak_count; i++)
+        if (la->peaks[i] >= count)
+            la->peaks[peak_count++] = la->peaks[i] - count;
+    la->peak_count = peak_count;
+}
+
+// Remove the last move from the queue
+void __visible
+lookahead_pop(struct lookahead *la)
+{
+    if (!la->move_count)
+        return;
+    la->move_count--;
+    // The cached speeds of the remaining moves are rechecked on the
+    // next update (the pass stops once they are unchanged)
+    if (la->cached_count > la->move_count)
+        la->cached_count = la->move_count;
+    while (la->peak_count && la->peaks[la->peak_count - 1] >= la->move_count)
+        la->peak_count--;
+}
@@ -0,0 +1,39 @@
+#ifndef LOOKAHEAD_H
+#define LOOKAHEAD_H
+
+struct lookahead_move {
+    // Junction limits (filled by host code)
+    double move_d, accel, max_cruise_v2, delta_v2, smooth_delta_v2;
+    double max_start_v2, max_smoothed_v2;
+    // Resulting velocities and timing (filled by lookahead_flush)
+    double start_v, cruise_v, end_v, accel_t, cruise_t, decel_t;
+    // Cached backward pass results (internal to lookahead.c)
+    double start_v2, smoothed_v2;
+    int can_accel, is_peak;
+};
+
+struct lookahead_delayed {
+    int index;
+    double start_v2, end_v2;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    struct lookahead_delayed *delayed;
+    int move_count, move_alloc;
+    int *peaks;
+    int peak_count, cached_count;
+};
+
+struct lookahead *lookahead_alloc(void);
+void lookahead_free(struct lookahead *la);
+void lookahead_reset(struct lookahead *la);
+void lookahead_add_move(struct lookahead *la, double move_d, double accel
+                        , double max_cruise_v2, double delta_v2
+                        , double smooth_delta_v2, double max_start_v2
+                        , double max_smoothed_v2);
+int lookahead_flush(struct lookahead *la, int lazy);
+void lookahead_discard(struct lookahead *la, int count);
+void lookahead_pop(struct lookahead *la);
+
+#endif // lookahead.h
@@ -0,0 +1,358 @@
+// Fused g-code move transforms (skew, bed tilt, and bed mesh)
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+// The bed mesh results of this code must be identical to the python
+// bed_mesh.CellMoveSplitter implementation - don't let the compiler
+// fuse multiplies and adds.
+#pragma GCC optimize ("fp-contract=off")
+
+#include <math.h> // floor
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "movetransform.h" // struct move_transform
+
+// Same semantics as python's min() and max()
+#define PYMIN(a, b) ((b) < (a) ? (b) : (a))
+#define PYMAX(a, b) ((b) > (a) ? (b) : (a))
+
+// Allocate a new 'move_transform' object
+struct move_transform * __visible
+move_transform_alloc(void)
+{
+    struct move_transform *mt = malloc(sizeof(*mt));
+    memset(mt, 0, sizeof(*mt));
+    return mt;
+}
+
+// Free memory associated with the bed mesh stage
+static void
+free_mesh(struct move_transform *mt)
+{
+    free(mt->mesh);
+    free(mt->cells);
+    free(mt->crossings);
+    free(mt->points);
+    mt->mesh = mt->cells = mt->crossings = mt->points = NULL;
+}
+
+// Free memory associated with a 'move_transform' object
+void __visible
+move_transform_free(struct move_transform *mt)
+{
+    free_mesh(mt);
+    free(mt);
+}
+
+// Set the fused affine transform (three rows of x, y, z, and constant
+// coefficients) or disable it if 'matrix' is NULL
+void __visible
+move_transform_set_matrix(struct move_transform *mt, double *matrix)
+{
+    mt->has_matrix = matrix != NULL;
+    if (matrix)
+        memcpy(mt->matrix, matrix, sizeof(mt->matrix));
+}
+
+// Set the interpolated bed mesh (stored by rows of the y axis) or
+// disable the bed mesh stage if 'mesh' is NULL
+void __visible
+move_transform_set_mesh(struct move_transform *mt, double *mesh
+                        , int x_count, int y_count
+                        , double min_x, double min_y
+                        , double dist_x, double dist_y)
+{
+    free_mesh(mt);
+    if (!mesh || x_count < 2 || y_count < 2)
+        return;
+    int count = x_count * y_count;
+    mt->mesh = malloc(count * sizeof(*mt->mesh));
+    memcpy(mt->mesh, mesh, count * sizeof(*mt->mesh));
+    mt->cells = malloc((x_count - 1) * (y_count - 1) * 4
+                       * sizeof(*mt->cells));
+    // Each crossed cell may add a grid line crossing and an extremum
+    int max_crossings = x_count + y_count;
+    mt->crossings = malloc(max_crossings * sizeof(*mt->crossings));
+    mt->points = malloc((2 * max_crossings + 1) * 2 * sizeof(*mt->points));
+    mt->x_count = x_count;
+    mt->y_count = y_count;
+    mt->min_x = min_x;
+    mt->min_y = min_y;
+    mt->dist_x = dist_x;
+    mt->dist_y = dist_y;
+    // Calculate the bilinear interpolation coefficients of each cell
+    int x, y;
+    double *c = mt->cells;
+    for (y = 0; y < y_count - 1; y++) {
+        double *row = &mesh[y * x_count], *next_row = &row[x_count];
+        for (x = 0; x < x_count - 1; x++) {
+            *c++ = row[x];
+            *c++ = row[x+1] - row[x];
+            *c++ = next_row[x] - row[x];
+            *c++ = next_row[x+1] - next_row[x] - row[x+1] + row[x];
+        }
+    }
+}
+
+// Set the z offset, split, and fade parameters of the bed mesh stage
+void __visible
+move_transform_set_mesh_params(struct move_transform *mt
+                               , double mesh_offset, double split_delta_z
+                               , double fade_start, double fade_end
+                               , double fade_dist, double fade_target)
+{
+    mt->mesh_offset = mesh_offset;
+    mt->split_delta_z = split_delta_z;
+    mt->fade_start = fade_start;
+    mt->fade_end = fade_end;
+    mt->fade_dist = fade_dist;
+    mt->fade_target = fade_target;
+}
+
+// Set the last position (after the affine transform) of the bed mesh stage
+void __visible
+move_transform_set_position(struct move_transform *mt, double *pos)
+{
+    memcpy(mt->last_pos, pos, sizeof(mt->last_pos));
+}
+
+// Report the last position of the bed mesh stage
+void __visible
+move_transform_get_position(struct move_transform *mt, double *pos)
+{
+    memcpy(pos, mt->last_pos, sizeof(mt->last_pos));
+}
+
+static inline double
+lerp(double t, double v0, double v1)
+{
+    return (1. - t) * v0 + t * v1;
+}
+
+// Find the mesh index and position within it of a coordinate
+static double
+get_linear_index(double coord, double mesh_min, double mesh_dist
+                 , int mesh_cnt, int *pidx)
+{
+    int idx = floor((coord - mesh_min) / mesh_dist);
+    idx = PYMIN(mesh_cnt - 2, PYMAX(0, idx));
+    *pidx = idx;
+    double t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist;
+    return PYMIN(1., PYMAX(0., t));
+}
+
+// Interpolate the mesh z height at a position (as ZMesh.calc_z)
+static double
+calc_z(struct move_transform *mt, double x, double y)
+{
+    int xidx, yidx, x_count = mt->x_count;
+    double tx = get_linear_index(x, mt->min_x, mt->dist_x, x_count, &xidx);
+    double ty = get_linear_index(y, mt->min_y, mt->dist_y, mt->y_count, &yidx);
+    double *row = &mt->mesh[yidx * x_count], *next_row = &row[x_count];
+    double z0 = lerp(tx, row[xidx], row[xidx+1]);
+    double z1 = lerp(tx, next_row[xidx], next_row[xidx+1]);
+    return lerp(ty, z0, z1);
+}
+
+// Store the fraction of the move at each crossed grid line of an axis
+static int
+find_crossings(double start, double end, double mesh_min, double mesh_dist
+               , int mesh_cnt, double *crossings)
+{
+    double move_d = end - start, stop = start + move_d;
+    double low = PYMIN(start, stop), high = PYMAX(start, stop);
+    int first_idx = PYMAX(0, (int)ceil((low - mesh_min) / mesh_dist));
+    int last_idx = PYMIN(mesh_cnt - 1
+                         , (int)floor((high - mesh_min) / mesh_dist));
+    int idx, count = 0;
+    for (idx = first_idx; idx <= last_idx; idx++) {
+        double t = (mesh_min + mesh_dist * idx - start) / move_d;
+        if (t > 0. && t < 1.)
+            crossings[count++] = t;
+    }
+    return count;
+}
+
+static int
+cmp_double(const void *a, const void *b)
+{
+    double da = *(const double*)a, db = *(const double*)b;
+    return (da > db) - (da < db);
+}
+
+// Store the (fraction of the move, z adjustment) at each crossed grid
+// line and at the extremum of the z adjustment within each crossed cell
+// (as CellMoveSplitter._calc_split_points).  Returns the number of
+// points stored.
+static int
+calc_split_points(struct move_transform *mt, double *prev, double *pos
+                  , int crossing_count, double factor, double *points)
+{
+    double px = (prev[0] - mt->min_x) / mt->dist_x;
+    double py = (prev[1] - mt->min_y) / mt->dist_y;
+    double qx = (pos[0] - prev[0]) / mt->dist_x;
+    double qy = (pos[1] - prev[1]) / mt->dist_y;
+    double start_t = 0.;
+    int j, k, count = 0;
+    for (j = 0; j <= crossing_count; j++) {
+        double end_t = j < crossing_count ? mt->crossings[j] : 1.;
+        double mid_t = (start_t + end_t) * .5;
+        int xidx = PYMIN(PYMAX((int)floor(px + qx * mid_t), 0)
+                         , mt->x_count - 2);
+        int yidx = PYMIN(PYMAX((int)floor(py + qy * mid_t), 0)
+                         , mt->y_count - 2);
+        double *c = &mt->cells[(yidx * (mt->x_count - 1) + xidx) * 4];
+        double cx = px - xidx, cy = py - yidx;
+        double point_ts[2];
+        int point_count = 0;
+        // z(t) = a*t^2 + b*t + c
+        double a = c[3] * qx * qy;
+        if (a) {
+            double t = (-(c[1] * qx + c[2] * qy + c[3] * (cx * qy + cy * qx))
+                        / (2. * a));
+            if (t > start_t && t < end_t)
+                point_ts[point_count++] = t;
+        }
+        if (end_t < 1.)
+            point_ts[point_count++] = end_t;
+        for (k = 0; k < point_count; k++) {
+            double t = point_ts[k];
+            double tx = PYMIN(PYMAX(cx + qx * t, 0.), 1.);
+            double ty = PYMIN(PYMAX(cy + qy * t, 0.), 1.);
+            double z = c[0] + c[1] * tx + (c[2] + c[3] * tx) * ty;
+            points[count * 2] = t;
+            points[count * 2 + 1] = factor * z + mt->mesh_offset;
+            count++;
+        }
+        start_t = end_t;
+    }
+    return count;
+}
+
+static inline void
+store_pos(double *out, double x, double y, double z, double e)
+{
+    out[0] = x;
+    out[1] = y;
+    out[2] = z;
+    out[3] = e;
+}
+
+// Store the position at fraction 't' of the move with the given z
+// adjustment
+static void
+store_split_pos(double *out, double *prev, double *pos, int *axis_move
+                , double t, double z_offset)
+{
+    double cur[4];
+    int i;
+    for (i = 0; i < 4; i++)
+        cur[i] = axis_move[i] ? lerp(t, prev[i], pos[i]) : prev[i];
+    store_pos(out, cur[0], cur[1], cur[2] + z_offset, cur[3]);
+}
+
+// Transform a g-code move, storing the resulting toolhead positions
+// (four values each) in 'out'.  Returns the number of positions stored.
+int __visible
+move_transform_move(struct move_transform *mt, double *newpos
+                    , double *out, int max_out)
+{
+    double pos[4];
+    if (mt->has_matrix) {
+        double x = newpos[0], y = newpos[1], z = newpos[2], *m = mt->matrix;
+        pos[0] = m[0] * x + m[1] * y + m[2] * z + m[3];
+        pos[1] = m[4] * x + m[5] * y + m[6] * z + m[7];
+        pos[2] = m[8] * x + m[9] * y + m[10] * z + m[11];
+    } else {
+        pos[0] = newpos[0];
+        pos[1] = newpos[1];
+        pos[2] = newpos[2];
+    }
+    pos[3] = newpos[3];
+    mt->fade_complete = 0;
+    if (!mt->mesh) {
+        memcpy(out, pos, sizeof(pos));
+        return 1;
+    }
+
+    // Determine the bed mesh fade factor
+    double factor = 1.;
+    if (pos[2] >= mt->fade_end)
+        factor = 0.;
+    else if (pos[2] >= mt->fade_start)
+        factor = (mt->fade_end - pos[2]) / mt->fade_dist;
+    if (!factor) {
+        mt->fade_complete = 1;
+        store_pos(out, pos[0], pos[1], pos[2] + mt->fade_target, pos[3]);
+        memcpy(mt->last_pos, pos, sizeof(pos));
+        return 1;
+    }
+
+    // Split the move where it crosses the mesh grid lines (and where
+    // the z adjustment peaks between them)
+    double *prev = mt->last_pos;
+    int axis_move[4], i, count = 0, crossing_count = 0;
+    for (i = 0; i < 4; i++)
+        axis_move[i] = fabs(pos[i] - prev[i]) > 1e-10;
+    if (axis_move[0])
+        crossing_count += find_crossings(prev[0], pos[0], mt->min_x
+                                         , mt->dist_x, mt->x_count
+                                         , &mt->crossings[crossing_count]);
+    if (axis_move[1])
+        crossing_count += find_crossings(prev[1], pos[1], mt->min_y
+                                         , mt->dist_y, mt->y_count
+                                         , &mt->crossings[crossing_count]);
+    qsort(mt->crossings, crossing_count, sizeof(mt->crossings[0]), cmp_double);
+    double *points = mt->points;
+    int point_count = calc_split_points(mt, prev, pos, crossing_count
+                                        , factor, points);
+    double z_offset = factor * calc_z(mt, prev[0], prev[1]) + mt->mesh_offset;
+    double peak_t = 0., peak_z = z_offset, split_delta_z = mt->split_delta_z;
+    int has_peak = 0, j = 0;
+    while (j < point_count && count < max_out - 1) {
+        double t = points[j * 2], next_z = points[j * 2 + 1];
+        if (has_peak && fabs(next_z - peak_z) >= split_delta_z) {
+            // Split at the peak and recheck this point from there
+            store_split_pos(&out[count * 4], prev, pos, axis_move
+                            , peak_t, peak_z);
+            count++;
+            z_offset = peak_z;
+            has_peak = 0;
+            continue;
+        }
+        double delta_z = fabs(next_z - z_offset);
+        if (delta_z >= split_delta_z) {
+            store_split_pos(&out[count * 4], prev, pos, axis_move
+                            , t, next_z);
+            count++;
+            z_offset = peak_z = next_z;
+            has_peak = 0;
+        } else if (delta_z > fabs(peak_z - z_offset)) {
+            peak_t = t;
+            peak_z = next_z;
+            has_peak = 1;
+        }
+        j++;
+    }
+    z_offset = factor * calc_z(mt, pos[0], pos[1]) + mt->mesh_offset;
+    if (has_peak && count < max_out - 1
+        && fabs(z_offset - peak_z) >= split_delta_z) {
+        store_split_pos(&out[count * 4], prev, pos, axis_move
+                        , peak_t, peak_z);
+        count++;
+    }
+    store_pos(&out[count * 4], pos[0], pos[1], pos[2] + z_offset, pos[3]);
+    count++;
+    memcpy(mt->last_pos, pos, sizeof(pos));
+    return count;
+}
+
+// Report if the bed mesh fade was complete on the last transformed move
+int __visible
+move_transform_fade_complete(struct move_transform *mt)
+{
+    return mt->fade_complete;
+}
@@ -0,0 +1,34 @@
+#ifndef MOVETRANSFORM_H
+#define MOVETRANSFORM_H
+
+struct move_transform {
+    // Fused affine transform of the x, y, and z coordinates
+    int has_matrix;
+    double matrix[12];
+    // Bed mesh stage (enabled if mesh is non-NULL)
+    double *mesh, *cells, *crossings, *points;
+    int x_count, y_count;
+    double min_x, min_y, dist_x, dist_y, mesh_offset, split_delta_z;
+    double fade_start, fade_end, fade_dist, fade_target;
+    double last_pos[4];
+    int fade_complete;
+};
+
+struct move_transform *move_transform_alloc(void);
+void move_transform_free(struct move_transform *mt);
+void move_transform_set_matrix(struct move_transform *mt, double *matrix);
+void move_transform_set_mesh(struct move_transform *mt, double *mesh
+                             , int x_count, int y_count
+                             , double min_x, double min_y
+                             , double dist_x, double dist_y);
+void move_transform_set_mesh_params(struct move_transform *mt
+                                    , double mesh_offset, double split_delta_z
+                                    , double fade_start, double fade_end
+                                    , double fade_dist, double fade_target);
+void move_transform_set_position(struct move_transform *mt, double *pos);
+void move_transform_get_position(struct move_transform *mt, double *pos);
+int move_transform_move(struct move_transform *mt, double *newpos
+                        , double *out, int max_out);
+int move_transform_fade_complete(struct move_transform *mt);
+
+#endif // movetransform.h
@@ -0,0 +1,100 @@
+// Decoding of messages received from the micro-controller
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "msgdecode.h" // struct msgdecode
+#include "serialqueue.h" // MESSAGE_HEADER_SIZE
+
+// Allocate a new (empty) decoder table
+struct msgdecode * __visible
+msgdecode_alloc(void)
+{
+    struct msgdecode *md = malloc(sizeof(*md));
+    memset(md, 0, sizeof(*md));
+    return md;
+}
+
+// Free memory associated with a decoder table
+void __visible
+msgdecode_free(struct msgdecode *md)
+{
+    if (!md)
+        return;
+    int i;
+    for (i = 0; i < ARRAY_SIZE(md->formats); i++)
+        free(md->formats[i]);
+    free(md);
+}
+
+// Register the parameter types of a message id.  Each character of
+// 'types' describes one parameter: 'u' for an unsigned integer, 'i'
+// for a signed integer, and 's' for a string/buffer.
+int __visible
+msgdecode_add_format(struct msgdecode *md, int msgid, char *types)
+{
+    int count = strlen(types);
+    if (msgid < 0 || msgid >= ARRAY_SIZE(md->formats)
+        || count > MSGDECODE_MAX_PARAMS)
+        return -1;
+    struct msgdecode_format *mf = malloc(sizeof(*mf));
+    memset(mf, 0, sizeof(*mf));
+    mf->param_count = count;
+    memcpy(mf->types, types, count);
+    free(md->formats[msgid]);
+    md->formats[msgid] = mf;
+    return 0;
+}
+
+// Decode a message block containing a single message.  Integer
+// parameters are stored in 'params' while string parameters are
+// stored as an offset (into 'msg') and length pair.  Returns the
+// number of entries stored in 'params' or -1 if the message could
+// not be decoded.
+int __visible
+msgdecode_decode(struct msgdecode *md, uint8_t *msg, int len
+                 , int64_t *params, int max)
+{
+    int pos = MESSAGE_HEADER_SIZE, end = len - MESSAGE_TRAILER_SIZE;
+    if (pos >= end)
+        return -1;
+    struct msgdecode_format *mf = md->formats[msg[pos++]];
+    if (!mf)
+        return -1;
+    int i, count = 0;
+    for (i = 0; i < mf->param_count; i++) {
+        uint8_t type = mf->types[i];
+        if (type == 's') {
+            if (pos >= end || count + 2 > max)
+                return -1;
+            int slen = msg[pos];
+            params[count++] = pos + 1;
+            params[count++] = slen;
+            pos += slen + 1;
+            continue;
+        }
+        if (pos >= end || count >= max)
+            return -1;
+        uint32_t c = msg[pos++];
+        uint64_t v = c & 0x7f;
+        if ((c & 0x60) == 0x60)
+            v |= -0x20;
+        while (c & 0x80) {
+            if (pos >= end)
+                return -1;
+            c = msg[pos++];
+            v = (v << 7) | (c & 0x7f);
+        }
+        if (type == 'u')
+            params[count++] = (uint32_t)v;
+        else
+            params[count++] = (int64_t)v;
+    }
+    if (pos != end)
+        return -1;
+    return count;
+}
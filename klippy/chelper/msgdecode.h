@@ -0,0 +1,23 @@
+#ifndef MSGDECODE_H
+#define MSGDECODE_H
+
+#include <stdint.h> // uint8_t
+
+#define MSGDECODE_MAX_PARAMS 64
+
+struct msgdecode_format {
+    int param_count;
+    uint8_t types[MSGDECODE_MAX_PARAMS];
+};
+
+struct msgdecode {
+    struct msgdecode_format *formats[256];
+};
+
+struct msgdecode *msgdecode_alloc(void);
+void msgdecode_free(struct msgdecode *md);
+int msgdecode_add_format(struct msgdecode *md, int msgid, char *types);
+int msgdecode_decode(struct msgdecode *md, uint8_t *msg, int len
+                     , int64_t *params, int max);
+
+#endif // msgdecode.h
@@ -25,6 +25,7 @@
 #include <unistd.h> // pipe
 #include "compiler.h" // __visible
 #include "list.h" // list_add_tail
+#include "msgdecode.h" // msgdecode_decode
 #include "pyhelper.h" // get_monotonic
 #include "serialqueue.h" // struct queue_message
 
@@ -364,6 +365,8 @@ struct serialqueue {
     double est_freq, last_clock_time;
     uint64_t last_clock;
     double last_receive_sent_time;
+    // Received message decoding
+    struct msgdecode *decoder;
     // Retransmit support
     uint64_t send_seq, receive_seq;
     uint64_t ignore_nak_seq, last_ack_seq, retransmit_seq, rtt_sample_seq;
@@ -1004,6 +1007,26 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Schedule the transmission of several messages (stored back-to-back
+// in 'data') on the given command queue with a single call
+void __visible
+serialqueue_send_multiple(struct serialqueue *sq, struct command_queue *cq
+                          , uint8_t *data, int *lens, uint64_t *min_clocks
+                          , uint64_t *req_clocks, int count)
+{
+    struct list_head msgs;
+    list_init(&msgs);
+    int i;
+    for (i=0; i<count; i++) {
+        struct queue_message *qm = message_fill(data, lens[i]);
+        qm->min_clock = min_clocks[i];
+        qm->req_clock = req_clocks[i];
+        list_add_tail(&qm->node, &msgs);
+        data += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
 void __visible
@@ -1035,8 +1058,16 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
         debug_queue_add(&sq->old_receive, qm);
     else
         message_free(qm);
+    struct msgdecode *decoder = sq->decoder;
 
     pthread_mutex_unlock(&sq->lock);
+
+    // Decode message parameters
+    pqm->param_count = -1;
+    if (decoder && pqm->len)
+        pqm->param_count = msgdecode_decode(
+            decoder, pqm->msg, pqm->len, pqm->params
+            , ARRAY_SIZE(pqm->params));
     return;
 
 exit:
@@ -1044,6 +1075,15 @@ exit:
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Set the table used to decode received messages in serialqueue_pull()
+void __visible
+serialqueue_set_decoder(struct serialqueue *sq, struct msgdecode *md)
+{
+    pthread_mutex_lock(&sq->lock);
+    sq->decoder = md;
+    pthread_mutex_unlock(&sq->lock);
+}
+
 void __visible
 serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust)
 {
@@ -1126,6 +1166,7 @@ serialqueue_extract_old(struct serialqueue *sq, int sentq
             pqm->len = qm->len;
             pqm->sent_time = qm->sent_time;
             pqm->receive_time = qm->receive_time;
+            pqm->param_count = -1;
         }
         list_del(&qm->node);
         message_free(qm);
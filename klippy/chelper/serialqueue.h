@@ -44,6 +44,9 @@ struct pull_queue_message {
     int len;
     double sent_time, receive_time;
     uint64_t notify_id;
+    // Filled by serialqueue_pull() if a decoder is set (else -1)
+    int param_count;
+    int64_t params[MESSAGE_MAX];
 };
 
 struct serialqueue;
@@ -57,7 +60,13 @@ void serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
+void serialqueue_send_multiple(struct serialqueue *sq, struct command_queue *cq
+                               , uint8_t *data, int *lens
+                               , uint64_t *min_clocks, uint64_t *req_clocks
+                               , int count);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+struct msgdecode;
+void serialqueue_set_decoder(struct serialqueue *sq, struct msgdecode *md);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
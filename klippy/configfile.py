@@ -94,6 +94,7 @@ class PrinterConfig:
         self.printer = printer
         self.autosave = None
         self.status_info = {}
+        self.status_version = 0
         self.save_config_pending = False
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
@@ -254,6 +255,7 @@ class PrinterConfig:
         self.printer.set_rollover_info("config", "\n".join(lines))
     # Status reporting
     def _build_status(self, config):
+        self.status_version += 1
         self.status_info.clear()
         for section in config.get_prefix_sections(''):
             self.status_info[section.get_name()] = section_status = {}
@@ -262,6 +264,8 @@ class PrinterConfig:
     def get_status(self, eventtime):
         return {'config': self.status_info,
                 'save_config_pending': self.save_config_pending}
+    def get_status_version(self):
+        return self.status_version, self.save_config_pending
     # Autosave functions
     def set(self, section, option, value):
         if not self.autosave.fileconfig.has_section(section):
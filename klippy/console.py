@@ -41,7 +41,7 @@ class KeyboardReader:
         self.pins = pins.PinResolver(validate_aliases=False)
         self.data = ""
         reactor.register_fd(self.fd, self.process_kbd)
-        reactor.register_callback(self.connect)
+        reactor.call_soon(self.connect)
         self.local_commands = {
             "PINS": self.command_PINS, "SET": self.command_SET,
             "DELAY": self.command_DELAY, "FLOOD": self.command_FLOOD,
@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, importlib, array
 from . import bus
 
 # ADXL345 registers
@@ -22,9 +22,27 @@ QUERY_RATES = {
 
 SCALE = 0.004 * 9.80665 * 1000. # 4mg/LSB * Earth gravity in mm/s**2
 
+RAW_FORMATS = ['csv', 'npz']
+
+CAPTURE_CHUNK = 4096 # Number of messages stored together
+MSG_SIZE = 48 # Data size of a full adxl345_data message (8 samples)
+DATA_CALLBACK_MESSAGES = 200 # About 0.5 seconds of samples at 3200Hz
+
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Decode a list of (sequence, data) messages into a numpy array of the
+# number of samples in each message and an array of raw x, y, z readings
+def decode_raw_messages(np, raw_samples):
+    counts = [len(data) // 6 for _, data in raw_samples]
+    if any(len(data) % 6 for _, data in raw_samples):
+        buf = b''.join([data[:count*6] for (_, data), count
+                        in zip(raw_samples, counts)])
+    else:
+        buf = b''.join([data for _, data in raw_samples])
+    sdata = np.frombuffer(buf, dtype='<i2').reshape(-1, 3)
+    return np.array(counts), sdata
+
 # Sample results
 class ADXL345Results:
     def __init__(self):
@@ -38,7 +56,8 @@ class ADXL345Results:
                 % (self.drops, self.overflows,
                    self.time_per_sample, self.start_range, self.end_range))
     def setup_data(self, axes_map, raw_samples, end_sequence, overflows,
-                   start1_time, start2_time, end1_time, end2_time):
+                   start1_time, start2_time, end1_time, end2_time,
+                   discarded_samples=0):
         if not raw_samples or not end_sequence:
             return
         self.axes_map = axes_map
@@ -51,8 +70,13 @@ class ADXL345Results:
         total_time = end2_time - start2_time
         self.time_per_sample = time_per_sample = total_time / self.total_count
         self.seq_to_time = time_per_sample * 8.
-        actual_count = sum([len(data)//6 for _, data in raw_samples])
+        actual_count = discarded_samples + sum([len(data)//6
+                                                for _, data in raw_samples])
         self.drops = self.total_count - actual_count
+    def get_sample_time(self, sequence, index):
+        # Time of a sample (as calculated by decode_samples())
+        seq_time = self.start2_time + sequence * self.seq_to_time
+        return seq_time + index * self.time_per_sample
     def decode_samples(self):
         if not self.raw_samples:
             return self.samples
@@ -74,25 +98,237 @@ class ADXL345Results:
                 actual_count += 1
         del samples[actual_count:]
         return self.samples
-    def write_to_file(self, filename):
+    def _decode_raw_arrays(self, np):
+        # Decode the samples into numpy arrays of sample times, raw
+        # (unscaled) x, y, z readings, and the scale of each axis
+        if not self.raw_samples:
+            return np.zeros(0), np.zeros((0, 3), np.int16), np.ones(3)
+        counts, sdata = decode_raw_messages(np, self.raw_samples)
+        positions = [pos for pos, scale in self.axes_map]
+        scales = np.array([scale for pos, scale in self.axes_map])
+        # Calculate the time of each sample from its sequence and index
+        seqs = np.array([seq for seq, _ in self.raw_samples], np.float64)
+        seq_times = self.start2_time + seqs * self.seq_to_time
+        starts = np.cumsum(counts) - counts
+        indexes = np.arange(sdata.shape[0]) - np.repeat(starts, counts)
+        times = (np.repeat(seq_times, counts)
+                 + indexes * self.time_per_sample)
+        return times, sdata[:, positions], scales
+    def decode_samples_array(self, np):
+        # Same as decode_samples(), but returns a numpy array with
+        # time, accel_x, accel_y, accel_z columns
+        times, accel, scales = self._decode_raw_arrays(np)
+        return np.column_stack((times, accel * scales))
+    def _write_csv(self, filename):
+        f = open(filename, "w")
+        f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (
+            self.get_stats(),))
+        samples = self.samples or self.decode_samples()
+        for t, accel_x, accel_y, accel_z in samples:
+            f.write("%.6f,%.6f,%.6f,%.6f\n" % (
+                t, accel_x, accel_y, accel_z))
+        f.close()
+    def _write_npz(self, filename, np):
+        # Store the raw readings (the accelerations are accel * scale)
+        times, accel, scales = self._decode_raw_arrays(np)
+        np.savez(filename, time=times, accel=accel, scale=scales,
+                 stats=self.get_stats())
+    def write_to_file(self, filename, np=None):
+        # Write the samples in csv format (or in the numpy npz format if
+        # the numpy module is provided)
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (
-                self.get_stats(),))
-            samples = self.samples or self.decode_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
-            f.close()
+            if np is not None:
+                self._write_npz(filename, np)
+            else:
+                self._write_csv(filename)
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
 
+# Storage for the bulk data messages of a measurement (accessed from
+# the background thread).  Messages are collected in a list and stored
+# in compact chunks of CAPTURE_CHUNK messages, so memory is only used
+# as the measurement grows.
+class AccelCaptureBuffer:
+    def __init__(self, max_messages, ring_buffer=False):
+        self.max_messages = max_messages
+        self.ring_buffer = ring_buffer
+        self.reset()
+    def reset(self):
+        # The chunks, the index of the first pending message and the
+        # pending messages are replaced together so that readers on
+        # other threads see a consistent view
+        self.pending = []
+        self.state = ([], 0, self.pending)
+        self.pending_limit = min(CAPTURE_CHUNK, self.max_messages)
+        self.stored_count = self.stored_bytes = 0
+        self.discarded_bytes = 0
+        self.overflows = self.gaps = 0
+        self.last_sequence = -1
+    def add_message(self, sequence, data):
+        pending = self.pending
+        if len(pending) >= self.pending_limit:
+            if not self._store_pending(sequence):
+                return
+            pending = self.pending
+        pending.append((sequence, data))
+    def _count_gaps(self, pending, last_sequence):
+        first_sequence = pending[0][0]
+        gaps = pending[-1][0] - first_sequence + 1 - len(pending)
+        if last_sequence >= 0:
+            gaps += first_sequence - last_sequence - 1
+        return gaps
+    def _store_pending(self, sequence):
+        chunks, pending_index, pending = self.state
+        if pending:
+            count = len(pending)
+            gaps = self._count_gaps(pending, self.last_sequence)
+            first_sequence = pending[0][0]
+            last_sequence = pending[-1][0]
+            datas = [data for seq, data in pending]
+            data = b''.join(datas)
+            # Only store the sequences and lengths of the messages that
+            # are not contiguous and full (which is rare)
+            sequences = lengths = None
+            if last_sequence - first_sequence + 1 != count:
+                sequences = array.array('l', [seq for seq, d in pending])
+            if len(data) != count * MSG_SIZE:
+                lengths = array.array('B', map(len, datas))
+            chunk = (pending_index, count, first_sequence, sequences,
+                     lengths, data)
+            self.gaps += gaps
+            self.last_sequence = last_sequence
+            chunks = chunks + [chunk]
+            pending_index += count
+            self.stored_count += count
+            self.stored_bytes += len(data)
+            if self.ring_buffer:
+                # Discard the oldest chunks
+                while self.stored_count - chunks[0][1] >= self.max_messages:
+                    dropped = chunks.pop(0)
+                    self.stored_count -= dropped[1]
+                    self.stored_bytes -= len(dropped[5])
+                    self.overflows += dropped[1]
+            self.pending = []
+            self.state = (chunks, pending_index, self.pending)
+        space = self.max_messages - self.stored_count
+        if not self.ring_buffer:
+            self.pending_limit = min(CAPTURE_CHUNK, space)
+            if space <= 0:
+                # Avoid discarding the start of the measurement
+                if sequence > self.last_sequence + 1:
+                    self.gaps += sequence - self.last_sequence - 1
+                self.last_sequence = sequence
+                self.overflows += 1
+                return False
+        return True
+    def discard_messages(self, end_index):
+        # Free the stored messages before the given index (the most
+        # recent chunk is always kept).  This must be called from the
+        # thread that adds the messages.
+        chunks, pending_index, pending = self.state
+        count = 0
+        while (count < len(chunks) - 1
+               and chunks[count][0] + chunks[count][1] <= end_index):
+            count += 1
+        for chunk in chunks[:count]:
+            self.stored_count -= chunk[1]
+            self.stored_bytes -= len(chunk[5])
+            self.discarded_bytes += len(chunk[5])
+        if count:
+            self.state = (chunks[count:], pending_index, pending)
+    def get_count(self):
+        # Return the index of the next message to be stored
+        chunks, pending_index, pending = self.state
+        return pending_index + len(pending)
+    def get_messages(self, first_index=0, end_index=None):
+        # Return the stored (sequence, data) messages in order, starting
+        # with the message at the given index (the first message stored
+        # since the buffer was reset has index 0)
+        chunks, pending_index, pending = self.state
+        if end_index is None:
+            end_index = pending_index + len(pending)
+        messages = []
+        for chunk in chunks:
+            chunk_index, count, first_sequence, sequences, lengths, data = chunk
+            start = max(first_index - chunk_index, 0)
+            end = min(end_index - chunk_index, count)
+            if start >= end:
+                continue
+            if sequences is None:
+                sequences = range(first_sequence, first_sequence + count)
+            if lengths is None:
+                messages.extend([(sequences[i], data[i*MSG_SIZE:(i+1)*MSG_SIZE])
+                                 for i in range(start, end)])
+                continue
+            pos = sum(lengths[:start])
+            for i in range(start, end):
+                next_pos = pos + lengths[i]
+                messages.append((sequences[i], data[pos:next_pos]))
+                pos = next_pos
+        messages.extend(pending[max(0, first_index - pending_index)
+                                :max(0, end_index - pending_index)])
+        return messages
+    def get_stats(self):
+        status = self.get_status()
+        return ("buffer_overflows=%d,sequence_gaps=%d"
+                % (status['buffer_overflows'], status['sequence_gaps']))
+    def get_status(self):
+        chunks, pending_index, pending = self.state
+        pending = pending[:]
+        gaps, stored_bytes = self.gaps, self.stored_bytes
+        count = self.stored_count + len(pending)
+        if pending:
+            gaps += self._count_gaps(pending, self.last_sequence)
+            stored_bytes += sum([len(data) for seq, data in pending])
+        return {'buffer_samples': stored_bytes // 6,
+                'buffer_fill': (float(min(count, self.max_messages))
+                                / self.max_messages),
+                'buffer_overflows': self.overflows,
+                'sequence_gaps': gaps}
+
+# Helper to decode the samples of a measurement while it is in progress
+class AccelSampleReader:
+    def __init__(self, chip, np):
+        self.chip = chip
+        self.numpy = np
+        self.rate = chip.query_rate
+        self.positions = [pos for pos, scale in chip.axes_map]
+        self.scales = np.array([scale for pos, scale in chip.axes_map])
+        self.next_index = 0
+        self.first_sequence = None
+        self.last_sequence = self.last_count = 0
+    def read_samples(self):
+        # Return an array of the x, y, z accelerations of the samples
+        # received since the last call (or None if there are none)
+        capture = self.chip.capture
+        end_index = capture.get_count()
+        messages = capture.get_messages(self.next_index, end_index)
+        self.next_index = end_index
+        if not messages:
+            return None
+        counts, sdata = decode_raw_messages(self.numpy, messages)
+        if self.first_sequence is None:
+            self.first_sequence = messages[0][0]
+        self.last_sequence = messages[-1][0]
+        self.last_count = int(counts[-1])
+        return sdata[:, self.positions] * self.scales
+    def discard_samples(self):
+        # Free the memory of the samples already read (only valid from
+        # a data callback)
+        self.chip.capture.discard_messages(self.next_index)
+    def get_sampling_freq(self, results, sample_count):
+        # Average sampling frequency of the read samples
+        start_time = results.get_sample_time(self.first_sequence, 0)
+        end_time = results.get_sample_time(self.last_sequence,
+                                           self.last_count - 1)
+        return sample_count / (end_time - start_time)
+
 # Printer class that controls measurments
 class ADXL345:
     def __init__(self, config):
@@ -109,9 +345,14 @@ class ADXL345:
         if self.data_rate not in QUERY_RATES:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
         # Measurement storage (accessed from background thread)
-        self.raw_samples = []
+        max_samples = config.getint('capture_samples', 2400000, minval=8)
+        self.capture = AccelCaptureBuffer(
+            max_samples // 8, config.getboolean('capture_ring_buffer', False))
         self.last_sequence = 0
         self.samples_start1 = self.samples_start2 = 0.
+        # Callbacks run (in the background thread) as messages arrive
+        self.data_callbacks = []
+        self.callback_count = 0
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
         self.mcu = mcu = self.spi.get_mcu()
@@ -123,7 +364,8 @@ class ADXL345:
                            % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
         mcu.register_response(self._handle_adxl345_start, "adxl345_start", oid)
-        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid)
+        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid,
+                              queued=True)
         # Register commands
         name = "default"
         if len(config.get_name().split()) > 1:
@@ -160,11 +402,21 @@ class ADXL345:
         if sequence < last_sequence:
             sequence += 0x10000
         self.last_sequence = sequence
-        raw_samples = self.raw_samples
-        if len(raw_samples) >= 300000:
-            # Avoid filling up memory with too many samples
-            return
-        raw_samples.append((sequence, params['data']))
+        self.capture.add_message(sequence, params['data'])
+        callbacks = self.data_callbacks
+        if callbacks:
+            self.callback_count += 1
+            if self.callback_count >= DATA_CALLBACK_MESSAGES:
+                self.callback_count = 0
+                for cb in callbacks:
+                    cb()
+    def add_data_callback(self, callback):
+        # The callback is invoked from the background thread after every
+        # DATA_CALLBACK_MESSAGES messages of a measurement
+        self.data_callbacks = self.data_callbacks + [callback]
+    def remove_data_callback(self, callback):
+        self.data_callbacks = [cb for cb in self.data_callbacks
+                               if cb != callback]
     def _convert_sequence(self, sequence):
         sequence = (self.last_sequence & ~0xffff) | sequence
         if sequence < self.last_sequence:
@@ -189,8 +441,8 @@ class ADXL345:
         self.spi.spi_send([REG_FIFO_CTL, 0x80])
         # Setup samples
         print_time = self.printer.lookup_object('toolhead').get_last_move_time()
-        self.raw_samples = []
-        self.last_sequence = 0
+        self.capture.reset()
+        self.last_sequence = self.callback_count = 0
         self.samples_start1 = self.samples_start2 = print_time
         # Start bulk reading
         reqclock = self.mcu.print_time_to_clock(print_time)
@@ -210,8 +462,8 @@ class ADXL345:
                                                  minclock=clock)
         self.last_tx_time = print_time
         self.query_rate = 0
-        raw_samples = self.raw_samples
-        self.raw_samples = []
+        self.mcu.flush_queued_responses()
+        raw_samples = self.capture.get_messages()
         # Generate results
         end1_time = self._clock_to_print_time(params['end1_time'])
         end2_time = self._clock_to_print_time(params['end2_time'])
@@ -220,24 +472,43 @@ class ADXL345:
         res = ADXL345Results()
         res.setup_data(self.axes_map, raw_samples, end_sequence, overflows,
                        self.samples_start1, self.samples_start2,
-                       end1_time, end2_time)
-        logging.info("ADXL345 finished %d measurements: %s",
-                     res.total_count, res.get_stats())
+                       end1_time, end2_time,
+                       self.capture.discarded_bytes // 6)
+        logging.info("ADXL345 finished %d measurements: %s,%s",
+                     res.total_count, res.get_stats(),
+                     self.capture.get_stats())
         return res
-    def end_query(self, name):
+    def get_sample_reader(self, np):
+        return AccelSampleReader(self, np)
+    def get_status(self, eventtime):
+        status = self.capture.get_status()
+        status['measuring'] = self.query_rate != 0
+        return status
+    def end_query(self, name, raw_format='csv'):
         if not self.query_rate:
             return
+        np = None
+        if raw_format == 'npz':
+            try:
+                np = importlib.import_module('numpy')
+            except ImportError:
+                raise self.printer.command_error(
+                    "Failed to import `numpy` module, needed for the npz"
+                    " format")
         res = self.finish_measurements()
         # Write data to file
-        filename = "/tmp/adxl345-%s.csv" % (name,)
-        res.write_to_file(filename)
+        filename = "/tmp/adxl345-%s.%s" % (name, raw_format)
+        res.write_to_file(filename, np)
     cmd_ACCELEROMETER_MEASURE_help = "Start/stop accelerometer"
     def cmd_ACCELEROMETER_MEASURE(self, gcmd):
         if self.query_rate:
             name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
             if not name.replace('-', '').replace('_', '').isalnum():
                 raise gcmd.error("Invalid adxl345 NAME parameter")
-            self.end_query(name)
+            raw_format = gcmd.get("FORMAT", "csv").lower()
+            if raw_format not in RAW_FORMATS:
+                raise gcmd.error("Invalid adxl345 FORMAT parameter")
+            self.end_query(name, raw_format)
             gcmd.respond_info("adxl345 measurements stopped")
         else:
             rate = gcmd.get_int("RATE", self.data_rate)
@@ -252,7 +523,7 @@ class ADXL345:
         self.start_measurements()
         reactor = self.printer.get_reactor()
         eventtime = starttime = reactor.monotonic()
-        while not self.raw_samples:
+        while not self.capture.get_count():
             eventtime = reactor.pause(eventtime + .1)
             if eventtime > starttime + 3.:
                 # Try to shutdown the measurements
@@ -4,7 +4,7 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, importlib
 from . import probe
 
 PROFILE_VERSION = 1
@@ -62,6 +62,7 @@ class BedMesh:
         self.last_position = [0., 0., 0., 0.]
         self.bmc = BedMeshCalibrate(config, self)
         self.z_mesh = None
+        self.mesh_version = 0
         self.toolhead = None
         self.horizontal_move_z = config.getfloat('horizontal_move_z', 5.)
         self.fade_start = config.getfloat('fade_start', 1.)
@@ -73,7 +74,9 @@ class BedMesh:
         self.base_fade_target = config.getfloat('fade_target', None)
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
-        self.splitter = MoveSplitter(config, self.gcode)
+        splitter_class = config.getchoice('split_method', SplitMethods,
+                                          'distance')
+        self.splitter = splitter_class(config, self.gcode)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -95,6 +98,7 @@ class BedMesh:
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
     def set_mesh(self, mesh):
+        self.mesh_version += 1
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
             if self.base_fade_target is None:
@@ -168,10 +172,7 @@ class BedMesh:
             # No mesh calibrated, or mesh leveling phased out.
             x, y, z, e = newpos
             if self.log_fade_complete:
-                self.log_fade_complete = False
-                logging.info(
-                    "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
-                    % (z, self.fade_target))
+                self.note_fade_complete(z)
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
         else:
             self.splitter.build_move(self.last_position, newpos, factor)
@@ -183,6 +184,23 @@ class BedMesh:
                     raise self.gcode.error(
                         "Mesh Leveling: Error splitting move ")
         self.last_position[:] = newpos
+    def note_fade_complete(self, z):
+        self.log_fade_complete = False
+        logging.info(
+            "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
+            % (z, self.fade_target))
+    def get_transform_stage(self):
+        # Moves split at the mesh cell boundaries may be fused with
+        # other move transforms (see gcode_move.FusedMoveTransform)
+        if not isinstance(self.splitter, CellMoveSplitter):
+            return None
+        if self.z_mesh is None:
+            return ('affine', [[1., 0., 0., 0.], [0., 1., 0., 0.],
+                               [0., 0., 1., self.fade_target]])
+        return ('mesh', self.z_mesh,
+                (self.fade_start, self.fade_end, self.fade_dist,
+                 self.fade_target),
+                self.splitter.split_delta_z, self.last_position)
     def get_status(self, eventtime=None):
         status = {
             "profile_name": "",
@@ -203,6 +221,8 @@ class BedMesh:
             status['probed_matrix'] = probed_matrix
             status['mesh_matrix'] = mesh_matrix
         return status
+    def get_status_version(self):
+        return self.mesh_version, self.pmgr.get_current_profile()
     def get_mesh(self):
         return self.z_mesh
     cmd_BED_MESH_OUTPUT_help = "Retrieve interpolated grid of probed z-points"
@@ -584,25 +604,152 @@ class MoveSplitter:
                         return self.current_pos[0], self.current_pos[1], \
                             self.current_pos[2] + self.z_offset, \
                             self.current_pos[3]
-            # end of move reached
-            self.current_pos[:] = self.next_pos
-            self.z_offset = self._calc_z_offset(self.current_pos)
-            # Its okay to add Z-Offset to the final move, since it will not be
-            # used again.
-            self.current_pos[2] += self.z_offset
-            self.traverse_complete = True
-            return self.current_pos
+            return self._complete_traverse()
         else:
             # Traverse complete
             return None
+    def _complete_traverse(self):
+        # end of move reached
+        self.current_pos[:] = self.next_pos
+        self.z_offset = self._calc_z_offset(self.current_pos)
+        # Its okay to add Z-Offset to the final move, since it will not be
+        # used again.
+        self.current_pos[2] += self.z_offset
+        self.traverse_complete = True
+        return self.current_pos
+
+# Variant of MoveSplitter that calculates where a move crosses the
+# grid lines of the mesh (and where the Z adjustment peaks within each
+# crossed cell) and only checks the Z adjustment at those points.  The
+# Z adjustment at these points is calculated from the precalculated
+# coefficients of each cell instead of at every move_check_distance
+# along the move.  If the Z adjustment rises and then falls again (or
+# vice versa) by split_delta_z then the move is also split at the peak.
+class CellMoveSplitter(MoveSplitter):
+    def build_move(self, prev_pos, next_pos, factor):
+        MoveSplitter.build_move(self, prev_pos, next_pos, factor)
+        z_mesh = self.z_mesh
+        crossings = []
+        if self.axis_move[0]:
+            crossings.extend(self._find_crossings(
+                0, z_mesh.mesh_x_min, z_mesh.mesh_x_dist,
+                z_mesh.mesh_x_count))
+        if self.axis_move[1]:
+            crossings.extend(self._find_crossings(
+                1, z_mesh.mesh_y_min, z_mesh.mesh_y_dist,
+                z_mesh.mesh_y_count))
+        crossings.sort()
+        # Store in reverse order so the next point may be popped
+        points = self._calc_split_points(crossings)
+        points.reverse()
+        self.points = points
+        self.peak = (None, self.z_offset)
+    def _find_crossings(self, axis, mesh_min, mesh_dist, mesh_cnt):
+        # Return the fraction of the move at each crossed grid line
+        start = self.prev_pos[axis]
+        move_d = self.next_pos[axis] - start
+        low, high = sorted([start, start + move_d])
+        first_idx = max(0, int(math.ceil((low - mesh_min) / mesh_dist)))
+        last_idx = min(mesh_cnt - 1,
+                       int(math.floor((high - mesh_min) / mesh_dist)))
+        crossings = []
+        for idx in range(first_idx, last_idx + 1):
+            t = (mesh_min + mesh_dist * idx - start) / move_d
+            if t > 0. and t < 1.:
+                crossings.append(t)
+        return crossings
+    def _calc_split_points(self, crossings):
+        # Return the (fraction of the move, Z adjustment) at each
+        # crossed grid line.  Within a cell the Z adjustment along a
+        # diagonal move is a quadratic function of the move fraction,
+        # so also return the point at the extremum of that function.
+        z_mesh = self.z_mesh
+        cell_table = z_mesh.cell_table
+        if cell_table is None:
+            return []
+        x_dist = z_mesh.mesh_x_dist
+        y_dist = z_mesh.mesh_y_dist
+        max_xidx = z_mesh.mesh_x_count - 2
+        max_yidx = z_mesh.mesh_y_count - 2
+        z_factor = self.z_factor
+        mesh_offset = z_mesh.mesh_offset
+        # Start position and move distance in units of mesh cells
+        px = (self.prev_pos[0] - z_mesh.mesh_x_min) / x_dist
+        py = (self.prev_pos[1] - z_mesh.mesh_y_min) / y_dist
+        qx = (self.next_pos[0] - self.prev_pos[0]) / x_dist
+        qy = (self.next_pos[1] - self.prev_pos[1]) / y_dist
+        points = []
+        start_t = 0.
+        for end_t in crossings + [1.]:
+            mid_t = (start_t + end_t) * .5
+            xidx = min(max(int(math.floor(px + qx * mid_t)), 0), max_xidx)
+            yidx = min(max(int(math.floor(py + qy * mid_t)), 0), max_yidx)
+            z0, dx, dy, dxy = cell_table[yidx][xidx]
+            cx = px - xidx
+            cy = py - yidx
+            point_ts = []
+            # z(t) = a*t^2 + b*t + c
+            a = dxy * qx * qy
+            if a:
+                t = -(dx * qx + dy * qy + dxy * (cx * qy + cy * qx)) / (2. * a)
+                if t > start_t and t < end_t:
+                    point_ts.append(t)
+            if end_t < 1.:
+                point_ts.append(end_t)
+            for t in point_ts:
+                tx = min(max(cx + qx * t, 0.), 1.)
+                ty = min(max(cy + qy * t, 0.), 1.)
+                z = z0 + dx * tx + (dy + dxy * tx) * ty
+                points.append((t, z_factor * z + mesh_offset))
+            start_t = end_t
+        return points
+    def _split_at(self, t, z_offset):
+        current_pos = self.current_pos
+        for i in range(4):
+            if self.axis_move[i]:
+                current_pos[i] = lerp(t, self.prev_pos[i], self.next_pos[i])
+        self.z_offset = z_offset
+        self.peak = (None, z_offset)
+        return (current_pos[0], current_pos[1],
+                current_pos[2] + z_offset, current_pos[3])
+    def split(self):
+        if self.traverse_complete:
+            return None
+        points = self.points
+        split_delta_z = self.split_delta_z
+        while points:
+            t, next_z = points.pop()
+            peak_t, peak_z = self.peak
+            if peak_t is not None and abs(next_z - peak_z) >= split_delta_z:
+                # Split at the peak and recheck this point from there
+                points.append((t, next_z))
+                return self._split_at(peak_t, peak_z)
+            delta_z = abs(next_z - self.z_offset)
+            if delta_z >= split_delta_z:
+                return self._split_at(t, next_z)
+            if delta_z > abs(peak_z - self.z_offset):
+                self.peak = (t, next_z)
+        peak_t, peak_z = self.peak
+        if peak_t is not None:
+            end_z = self._calc_z_offset(self.next_pos)
+            if abs(end_z - peak_z) >= split_delta_z:
+                return self._split_at(peak_t, peak_z)
+        return self._complete_traverse()
+
+SplitMethods = {'distance': MoveSplitter, 'cell': CellMoveSplitter}
 
 
 class ZMesh:
     def __init__(self, params):
-        self.probed_matrix = self.mesh_matrix = None
+        self.probed_matrix = self.mesh_matrix = self.cell_table = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
+        # Vectorize the mesh calculations if numpy is available
+        try:
+            self.numpy = importlib.import_module('numpy')
+        except ImportError:
+            self.numpy = None
         logging.debug('bed_mesh: probe/mesh parameters:')
         for key, value in self.mesh_params.items():
             logging.debug("%s :  %s" % (key, value))
@@ -686,13 +833,39 @@ class ZMesh:
         # should produce an offset that is divisible by common
         # z step distances
         self.avg_z = round(self.avg_z, 2)
-        self.print_mesh(logging.debug)
+        self._build_cell_table()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.print_mesh(logging.debug)
     def offset_mesh(self, offset):
         if self.mesh_matrix:
             self.mesh_offset = offset
-            for y_line in self.mesh_matrix:
-                for idx, z in enumerate(y_line):
-                    y_line[idx] = z - self.mesh_offset
+            if self.numpy is not None:
+                tbl = self.numpy.array(self.mesh_matrix) - self.mesh_offset
+                for y_line, z_line in zip(self.mesh_matrix, tbl.tolist()):
+                    y_line[:] = z_line
+            else:
+                for y_line in self.mesh_matrix:
+                    for idx, z in enumerate(y_line):
+                        y_line[idx] = z - self.mesh_offset
+            self._build_cell_table()
+    def _build_cell_table(self):
+        # Calculate the bilinear interpolation coefficients of each cell
+        tbl = self.mesh_matrix
+        if self.numpy is not None:
+            tbl = self.numpy.array(tbl)
+            z0 = tbl[:-1, :-1]
+            dx = tbl[:-1, 1:] - z0
+            dy = tbl[1:, :-1] - z0
+            dxy = tbl[1:, 1:] - tbl[1:, :-1] - tbl[:-1, 1:] + z0
+            self.cell_table = [
+                list(zip(*line)) for line in zip(
+                    z0.tolist(), dx.tolist(), dy.tolist(), dxy.tolist())]
+            return
+        self.cell_table = [
+            [(tbl[y][x], tbl[y][x+1] - tbl[y][x], tbl[y+1][x] - tbl[y][x],
+              tbl[y+1][x+1] - tbl[y+1][x] - tbl[y][x+1] + tbl[y][x])
+             for x in range(self.mesh_x_count - 1)]
+            for y in range(self.mesh_y_count - 1)]
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
@@ -736,6 +909,9 @@ class ZMesh:
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
+        if self.numpy is not None:
+            self._np_sample_lagrange(z_matrix)
+            return
         x_mult = self.x_mult
         y_mult = self.y_mult
         self.mesh_matrix = \
@@ -790,6 +966,9 @@ class ZMesh:
         return total
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
+        if self.numpy is not None:
+            self._np_sample_bicubic(z_matrix)
+            return
         x_mult = self.x_mult
         y_mult = self.y_mult
         c = self.mesh_params['tension']
@@ -885,6 +1064,85 @@ class ZMesh:
         c = m1 * (t3 - 2*t2 + t)
         d = m2 * (t3 - t2)
         return a + b + c + d
+    # Vectorized versions of the interpolation algorithms.  These
+    # evaluate the same expressions in the same order as the code
+    # above, so the resulting mesh is identical.
+    def _np_probed_mesh(self, z_matrix):
+        mesh = self.numpy.zeros((self.mesh_y_count, self.mesh_x_count))
+        mesh[::self.y_mult, ::self.x_mult] = z_matrix
+        return mesh
+    def _np_sample_lagrange(self, z_matrix):
+        np = self.numpy
+        x_mult = self.x_mult
+        y_mult = self.y_mult
+        mesh = self._np_probed_mesh(z_matrix)
+        xpts, ypts = self._get_lagrange_coords()
+        # Interpolate X coordinates of the probed rows
+        cols = [j for j in range(self.mesh_x_count) if j % x_mult]
+        x = np.array([self.get_x_coordinate(j) for j in cols])
+        mesh[::y_mult, cols] = self._np_calc_lagrange(
+            xpts, x, mesh[::y_mult, ::x_mult])
+        # Interpolate Y coordinates
+        rows = [j for j in range(self.mesh_y_count) if j % y_mult]
+        y = np.array([self.get_y_coordinate(j) for j in rows])
+        mesh[rows, :] = self._np_calc_lagrange(
+            ypts, y, mesh[::y_mult, :].T).T
+        self.mesh_matrix = mesh.tolist()
+    def _np_calc_lagrange(self, lpts, c, z_pts):
+        # Interpolate each row of 'z_pts' at all the coordinates in 'c'
+        pt_cnt = len(lpts)
+        total = 0.
+        for i in range(pt_cnt):
+            n = self.numpy.ones(len(c))
+            d = 1.
+            for j in range(pt_cnt):
+                if j == i:
+                    continue
+                n *= (c - lpts[j])
+                d *= (lpts[i] - lpts[j])
+            total += z_pts[:, i:i+1] * n / d
+        return total
+    def _np_sample_bicubic(self, z_matrix):
+        np = self.numpy
+        c = self.mesh_params['tension']
+        mesh = self._np_probed_mesh(z_matrix)
+        # Interpolate X values
+        cols, pts, t = self._get_ctl_indices(self.mesh_x_count, self.x_mult)
+        if cols:
+            x_rows = mesh[::self.y_mult]
+            p = [x_rows[:, idx] for idx in pts]
+            mesh[::self.y_mult, cols] = self._cardinal_spline(
+                p + [np.array(t)], c)
+        # Interpolate Y values
+        rows, pts, t = self._get_ctl_indices(self.mesh_y_count, self.y_mult)
+        if rows:
+            p = [mesh[idx, :] for idx in pts]
+            mesh[rows, :] = self._cardinal_spline(
+                p + [np.array(t)[:, np.newaxis]], c)
+        self.mesh_matrix = mesh.tolist()
+    def _get_ctl_indices(self, mesh_cnt, mult):
+        # Find the control point indexes and t of each interpolated
+        # value along an axis (as _get_x_ctl_pts and _get_y_ctl_pts)
+        last_pt = mesh_cnt - 1 - mult
+        positions = []
+        pts = []
+        t = []
+        for pos in range(mesh_cnt):
+            if pos % mult == 0:
+                continue
+            if pos < mult:
+                pts.append((0, 0, mult, 2*mult))
+                t.append(pos / float(mult))
+            elif pos > last_pt:
+                pts.append((last_pt - mult, last_pt, last_pt + mult,
+                            last_pt + mult))
+                t.append((pos - last_pt) / float(mult))
+            else:
+                i = pos - pos % mult
+                pts.append((i - mult, i, i + mult, i + 2*mult))
+                t.append((pos - i) / float(mult))
+            positions.append(pos)
+        return positions, [list(idx) for idx in zip(*pts)], t
 
 
 class ProfileManager:
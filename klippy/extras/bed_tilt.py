@@ -26,6 +26,9 @@ class BedTilt:
     def get_position(self):
         x, y, z, e = self.toolhead.get_position()
         return [x, y, z - x*self.x_adjust - y*self.y_adjust - self.z_adjust, e]
+    def get_transform_stage(self):
+        return ('affine', [[1., 0., 0., 0.], [0., 1., 0., 0.],
+                           [self.x_adjust, self.y_adjust, 1., self.z_adjust]])
     def move(self, newpos, speed):
         x, y, z, e = newpos
         self.toolhead.move([x, y, z + x*self.x_adjust + y*self.y_adjust
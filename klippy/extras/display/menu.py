@@ -899,7 +899,7 @@ class MenuManager:
             return
         if not self.gcode_queue:
             reactor = self.printer.get_reactor()
-            reactor.register_callback(self.dispatch_gcode)
+            reactor.call_soon(self.dispatch_gcode)
         self.gcode_queue.append(script)
 
     def dispatch_gcode(self, eventtime):
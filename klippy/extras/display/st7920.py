@@ -72,6 +72,10 @@ class ST7920:
         cmd_type.send([self.oid, cmds], reqclock=BACKGROUND_PRIORITY_CLOCK)
         #logging.debug("st7920 %d %s", is_data, repr(cmds))
     def flush(self):
+        # Submit all framebuffer updates to the mcu as a single batch
+        with self.mcu.command_batch():
+            self._flush()
+    def _flush(self):
         # Find all differences in the framebuffers and send them to the chip
         for new_data, old_data, fb_id in self.all_framebuffers:
             if new_data == old_data:
@@ -15,6 +15,7 @@ TextGlyphs = { 'right_arrow': '\x1a', 'degrees': '\xf8' }
 class DisplayBase:
     def __init__(self, io, columns=128, x_offset=0):
         self.send = io.send
+        self.mcu = io.get_mcu()
         # framebuffers
         self.columns = columns
         self.x_offset = x_offset
@@ -26,6 +27,10 @@ class DisplayBase:
                      for c in font8x14.VGA_FONT]
         self.icons = {}
     def flush(self):
+        # Submit all framebuffer updates to the mcu as a single batch
+        with self.mcu.command_batch():
+            self._flush()
+    def _flush(self):
         # Find all differences in the framebuffers and send them to the chip
         for new_data, old_data, page in self.all_framebuffers:
             if new_data == old_data:
@@ -125,6 +130,8 @@ class SPI4wire:
         self.mcu_dc.update_digital_out(is_data,
                                        reqclock=BACKGROUND_PRIORITY_CLOCK)
         self.spi.spi_send(cmds, reqclock=BACKGROUND_PRIORITY_CLOCK)
+    def get_mcu(self):
+        return self.spi.get_mcu()
 
 # IO wrapper for i2c bus
 class I2C:
@@ -139,6 +146,8 @@ class I2C:
         cmds = bytearray(cmds)
         cmds.insert(0, hdr)
         self.i2c.i2c_write(cmds, reqclock=BACKGROUND_PRIORITY_CLOCK)
+    def get_mcu(self):
+        return self.i2c.get_mcu()
 
 # Helper code for toggling a reset pin on startup
 class ResetHelper:
@@ -59,10 +59,12 @@ class Fan:
 
 class PrinterFan:
     def __init__(self, config):
+        self.printer = config.get_printer()
         self.fan = Fan(config)
         # Register commands
-        gcode = config.get_printer().lookup_object('gcode')
+        gcode = self.printer.lookup_object('gcode')
         gcode.register_command("M106", self.cmd_M106)
+        gcode.register_fast_handler("M106", self._fast_M106, "S")
         gcode.register_command("M107", self.cmd_M107)
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
@@ -70,6 +72,12 @@ class PrinterFan:
         # Set fan speed
         value = gcmd.get_float('S', 255., minval=0.) / 255.
         self.fan.set_speed_from_command(value)
+    def _fast_M106(self, params, commandline):
+        value = params.get('S', 255.)
+        if value < 0.:
+            raise self.printer.command_error(
+                "Error on '%s': S must have minimum of %s" % (commandline, 0.))
+        self.fan.set_speed_from_command(value / 255.)
     def cmd_M107(self, gcmd):
         # Turn fan off
         self.fan.set_speed_from_command(0.)
@@ -21,26 +21,38 @@ class ArcSupport:
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("G2", self.cmd_G2)
         self.gcode.register_command("G3", self.cmd_G2)
+        self.gcode.register_fast_handler(
+            "G2", (lambda params, cmdline: self._process_arc(params, True)),
+            "XYZIJEF")
+        self.gcode.register_fast_handler(
+            "G3", (lambda params, cmdline: self._process_arc(params, False)),
+            "XYZIJEF")
 
     def cmd_G2(self, gcmd):
+        # Parse parameters
+        params = {p: gcmd.get_float(p) for p in 'XYZRIJEF'
+                  if gcmd.get(p, None) is not None}
+        self._process_arc(params, gcmd.get_command() == 'G2')
+
+    def _process_arc(self, params, clockwise):
+        # Handle a G2/G3 move with already parsed (float) parameters
+        error = self.printer.command_error
         gcodestatus = self.gcode_move.get_status()
         if not gcodestatus['absolute_coordinates']:
-            raise gcmd.error("G2/G3 does not support relative move mode")
+            raise error("G2/G3 does not support relative move mode")
         currentPos = gcodestatus['gcode_position']
 
-        # Parse parameters
-        asX = gcmd.get_float("X", currentPos[0])
-        asY = gcmd.get_float("Y", currentPos[1])
-        asZ = gcmd.get_float("Z", currentPos[2])
-        if gcmd.get_float("R", None) is not None:
-            raise gcmd.error("G2/G3 does not support R moves")
-        asI = gcmd.get_float("I", 0.)
-        asJ = gcmd.get_float("J", 0.)
+        asX = params.get("X", currentPos[0])
+        asY = params.get("Y", currentPos[1])
+        asZ = params.get("Z", currentPos[2])
+        if "R" in params:
+            raise error("G2/G3 does not support R moves")
+        asI = params.get("I", 0.)
+        asJ = params.get("J", 0.)
         if not asI and not asJ:
-            raise gcmd.error("G2/G3 neither I nor J given")
-        asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
-        clockwise = (gcmd.get_command() == 'G2')
+            raise error("G2/G3 neither I nor J given")
+        asE = params.get("E")
+        asF = params.get("F")
 
         # Build list of linear coordinates to move to
         coords = self.planArc(currentPos, [asX, asY, asZ], [asI, asJ],
@@ -111,6 +111,11 @@ def load_config(config):
 # GCode macro
 ######################################################################
 
+def _is_immutable(value):
+    if isinstance(value, tuple):
+        return all([_is_immutable(v) for v in value])
+    return not isinstance(value, (list, dict, set))
+
 class GCodeMacro:
     def __init__(self, config):
         name = config.get_name().split()[1]
@@ -139,6 +144,7 @@ class GCodeMacro:
         self.kwparams = { o[len(prefix):].upper(): config.get(o)
                           for o in config.get_prefix_options(prefix) }
         self.variables = {}
+        self.variables_version = 0
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
             try:
@@ -148,6 +154,7 @@ class GCodeMacro:
                 raise config.error(
                     "Option '%s' in section '%s' is not a valid literal" % (
                         option, config.get_name()))
+        self._check_variables()
     def handle_connect(self):
         prev_cmd = self.gcode.register_command(self.alias, None)
         if prev_cmd is None:
@@ -160,6 +167,16 @@ class GCodeMacro:
         return dict(self.variables)
     def get_status(self, eventtime):
         return dict(self.variables)
+    def _check_variables(self):
+        # Lists, dicts, and sets may be modified in place (eg, from a
+        # macro template) without SET_GCODE_VARIABLE, so only report a
+        # status version while all the variables are immutable
+        self.variables_immutable = all([
+            _is_immutable(v) for v in self.variables.values()])
+    def get_status_version(self):
+        if not self.variables_immutable:
+            return None
+        return self.variables_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, gcmd):
         variable = gcmd.get('VARIABLE')
@@ -174,6 +191,8 @@ class GCodeMacro:
         except ValueError as e:
             raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
         self.variables[variable] = literal
+        self.variables_version += 1
+        self._check_variables()
     cmd_desc = "G-Code macro"
     def cmd(self, gcmd):
         if self.in_script:
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
-import homing
+import homing, chelper
 
 class GCodeMove:
     def __init__(self, config):
@@ -32,6 +32,8 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_fast_handler('G0', self._process_move)
+        gcode.register_fast_handler('G1', self._process_move)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True)
         # G-Code coordinate manipulation
@@ -46,12 +48,17 @@ class GCodeMove:
         self.saved_states = {}
         self.move_transform = self.move_with_transform = None
         self.position_with_transform = (lambda: [0., 0., 0., 0.])
+        self.transforms = []
+        self.fused_transform = None
     def _handle_ready(self):
         self.is_printer_ready = True
+        toolhead = self.printer.lookup_object('toolhead')
+        self.fused_transform = FusedMoveTransform(toolhead)
         if self.move_transform is None:
-            toolhead = self.printer.lookup_object('toolhead')
             self.move_with_transform = toolhead.move
             self.position_with_transform = toolhead.get_position
+        else:
+            self._update_fused_transform()
     def _handle_shutdown(self):
         if not self.is_printer_ready:
             return
@@ -74,10 +81,32 @@ class GCodeMove:
         old_transform = self.move_transform
         if old_transform is None:
             old_transform = self.printer.lookup_object('toolhead', None)
+        if self.fused_transform is not None:
+            self.fused_transform.sync_position()
+        # Track the chain of transforms (from first to last applied)
+        if transform in self.transforms:
+            del self.transforms[:self.transforms.index(transform)]
+        elif transform is self.printer.lookup_object('toolhead', None):
+            del self.transforms[:]
+        else:
+            msg = check_transform_stage(transform)
+            if msg is not None:
+                raise self.printer.config_error(msg)
+            self.transforms.insert(0, transform)
         self.move_transform = transform
         self.move_with_transform = transform.move
         self.position_with_transform = transform.get_position
+        self._update_fused_transform()
         return old_transform
+    def _update_fused_transform(self):
+        if self.fused_transform is None:
+            return
+        is_fused = self.fused_transform.setup(self.transforms)
+        if not self.transforms:
+            return
+        self.move_with_transform = self.move_transform.move
+        if is_fused:
+            self.move_with_transform = self.fused_transform.move
     def _get_gcode_position(self):
         p = [lp - bp for lp, bp in zip(self.last_position, self.base_position)]
         p[3] /= self.extrude_factor
@@ -100,38 +129,45 @@ class GCodeMove:
         }
     def reset_last_position(self):
         if self.is_printer_ready:
+            self.fused_transform.sync_position()
             self.last_position = self.position_with_transform()
+            self._update_fused_transform()
     # G-Code movement commands
     def cmd_G1(self, gcmd):
         # Move
         params = gcmd.get_command_parameters()
         try:
-            for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
+            fparams = { axis: float(params[axis])
+                        for axis in 'XYZEF' if axis in params }
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
+        self._process_move(fparams, gcmd.get_commandline())
+    def _process_move(self, params, commandline):
+        # Handle a G0/G1 move with already parsed (float) parameters
+        for pos, axis in enumerate('XYZ'):
+            if axis in params:
+                v = params[axis]
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    self.last_position[pos] += v
+                else:
+                    # value relative to base coordinate position
+                    self.last_position[pos] = v + self.base_position[pos]
+        if 'E' in params:
+            v = params['E'] * self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        if 'F' in params:
+            gcode_speed = params['F']
+            if gcode_speed <= 0.:
+                raise self.printer.command_error("Invalid speed in '%s'"
+                                                 % (commandline,))
+            self.speed = gcode_speed * self.speed_factor
         self.move_with_transform(self.last_position, self.speed)
     def cmd_G28(self, gcmd):
         # Move to origin
@@ -276,5 +312,144 @@ class GCodeMove:
                           % (mcu_pos, stepper_pos, kin_pos, toolhead_pos,
                              gcode_pos, base_pos, homing_pos))
 
+# Verify the stage description reported by a move transform
+def check_transform_stage(transform):
+    get_stage = getattr(transform, 'get_transform_stage', None)
+    if get_stage is None:
+        return None
+    stage = get_stage()
+    if stage is None:
+        return None
+    if stage[0] == 'affine':
+        matrix = stage[1]
+        if len(matrix) != 3 or [len(row) for row in matrix] != [4, 4, 4]:
+            return "Invalid affine matrix in move transform stage"
+    elif stage[0] == 'mesh':
+        if len(stage) != 5:
+            return "Invalid mesh move transform stage"
+    else:
+        return "Unknown move transform stage '%s'" % (stage[0],)
+    return None
+
+# Apply affine matrix 'm2' after affine matrix 'm1'
+def combine_matrix(m2, m1):
+    return [[sum([m2[r][k] * m1[k][c] for k in range(3)])
+             + (m2[r][3] if c == 3 else 0.)
+             for c in range(4)] for r in range(3)]
+
+# Helper to evaluate a chain of standard move transforms with a single
+# call to C code.  A transform may describe its action by providing a
+# get_transform_stage() method that returns either ('affine', matrix)
+# (three rows of x, y, z, and constant coefficients producing the new
+# x, y, and z coordinates) or ('mesh', z_mesh, fade, split_delta_z,
+# last_position) for a bed mesh that splits moves at the mesh cell
+# boundaries.  A chain containing any other transform (or a mesh that
+# is not the last transform) is not fused - in that case the python
+# move() method of each transform is called as usual.
+class FusedMoveTransform:
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.ffi_main = ffi_main
+        self.transform = ffi_main.gc(ffi_lib.move_transform_alloc(),
+                                     ffi_lib.move_transform_free)
+        self.move_transform_set_matrix = ffi_lib.move_transform_set_matrix
+        self.move_transform_set_mesh = ffi_lib.move_transform_set_mesh
+        self.move_transform_set_mesh_params = (
+            ffi_lib.move_transform_set_mesh_params)
+        self.move_transform_set_position = (
+            ffi_lib.move_transform_set_position)
+        self.move_transform_get_position = (
+            ffi_lib.move_transform_get_position)
+        self.move_transform_move = ffi_lib.move_transform_move
+        self.move_transform_fade_complete = (
+            ffi_lib.move_transform_fade_complete)
+        self.mesh_transform = self.mesh_position = self.cell_table = None
+        self.need_set_position = self.check_fade_complete = False
+        self.out = ffi_main.new("double[]", 4)
+        self.max_out = 1
+    def sync_position(self):
+        # Fused moves only update the last position of the mesh stage
+        # in the C code - store it in the mesh transform
+        if self.mesh_transform is not None and not self.need_set_position:
+            pos = self.ffi_main.new("double[]", 4)
+            self.move_transform_get_position(self.transform, pos)
+            self.mesh_position[:] = [pos[0], pos[1], pos[2], pos[3]]
+    def setup(self, transforms):
+        self.mesh_transform = None
+        # Combine the stages of all transforms
+        matrix = mesh_transform = mesh_stage = None
+        for transform in transforms:
+            get_stage = getattr(transform, 'get_transform_stage', None)
+            if get_stage is None:
+                return False
+            stage = get_stage()
+            if stage is None or mesh_stage is not None:
+                return False
+            if stage[0] == 'affine':
+                if matrix is None:
+                    matrix = stage[1]
+                else:
+                    matrix = combine_matrix(stage[1], matrix)
+            else:
+                mesh_transform = transform
+                mesh_stage = stage
+        ffi_main = self.ffi_main
+        if matrix is None:
+            self.move_transform_set_matrix(self.transform, ffi_main.NULL)
+        else:
+            self.move_transform_set_matrix(self.transform,
+                                           [v for row in matrix for v in row])
+        self.check_fade_complete = (mesh_transform is not None
+                                    and mesh_transform.log_fade_complete)
+        if mesh_stage is None:
+            if self.cell_table is not None:
+                self.move_transform_set_mesh(self.transform, ffi_main.NULL,
+                                             0, 0, 0., 0., 0., 0.)
+                self.cell_table = None
+            self.max_out = 1
+            return True
+        stage_type, z_mesh, fade, split_delta_z, last_position = mesh_stage
+        if z_mesh.cell_table is not self.cell_table:
+            # Load the new (or updated) mesh
+            self.cell_table = z_mesh.cell_table
+            mesh = [z for line in z_mesh.mesh_matrix for z in line]
+            self.move_transform_set_mesh(
+                self.transform, mesh, z_mesh.mesh_x_count,
+                z_mesh.mesh_y_count, z_mesh.mesh_x_min, z_mesh.mesh_y_min,
+                z_mesh.mesh_x_dist, z_mesh.mesh_y_dist)
+            # Up to a crossing and a peak per crossed cell, plus the end
+            self.max_out = 2 * (z_mesh.mesh_x_count + z_mesh.mesh_y_count) + 2
+            self.out = ffi_main.new("double[]", self.max_out * 4)
+        fade_start, fade_end, fade_dist, fade_target = fade
+        self.move_transform_set_mesh_params(
+            self.transform, z_mesh.mesh_offset, split_delta_z,
+            fade_start, fade_end, fade_dist, fade_target)
+        # The last position is loaded on the next move, as the mesh
+        # transform may still be moved directly (for example, by the
+        # transform that removed itself from the chain)
+        self.mesh_transform = mesh_transform
+        self.mesh_position = last_position
+        self.need_set_position = True
+        return True
+    def move(self, newpos, speed):
+        if self.need_set_position:
+            self.need_set_position = False
+            self.move_transform_set_position(self.transform,
+                                             self.mesh_position)
+        out = self.out
+        count = self.move_transform_move(self.transform, newpos, out,
+                                         self.max_out)
+        if (self.check_fade_complete
+            and self.move_transform_fade_complete(self.transform)):
+            self.check_fade_complete = False
+            self.mesh_transform.note_fade_complete(newpos[2])
+        if count == 1:
+            self.toolhead.move([out[0], out[1], out[2], out[3]], speed)
+            return
+        toolhead_move = self.toolhead.move
+        for i in range(0, count * 4, 4):
+            toolhead_move([out[i], out[i+1], out[i+2], out[i+3]], speed)
+
 def load_config(config):
     return GCodeMove(config)
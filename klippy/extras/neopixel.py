@@ -125,7 +125,7 @@ class PrinterNeoPixel:
                     self.send_data(print_time)
         def lookahead_bgfunc(print_time):
             reactor = self.printer.get_reactor()
-            reactor.register_callback(lambda et: reactor_bgfunc(print_time))
+            reactor.call_soon(lambda et: reactor_bgfunc(print_time))
         toolhead = self.printer.lookup_object('toolhead')
         toolhead.register_lookahead_callback(lookahead_bgfunc)
 
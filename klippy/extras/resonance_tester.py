@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
+import chelper
 from . import shaper_calibrate
 
 def _parse_probe_points(config):
@@ -15,6 +16,102 @@ def _parse_probe_points(config):
         raise config.error("Unable to parse probe_points in %s" % (
             config.get_name()))
 
+# Duration of the vibrations generated at a time
+SWEEP_BATCH_TIME = .250
+
+# Generate the vibrations of a frequency sweep directly into the trapq
+class VibrationSweep:
+    def __init__(self, toolhead, vib_dir, freq_start, freq_end,
+                 accel_per_hz, hz_per_sec):
+        self.vib_dir = vib_dir
+        self.freq_end = freq_end
+        self.accel_per_hz = accel_per_hz
+        self.hz_per_sec = hz_per_sec
+        self.max_velocity, self.max_accel = toolhead.get_max_velocity()
+        self.center = toolhead.get_position()
+        self.check_move = toolhead.check_trapq_move
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.trapq_append = ffi_lib.trapq_append
+        self.freq = freq_start
+        self.sign = 1.
+        self.center_v = 0.
+        self.next_vibration = None
+    def get_vibration(self, freq):
+        # Return the accel, max velocity, and distance of a half-period
+        t_seg = .25 / freq
+        accel = min(self.accel_per_hz * freq, self.max_accel)
+        return accel, min(accel * t_seg, self.max_velocity), (
+            .5 * accel * t_seg**2)
+    def get_next_freq(self, freq):
+        t_seg = .25 / freq
+        return freq + 2. * t_seg * self.hz_per_sec
+    def is_finished(self):
+        return self.freq > self.freq_end + 0.000001
+    def _check_vibration(self, freq, sign):
+        # Return the accel, max velocity, distance, and edge position of
+        # a half-period (limited by the kinematics)
+        accel, max_v, dist = self.get_vibration(freq)
+        center = self.center
+        edge = (center[0] + sign * self.vib_dir[0] * dist,
+                center[1] + sign * self.vib_dir[1] * dist,
+                center[2], center[3])
+        max_v, accel = self.check_move(center, edge, max_v, accel)
+        max_v, accel = self.check_move(edge, center, max_v, accel)
+        return accel, max_v, dist, edge
+    def _append_move(self, trapq, print_time, start_pos, axes_r, move_d,
+                     start_v, end_v, max_v, accel):
+        # Determine the move trapezoid (as the look-ahead queue would)
+        start_v2 = start_v**2
+        end_v2 = end_v**2
+        cruise_v2 = min(max_v**2, .5 * (start_v2 + end_v2) + accel * move_d)
+        start_v2 = min(start_v2, cruise_v2)
+        end_v2 = min(end_v2, cruise_v2)
+        half_inv_accel = .5 / accel
+        accel_d = (cruise_v2 - start_v2) * half_inv_accel
+        decel_d = (cruise_v2 - end_v2) * half_inv_accel
+        cruise_d = max(0., move_d - accel_d - decel_d)
+        start_v = math.sqrt(start_v2)
+        cruise_v = math.sqrt(cruise_v2)
+        end_v = math.sqrt(end_v2)
+        accel_t = accel_d / ((start_v + cruise_v) * 0.5)
+        cruise_t = cruise_d / cruise_v
+        decel_t = decel_d / ((end_v + cruise_v) * 0.5)
+        self.trapq_append(trapq, print_time, accel_t, cruise_t, decel_t,
+                          start_pos[0], start_pos[1], start_pos[2],
+                          axes_r[0], axes_r[1], 0., start_v, cruise_v, accel)
+        return print_time + accel_t + cruise_t + decel_t
+    def generate_moves(self, trapq, print_time):
+        # Queue a batch of half-periods (each a move away from the
+        # center position and a move back to it)
+        end_time = print_time + SWEEP_BATCH_TIME
+        center = self.center
+        while print_time < end_time and not self.is_finished():
+            vibration = self.next_vibration
+            if vibration is None:
+                vibration = self._check_vibration(self.freq, self.sign)
+            accel, max_v, dist, edge = vibration
+            # The limits of the next half-period are needed for the
+            # velocity at the center position
+            next_freq = self.get_next_freq(self.freq)
+            self.next_vibration = None
+            end_v = 0.
+            if next_freq <= self.freq_end + 0.000001:
+                self.next_vibration = self._check_vibration(next_freq,
+                                                            -self.sign)
+                end_v = min(max_v, self.next_vibration[1])
+            dx = self.sign * self.vib_dir[0]
+            dy = self.sign * self.vib_dir[1]
+            print_time = self._append_move(
+                trapq, print_time, center, (dx, dy), dist,
+                self.center_v, 0., max_v, accel)
+            print_time = self._append_move(
+                trapq, print_time, edge, (-dx, -dy), dist,
+                0., end_v, max_v, accel)
+            self.sign = -self.sign
+            self.freq = next_freq
+            self.center_v = end_v
+        return print_time
+
 class VibrationPulseTest:
     def __init__(self, config):
         printer = config.get_printer()
@@ -48,31 +145,63 @@ class VibrationPulseTest:
         if axis not in self.get_supported_axes():
             raise gcmd.error("Test axis '%s' is not supported", axis)
         vib_dir = (1, 0) if axis == 'x' else (0., 1.)
-        sign = 1.
-        freq = self.freq_start
+        sweep = VibrationSweep(toolhead, vib_dir, self.freq_start,
+                               self.freq_end, self.accel_per_hz,
+                               self.hz_per_sec)
+        # The largest vibrations are at the start of the sweep
+        L = sweep.get_vibration(self.freq_start)[2]
+        for sign in [1., -1.]:
+            toolhead.check_move([X + sign * vib_dir[0] * L,
+                                 Y + sign * vib_dir[1] * L, Z, E])
+        freq = sweep.freq
         gcmd.respond_info("Testing frequency %.0f Hz" % (freq,))
-        _, max_accel = toolhead.get_max_velocity()
-        while freq <= self.freq_end + 0.000001:
-            t_seg = .25 / freq
-            accel = min(self.accel_per_hz * freq, max_accel)
-            V = accel * t_seg
-            toolhead.cmd_M204(self.gcode.create_gcode_command(
-                "M204", "M204", {"S": accel}))
-            L = .5 * accel * t_seg**2
-            nX = X + sign * vib_dir[0] * L
-            nY = Y + sign * vib_dir[1] * L
-            toolhead.move([nX, nY, Z, E], V)
-            toolhead.move([X, Y, Z, E], V)
-            sign = -sign
-            old_freq = freq
-            freq += 2. * t_seg * self.hz_per_sec
-            if math.floor(freq) > math.floor(old_freq):
-                gcmd.respond_info("Testing frequency %.0f Hz" % (freq,))
+        while not sweep.is_finished():
+            toolhead.queue_trapq_moves(sweep.generate_moves)
+            if math.floor(sweep.freq) > math.floor(freq):
+                freq = sweep.freq
+                if not sweep.is_finished():
+                    gcmd.respond_info("Testing frequency %.0f Hz" % (freq,))
+
+# Calculate the frequency response while the accelerometer measures.
+# The samples are processed in the accelerometer's background thread (so
+# that the calculations do not delay the reactor) and, unless they are
+# needed for the raw data output, discarded once processed.
+class FreqResponseStream:
+    def __init__(self, helper, chip, keep_samples):
+        self.chip = chip
+        self.keep_samples = keep_samples
+        self.reader = chip.get_sample_reader(helper.numpy)
+        self.estimator = shaper_calibrate.FreqResponseEstimator(
+                helper, self.reader.rate)
+        chip.add_data_callback(self._process_samples)
+    def _read_samples(self):
+        accel = self.reader.read_samples()
+        if accel is not None:
+            self.estimator.add_samples(accel)
+    def _process_samples(self):
+        self._read_samples()
+        if not self.keep_samples:
+            self.reader.discard_samples()
+    def stop(self):
+        self.chip.remove_data_callback(self._process_samples)
+    def finish(self, results):
+        # Return the frequency response of the finished measurement (or
+        # None if it should be calculated from the results instead)
+        self.stop()
+        self._read_samples()
+        if not self.estimator.sample_count:
+            return None
+        sampling_freq = self.reader.get_sampling_freq(
+                results, self.estimator.sample_count)
+        # The results are incomplete if processed samples were discarded
+        return self.estimator.get_calibration_data(
+                sampling_freq, check_window=self.keep_samples)
 
 class ResonanceTester:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.move_speed = config.getfloat('move_speed', 50., above=0.)
+        self.stream_psd = config.getboolean('stream_psd', False)
         self.test = VibrationPulseTest(config)
         if not config.get('accel_chip_x', None):
             self.accel_chip_names = [('xy', config.get('accel_chip').strip())]
@@ -121,9 +250,14 @@ class ResonanceTester:
             raise gcmd.error("Invalid NAME parameter")
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = gcmd.get("FORMAT", "csv").lower()
+        if raw_format not in ['csv', 'npz']:
+            raise gcmd.error("Unsupported raw data format '%s', only 'csv'"
+                             " and 'npz' are supported" % (raw_format,))
 
-        # Setup calculation of resonances
-        if csv_output:
+        # Setup calculation of resonances (numpy is also used to write
+        # raw data in npz format)
+        if csv_output or raw_format == 'npz':
             helper = shaper_calibrate.ShaperCalibrate(self.printer)
 
         currentPos = toolhead.get_position()
@@ -144,8 +278,10 @@ class ResonanceTester:
             for chip_axis, chip in self.accel_chips:
                 if axis in chip_axis or chip_axis in axis:
                     chip.start_measurements()
+            streams = self.start_streams(helper if csv_output else None,
+                                         axis, raw_output)
             # Generate moves
-            self.test.run_test(toolhead, axis, gcmd)
+            self.run_test(toolhead, axis, gcmd, streams)
             raw_values = []
             for chip_axis, chip in self.accel_chips:
                 if axis in chip_axis or chip_axis in axis:
@@ -153,8 +289,11 @@ class ResonanceTester:
                     if raw_output:
                         raw_name = self.get_filename(
                                 'raw_data', name_suffix, axis,
-                                point if len(calibration_points) > 1 else None)
-                        results.write_to_file(raw_name)
+                                point if len(calibration_points) > 1 else None,
+                                raw_format)
+                        results.write_to_file(
+                                raw_name,
+                                helper.numpy if raw_format == 'npz' else None)
                         gcmd.respond_info(
                                 "Writing raw accelerometer data to %s file" % (
                                     raw_name,))
@@ -168,7 +307,8 @@ class ResonanceTester:
                     raise gcmd.error(
                             "%s-axis accelerometer measured no data" % (
                                 chip_axis,))
-                new_data = helper.process_accelerometer_data(chip_values)
+                new_data = self.process_accelerometer_data(
+                        helper, streams, chip_axis, chip_values)
                 data = data.join(new_data) if data else new_data
         if csv_output:
             csv_name = self.save_calibration_data('resonances', name_suffix,
@@ -219,8 +359,9 @@ class ResonanceTester:
                 for chip_axis, chip in self.accel_chips:
                     if axis in chip_axis or chip_axis in axis:
                         chip.start_measurements()
+                streams = self.start_streams(helper, axis, False)
                 # Generate moves
-                self.test.run_test(toolhead, axis, gcmd)
+                self.run_test(toolhead, axis, gcmd, streams)
                 raw_values = [(chip_axis, chip.finish_measurements())
                               for chip_axis, chip in self.accel_chips
                               if axis in chip_axis or chip_axis in axis]
@@ -231,7 +372,8 @@ class ResonanceTester:
                         raise gcmd.error(
                                 "%s-axis accelerometer measured no data" % (
                                     chip_axis,))
-                    new_data = helper.process_accelerometer_data(chip_values)
+                    new_data = self.process_accelerometer_data(
+                            helper, streams, chip_axis, chip_values)
                     if calibration_data[axis] is None:
                         calibration_data[axis] = new_data
                     else:
@@ -280,17 +422,43 @@ class ResonanceTester:
                               "%.6f (x), %.6f (y), %.6f (z)" % (
                                   axis, vx, vy, vz))
 
+    def start_streams(self, helper, axis, keep_samples):
+        # Start calculating the frequency response during the test
+        if helper is None or not self.stream_psd:
+            return {}
+        return {chip_axis: FreqResponseStream(helper, chip, keep_samples)
+                for chip_axis, chip in self.accel_chips
+                if axis in chip_axis or chip_axis in axis}
+
+    def run_test(self, toolhead, axis, gcmd, streams):
+        try:
+            self.test.run_test(toolhead, axis, gcmd)
+        finally:
+            # Stop processing the samples during the test (the remaining
+            # samples are processed after the measurement has finished)
+            for stream in streams.values():
+                stream.stop()
+
+    def process_accelerometer_data(self, helper, streams, chip_axis,
+                                   chip_values):
+        if chip_axis in streams:
+            data = streams[chip_axis].finish(chip_values)
+            if data is not None:
+                return data
+        return helper.process_accelerometer_data(chip_values)
+
     def is_valid_name_suffix(self, name_suffix):
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
-    def get_filename(self, base, name_suffix, axis=None, point=None):
+    def get_filename(self, base, name_suffix, axis=None, point=None,
+                     ext='csv'):
         name = base
         if axis:
             name += '_' + axis
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + "." + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data, shapers_vals=None):
@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import importlib, logging, math, multiprocessing
+import importlib, logging, math, multiprocessing, traceback
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
@@ -13,6 +13,12 @@ MAX_SHAPER_FREQ = 150.
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 SHAPER_DAMPING_RATIO = 0.1
 
+# Maximum number of intermediate values to calculate at once while
+# fitting a shaper
+MAX_FIT_VALUES = 1 << 17
+# Maximum number of calculation processes to run in parallel
+MAX_PROCESSES = 4
+
 ######################################################################
 # Input shapers
 ######################################################################
@@ -142,6 +148,59 @@ class CalibrationData:
             psd[self.freq_bins < MIN_FREQ] = 0.
 
 
+# Incrementally calculate the frequency response of accelerometer
+# samples as they are measured (the same as calc_freq_response(), but
+# without storing the samples)
+class FreqResponseEstimator:
+    def __init__(self, helper, rate):
+        self.helper = helper
+        self.numpy = np = helper.numpy
+        # The window size is selected from the nominal sampling rate
+        self.nfft = nfft = helper.get_window_size(rate)
+        self.overlap = nfft // 2
+        self.window = np.kaiser(nfft, 6.)
+        self.pending = np.zeros((3, 0))
+        self.psd_sums = np.zeros((3, nfft // 2 + 1))
+        self.window_count = self.sample_count = 0
+    def add_samples(self, accel):
+        # Add an array of x, y, z acceleration samples
+        np = self.numpy
+        nfft, overlap = self.nfft, self.overlap
+        self.sample_count += accel.shape[0]
+        data = np.concatenate((self.pending, accel.T), axis=1)
+        if data.shape[1] < nfft:
+            self.pending = data
+            return
+        # Calculate the response of all complete windows
+        for psd_sum, x in zip(self.psd_sums, data):
+            x = self.helper._split_into_windows(x, nfft, overlap)
+            x = self.window[:, None] * (x - np.mean(x, axis=0))
+            result = np.fft.rfft(x, n=nfft, axis=0)
+            psd_sum += (np.conjugate(result) * result).real.sum(axis=-1)
+        n_windows = (data.shape[1] - overlap) // (nfft - overlap)
+        self.window_count += n_windows
+        self.pending = data[:, n_windows * (nfft - overlap):].copy()
+    def get_calibration_data(self, sampling_freq, check_window=True):
+        # Return None if there are too few samples (or, if check_window
+        # is set, if the measured sampling frequency selects a different
+        # window size than the nominal one)
+        np = self.numpy
+        nfft = self.nfft
+        if self.sample_count <= nfft or (
+                check_window
+                and nfft != self.helper.get_window_size(sampling_freq)):
+            return None
+        # Scale the same way as ShaperCalibrate._psd()
+        scale = 1.0 / (self.window**2).sum()
+        psd = self.psd_sums * (scale / sampling_freq / self.window_count)
+        psd[:, 1:-1] *= 2.
+        freqs = np.fft.rfftfreq(nfft, 1. / sampling_freq)
+        px, py, pz = psd
+        calibration_data = CalibrationData(freqs, px+py+pz, px, py, pz)
+        calibration_data.set_numpy(np)
+        return calibration_data
+
+
 class ShaperCalibrate:
     def __init__(self, printer):
         self.printer = printer
@@ -154,13 +213,12 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
-    def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
-        import queuelogger
+    def _start_background_process(self, method, args):
         parent_conn, child_conn = multiprocessing.Pipe()
         def wrapper():
-            queuelogger.clear_bg_logging()
+            if self.printer is not None:
+                import queuelogger
+                queuelogger.clear_bg_logging()
             try:
                 res = method(*args)
             except:
@@ -173,22 +231,69 @@ class ShaperCalibrate:
         calc_proc = multiprocessing.Process(target=wrapper)
         calc_proc.daemon = True
         calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
+        child_conn.close()
+        return calc_proc, parent_conn
+
+    def _finish_background_process(self, calc_proc, parent_conn):
+        try:
+            is_err, res = parent_conn.recv()
+        except EOFError:
+            is_err, res = True, "calculation process exited unexpectedly"
+        calc_proc.join()
+        parent_conn.close()
+        if is_err:
+            raise self.error("Error in remote calculation: %s" % (res,))
+        return res
+
+    def background_process_exec(self, method, args):
+        if self.printer is None:
+            return method(*args)
+        return self._run_background_processes(method, [args], 1)[0]
+
+    def background_process_map(self, method, args_list):
+        # Run the calculations in parallel processes (up to one per
+        # cpu, as each needs its own memory) and return their results
+        # in order
+        max_procs = min(multiprocessing.cpu_count(), MAX_PROCESSES)
+        if max_procs <= 1:
+            # No parallelism - run all the calculations in turn (in a
+            # single background process when running in the printer)
+            return self.background_process_exec(
+                lambda: [method(*args) for args in args_list], ())
+        return self._run_background_processes(method, args_list, max_procs)
+
+    def _run_background_processes(self, method, args_list, max_procs):
+        results = [None] * len(args_list)
+        running = []
+        next_idx = 0
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+        while running or next_idx < len(args_list):
+            while next_idx < len(args_list) and len(running) < max_procs:
+                running.append((next_idx, self._start_background_process(
+                    method, args_list[next_idx])))
+                next_idx += 1
+            if self.printer is None:
+                # Not running in the printer - just wait for a result
+                idx, (calc_proc, parent_conn) = running.pop(0)
+                results[idx] = self._finish_background_process(
+                    calc_proc, parent_conn)
+                continue
+            for item in list(running):
+                idx, (calc_proc, parent_conn) = item
+                if parent_conn.poll() or not calc_proc.is_alive():
+                    running.remove(item)
+                    results[idx] = self._finish_background_process(
+                        calc_proc, parent_conn)
+            if not running and next_idx >= len(args_list):
+                break
             if eventtime > last_report_time + 5.:
                 last_report_time = eventtime
                 gcode.respond_info("Wait for calculations..", log=False)
             eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        return results
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -237,13 +342,12 @@ class ShaperCalibrate:
         if isinstance(raw_values, np.ndarray):
             data = raw_values
         else:
-            data = np.array(raw_values.decode_samples())
+            data = raw_values.decode_samples_array(np)
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
         SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        M = self.get_window_size(SAMPLING_FREQ)
         if N <= M:
             return None
 
@@ -254,6 +358,10 @@ class ShaperCalibrate:
         fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
+    def get_window_size(self, sampling_freq):
+        # Round up to the nearest power of 2 for faster FFT
+        return 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+
     def process_accelerometer_data(self, data):
         calibration_data = self.background_process_exec(
                 self.calc_freq_response, (data,))
@@ -263,25 +371,25 @@ class ShaperCalibrate:
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+    def _estimate_shapers(self, A, T, freq_bins):
+        # Calculate the remaining vibrations at each frequency bin of
+        # the shapers given by the rows of A and T for each of the
+        # TEST_DAMPING_RATIOS (as an array of damping, shaper, bin)
         np = self.numpy
 
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
-
-        omega = 2. * math.pi * test_freqs
-        damping = test_damping_ratio * omega
-        omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+        inv_D = 1. / A.sum(axis=-1)
 
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
-                                       freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
-        remaining_vibrations = (vals * psd).sum() / psd.sum()
-        return (remaining_vibrations, vals)
+        omega = 2. * math.pi * freq_bins
+        damping = np.array([dr * omega for dr in TEST_DAMPING_RATIOS])
+        omega_d = np.array([omega * math.sqrt(1. - dr**2)
+                            for dr in TEST_DAMPING_RATIOS])
+        W = A[:, None, :] * np.exp(-damping[:, None, :, None]
+                                   * (T[:, -1:] - T)[:, None, :])
+        omega_d_T = omega_d[:, None, :, None] * T[:, None, :]
+        S = W * np.sin(omega_d_T)
+        C = W * np.cos(omega_d_T)
+        return (np.sqrt(S.sum(axis=-1)**2 + C.sum(axis=-1)**2)
+                * inv_D[:, None])
 
     def fit_shaper(self, shaper_cfg, calibration_data):
         np = self.numpy
@@ -291,39 +399,46 @@ class ShaperCalibrate:
         freq_bins = calibration_data.freq_bins
         psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
         freq_bins = freq_bins[freq_bins <= MAX_FREQ]
-
-        best_freq = None
-        best_remaining_vibrations = 0
-        best_shaper_vals = []
-
-        for test_freq in test_freqs[::-1]:
-            cur_remaining_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, SHAPER_DAMPING_RATIO)
+        psd_sum = psd.sum()
+
+        shapers = [shaper_cfg.init_func(test_freq, SHAPER_DAMPING_RATIO)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+
+        # Evaluate all test frequencies (in chunks to limit memory usage)
+        all_vibrations = np.zeros(shape=test_freqs.shape)
+        all_shaper_vals = np.zeros(shape=test_freqs.shape + freq_bins.shape)
+        chunk = max(1, MAX_FIT_VALUES // (
+            len(TEST_DAMPING_RATIOS) * freq_bins.shape[0] * A.shape[1]))
+        for i in range(0, test_freqs.shape[0], chunk):
+            vals = self._estimate_shapers(A[i:i+chunk], T[i:i+chunk],
+                                          freq_bins)
+            vibrations = (vals * psd).sum(axis=-1) / psd_sum
             # Exact damping ratio of the printer is unknown, pessimizing
             # remaining vibrations over possible damping values.
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > cur_remaining_vibrations:
-                    cur_remaining_vibrations = vibrations
-            if (best_freq is None or
-                    best_remaining_vibrations > cur_remaining_vibrations):
-                # The current frequency is better for the shaper.
-                best_freq = test_freq
-                best_remaining_vibrations = cur_remaining_vibrations
-                best_shaper_vals = shaper_vals
-        return (best_freq, best_remaining_vibrations, best_shaper_vals)
+            all_vibrations[i:i+chunk] = np.fmax(
+                np.fmax.reduce(vibrations, axis=0), 0.)
+            shaper_vals = all_shaper_vals[i:i+chunk]
+            for dr_vals in vals:
+                shaper_vals[:] = np.maximum(shaper_vals, dr_vals)
+
+        # Select the best (and highest, if several are equally good)
+        # frequency for the shaper
+        best_idx = test_freqs.shape[0] - 1 - np.argmin(all_vibrations[::-1])
+        return (test_freqs[best_idx], all_vibrations[best_idx],
+                all_shaper_vals[best_idx])
 
     def find_best_shaper(self, calibration_data, logger=None):
         best_shaper = prev_shaper = None
         best_freq = prev_freq = 0.
         best_vibrations = prev_vibrations = 0.
         all_shaper_vals = []
-        for shaper in INPUT_SHAPERS:
-            shaper_freq, vibrations, shaper_vals = self.background_process_exec(
-                    self.fit_shaper, (shaper, calibration_data))
+        results = self.background_process_map(
+                self.fit_shaper, [(shaper, calibration_data)
+                                  for shaper in INPUT_SHAPERS])
+        for shaper, res in zip(INPUT_SHAPERS, results):
+            shaper_freq, vibrations, shaper_vals = res
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%)" % (
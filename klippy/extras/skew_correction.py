@@ -66,6 +66,11 @@ class PrinterSkew:
         return [skewed_x, skewed_y, pos[2], pos[3]]
     def get_position(self):
         return self.calc_unskew(self.next_transform.get_position())
+    def get_transform_stage(self):
+        xy, xz, yz = self.xy_factor, self.xz_factor, self.yz_factor
+        return ('affine', [[1., -xy, -(xz - (xy * yz)), 0.],
+                           [0., 1., -yz, 0.],
+                           [0., 0., 1., 0.]])
     def move(self, newpos, speed):
         corrected_pos = self.calc_skew(newpos)
         self.next_transform.move(corrected_pos, speed)
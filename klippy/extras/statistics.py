@@ -28,6 +28,13 @@ class PrinterStats:
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        # Optional reactor profiling
+        self.profiler = None
+        if config.getboolean('reactor_profile', False):
+            self.profiler = reactor.enable_profiling()
+            webhooks = self.printer.lookup_object('webhooks')
+            webhooks.register_endpoint("reactor/profile",
+                                       self._handle_profile_request)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
@@ -36,11 +43,15 @@ class PrinterStats:
             reactor.update_timer(self.stats_timer, reactor.NOW)
     def generate_stats(self, eventtime):
         stats = [cb(eventtime) for cb in self.stats_cb]
+        if self.profiler is not None:
+            stats.append((False, self.profiler.get_interval_stats()))
         if max([s[0] for s in stats]):
             stats.append(get_os_stats(eventtime))
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
         return eventtime + 1.
+    def _handle_profile_request(self, web_request):
+        web_request.send(self.profiler.get_status())
 
 def load_config(config):
     return PrinterStats(config)
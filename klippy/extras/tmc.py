@@ -151,7 +151,7 @@ class TMCCommandHelper:
         self.mcu_tmc.set_register(reg_name, val, print_time)
     def handle_stepper_enable(self, print_time, is_enable):
         cb = (lambda ev: self._do_enable(print_time, is_enable))
-        self.printer.get_reactor().register_callback(cb)
+        self.printer.get_reactor().call_soon(cb)
     # DUMP_TMC support
     def setup_register_dump(self, read_registers, read_translate=None):
         self.read_registers = read_registers
@@ -170,12 +170,12 @@ class TMC2660CurrentHelper:
 
     def handle_printing(self, print_time):
         print_time -= 0.100 # Schedule slightly before deadline
-        self.printer.get_reactor().register_callback(
+        self.printer.get_reactor().call_soon(
             (lambda ev: self.set_current(print_time, self.current)))
 
     def handle_ready(self, print_time):
         current = self.current * float(self.idle_current_percentage) / 100.
-        self.printer.get_reactor().register_callback(
+        self.printer.get_reactor().call_soon(
             (lambda ev: self.set_current(print_time, current)))
 
     def set_current(self, print_time, current):
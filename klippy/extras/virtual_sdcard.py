@@ -3,10 +3,272 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, struct, threading, collections
+import gcode
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+
+######################################################################
+# Compiled (pre-parsed) g-code files
+######################################################################
+
+# A compiled file contains a header followed by one record for each
+# g-code line.  Each record contains an opcode, a parameter mask, the
+# position of the line in the source file, the line itself, and (for
+# moves) the float value of each parameter in the mask.  Blank and
+# comment only lines are not stored.  The last record is an end record
+# (so that a truncated file can be detected).
+COMPILED_EXT = ".kgc"
+COMPILED_MAGIC = "KLGCODE2"
+COMPILED_HEADER = struct.Struct("<8sQd")
+RECORD_HEADER = struct.Struct("<BBQI")
+OP_LINE, OP_G0, OP_G1, OP_END = 0, 1, 2, 3
+OP_COMMANDS = {'G0': OP_G0, 'G1': OP_G1}
+OP_NAMES = {OP_G0: 'G0', OP_G1: 'G1'}
+MOVE_PARAMS = "XYZEF"
+MOVE_LETTERS = [[p for i, p in enumerate(MOVE_PARAMS) if mask & (1 << i)]
+                for mask in range(1 << len(MOVE_PARAMS))]
+MOVE_STRUCTS = [struct.Struct("<" + "d" * len(letters))
+                for letters in MOVE_LETTERS]
+COMPILED_READ_SIZE = 65536
+
+def get_compiled_filename(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, "." + basename + COMPILED_EXT)
+
+# Convert a g-code file to a compiled file.  The optional pause_cb is
+# invoked periodically and may return True to abort the conversion.
+def compile_gcode_file(filename, pause_cb=None):
+    compiled_fname = get_compiled_filename(filename)
+    temp_fname = compiled_fname + ".tmp"
+    st = os.stat(filename)
+    sf = open(filename, 'rb')
+    try:
+        df = open(temp_fname, 'wb')
+        try:
+            df.write(COMPILED_HEADER.pack(COMPILED_MAGIC, st.st_size,
+                                          st.st_mtime))
+            is_complete = _compile_lines(sf, df, pause_cb)
+        finally:
+            df.close()
+        if not is_complete:
+            os.unlink(temp_fname)
+            return None
+        os.rename(temp_fname, compiled_fname)
+    except:
+        if os.path.exists(temp_fname):
+            os.unlink(temp_fname)
+        raise
+    finally:
+        sf.close()
+    return compiled_fname
+
+def _compile_lines(sf, df, pause_cb):
+    fast_r = gcode.GCodeDispatch.fast_r
+    out = []
+    position = line_count = 0
+    for line in sf:
+        if not line.endswith('\n'):
+            # Final line without a newline is never run
+            break
+        line_position = position
+        position += len(line)
+        line = line[:-1]
+        sline = line.strip()
+        if not sline or sline.startswith(';'):
+            continue
+        opcode = mask = 0
+        m = fast_r.match(sline.upper())
+        if m is not None and m.group(1) in OP_COMMANDS:
+            params = { p[0]: float(p[1:]) for p in m.group(2).split() }
+            if all([p in MOVE_PARAMS for p in params]):
+                opcode = OP_COMMANDS[m.group(1)]
+                for i, p in enumerate(MOVE_PARAMS):
+                    if p in params:
+                        mask |= 1 << i
+        out.append(RECORD_HEADER.pack(opcode, mask, line_position,
+                                      len(line)))
+        out.append(line)
+        if opcode:
+            out.append(MOVE_STRUCTS[mask].pack(
+                *[params[p] for p in MOVE_LETTERS[mask]]))
+        if len(out) >= 30000:
+            df.write("".join(out))
+            del out[:]
+        line_count += 1
+        if pause_cb is not None and not line_count % 1000:
+            if pause_cb():
+                return False
+    out.append(RECORD_HEADER.pack(OP_END, 0, position, 0))
+    df.write("".join(out))
+    return True
+
+# Open a compiled file (if it is up to date with the source file)
+def open_compiled_file(filename):
+    compiled_fname = get_compiled_filename(filename)
+    if not os.path.exists(compiled_fname):
+        return None
+    st = os.stat(filename)
+    f = open(compiled_fname, 'rb')
+    header = f.read(COMPILED_HEADER.size)
+    if (len(header) != COMPILED_HEADER.size
+        or COMPILED_HEADER.unpack(header) != (COMPILED_MAGIC, st.st_size,
+                                              st.st_mtime)):
+        f.close()
+        return None
+    return CompiledReader(f)
+
+class CompiledFileError(Exception):
+    pass
+
+class CompiledReader:
+    def __init__(self, f):
+        self.f = f
+        self.data = ""
+        self.data_pos = 0
+        self.src_position = 0
+    def close(self):
+        self.f.close()
+    def rewind(self):
+        self.f.seek(COMPILED_HEADER.size)
+        self.data = ""
+        self.data_pos = self.src_position = 0
+    def _fill(self, count):
+        if len(self.data) - self.data_pos >= count:
+            return True
+        self.data = self.data[self.data_pos:] + self.f.read(
+            max(count, COMPILED_READ_SIZE))
+        self.data_pos = 0
+        return len(self.data) >= count
+    def read_record(self):
+        # Returns (opcode, line, params) or None at end of file
+        if not self._fill(RECORD_HEADER.size):
+            raise CompiledFileError("Compiled file is truncated")
+        opcode, mask, line_position, line_len = RECORD_HEADER.unpack_from(
+            self.data, self.data_pos)
+        if opcode == OP_END:
+            return None
+        params_struct = MOVE_STRUCTS[mask]
+        count = RECORD_HEADER.size + line_len + params_struct.size
+        if not self._fill(count):
+            raise CompiledFileError("Compiled file is truncated")
+        data = self.data
+        pos = self.data_pos + RECORD_HEADER.size
+        line = data[pos:pos+line_len]
+        params = None
+        if opcode:
+            params = dict(zip(MOVE_LETTERS[mask], params_struct.unpack_from(
+                data, pos + line_len)))
+        self.data_pos += count
+        self.src_position = line_position + line_len + 1
+        return opcode, line, params
+    def seek_source(self, src_position):
+        # Position the reader so that the next record is the first
+        # line at or after 'src_position'
+        if src_position < self.src_position:
+            self.rewind()
+        while 1:
+            if not self._fill(RECORD_HEADER.size):
+                return False
+            opcode, mask, line_position, line_len = (
+                RECORD_HEADER.unpack_from(self.data, self.data_pos))
+            if src_position <= line_position:
+                return src_position >= self.src_position
+            if opcode == OP_END:
+                return False
+            try:
+                self.read_record()
+            except CompiledFileError:
+                return False
+
+
+######################################################################
+# Background file read-ahead
+######################################################################
+
+READ_AHEAD_CHUNK = 65536
+
+# Read a file in a background thread so that slow storage does not
+# stall the main reactor thread
+class ReadAheadReader:
+    def __init__(self, reactor, filename, position, depth):
+        self.reactor = reactor
+        self.depth = depth
+        self.f = open(filename, 'rb')
+        self.f.seek(position)
+        self.io_wait = 0.
+        # Threading
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.chunks = collections.deque()
+        self.waiter = None
+        self.is_stopped = False
+        self.bg_thread = None
+        if depth:
+            self.bg_thread = threading.Thread(target=self._bg_thread)
+            self.bg_thread.daemon = True
+            self.bg_thread.start()
+    def _bg_thread(self):
+        # The file is owned by this thread once it is started
+        try:
+            self._bg_read_loop()
+        finally:
+            self.f.close()
+    def _bg_read_loop(self):
+        while 1:
+            with self.lock:
+                while len(self.chunks) >= self.depth and not self.is_stopped:
+                    self.cond.wait()
+                if self.is_stopped:
+                    return
+            try:
+                data = self.f.read(READ_AHEAD_CHUNK)
+            except Exception as e:
+                logging.exception("virtual_sdcard read-ahead")
+                data = e
+            with self.lock:
+                if self.is_stopped:
+                    return
+                self.chunks.append(data)
+                waiter, self.waiter = self.waiter, None
+            if waiter is not None:
+                self.reactor.async_complete(waiter, None)
+            if not isinstance(data, str) or not data:
+                return
+    def get_depth(self):
+        return len(self.chunks)
+    def read(self):
+        # Return the next chunk of the file (or "" at end of file)
+        if self.bg_thread is None:
+            start_time = self.reactor.monotonic()
+            data = self.f.read(READ_AHEAD_CHUNK)
+            self.io_wait += self.reactor.monotonic() - start_time
+            return data
+        while 1:
+            with self.lock:
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.cond.notify()
+                    break
+                completion = self.waiter = self.reactor.completion()
+            start_time = self.reactor.monotonic()
+            completion.wait()
+            self.io_wait += self.reactor.monotonic() - start_time
+        if not isinstance(data, str):
+            raise data
+        return data
+    def close(self):
+        if self.bg_thread is None:
+            self.f.close()
+            return
+        # Don't wait for the thread (it may be blocked in a slow read) -
+        # it closes the file when it notices the stop request.
+        with self.lock:
+            self.is_stopped = True
+            self.chunks.clear()
+            self.cond.notify()
+
 class VirtualSD:
     def __init__(self, config):
         printer = config.get_printer()
@@ -16,6 +278,12 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        self.use_compiled = config.getboolean('compiled_print', False)
+        self.compiled_reader = None
+        self.compile_pending = False
+        self.read_ahead = config.getint('read_ahead', 4, minval=0)
+        self.reader = None
+        self.io_wait = 0.
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
@@ -51,7 +319,13 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        reader = self.reader
+        if reader is None:
+            return True, "sd_pos=%d sd_io_wait=%.3f" % (
+                self.file_position, self.io_wait)
+        return True, "sd_pos=%d sd_read_ahead=%d sd_io_wait=%.3f" % (
+            self.file_position, reader.get_depth(),
+            self.io_wait + reader.io_wait)
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
@@ -99,7 +373,11 @@ class VirtualSD:
             self.do_pause()
             self.current_file.close()
             self.current_file = None
+        if self.compiled_reader is not None:
+            self.compiled_reader.close()
+            self.compiled_reader = None
         self.file_position = self.file_size = 0.
+        self.compile_pending = False
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
         "if necessary"
@@ -163,6 +441,30 @@ class VirtualSD:
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        self.compile_pending = self.use_compiled
+    def _compile_pause(self):
+        self.reactor.pause(self.reactor.NOW)
+        return self.must_pause_work
+    def _load_compiled(self):
+        # Compile the file (from the work timer, so that other tasks
+        # continue to run during the conversion)
+        fname = self.current_file.name
+        try:
+            reader = open_compiled_file(fname)
+            if reader is None:
+                self.gcode.respond_info("Compiling file %s" % (
+                    os.path.basename(fname),))
+                if compile_gcode_file(fname, self._compile_pause) is None:
+                    # Print paused - compile again on resume
+                    return
+                reader = open_compiled_file(fname)
+        except:
+            logging.exception("virtual_sdcard compile")
+            self.gcode.respond_info(
+                "Unable to compile file - printing normally")
+            reader = None
+        self.compile_pending = False
+        self.compiled_reader = reader
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         if self.work_timer is not None:
@@ -197,29 +499,66 @@ class VirtualSD:
             self.work_timer = None
             return self.reactor.NEVER
         self.print_stats.note_start()
+        if self.compile_pending:
+            self._load_compiled()
+        use_text = True
+        if (self.compiled_reader is not None
+            and self.compiled_reader.seek_source(self.file_position)):
+            use_text = self._process_compiled()
+        if use_text:
+            self._process_text()
+        logging.info("Exiting SD card print (position %d)", self.file_position)
+        self.work_timer = None
+        self.cmd_from_sd = False
+        if self.current_file is not None:
+            self.print_stats.note_pause()
+        else:
+            self.print_stats.note_complete()
+        return self.reactor.NEVER
+    def _process_text(self):
+        try:
+            self.reader = ReadAheadReader(self.reactor, self.current_file.name,
+                                          self.file_position, self.read_ahead)
+        except:
+            logging.exception("virtual_sdcard read-ahead open")
+            return
+        try:
+            self._process_text_lines(self.reader)
+        finally:
+            self.io_wait += self.reader.io_wait
+            self.reader.close()
+            self.reader = None
+    def _process_text_lines(self, reader):
+        # Line boundaries are found in place in the buffered data; each
+        # line is copied once (when sliced for dispatch) and only the
+        # partial line at the end of a chunk is carried into the next.
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        data = ""
+        line_start = 0
+        next_pause_position = self.file_position + 8192
         while not self.must_pause_work:
-            if not lines:
+            line_end = data.find('\n', line_start)
+            if line_end < 0:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    chunk = reader.read()
                 except:
                     logging.exception("virtual_sdcard read")
-                    break
-                if not data:
+                    return
+                if not chunk:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
-                    break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                    return
+                data = data[line_start:] + chunk
+                line_start = 0
+                continue
+            # Periodically allow other tasks to run
+            if self.file_position >= next_pause_position:
                 self.reactor.pause(self.reactor.NOW)
+                next_pause_position = self.file_position + 8192
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
@@ -228,23 +567,63 @@ class VirtualSD:
             # Dispatch command
             self.cmd_from_sd = True
             try:
-                self.gcode.run_script(lines[-1])
+                self.gcode.run_script(data[line_start:line_end])
             except self.gcode.error as e:
                 self.print_stats.note_error(str(e))
-                break
+                return
             except:
                 logging.exception("virtual_sdcard dispatch")
-                break
+                return
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
-        logging.info("Exiting SD card print (position %d)", self.file_position)
-        self.work_timer = None
-        self.cmd_from_sd = False
-        if self.current_file is not None:
-            self.print_stats.note_pause()
-        else:
-            self.print_stats.note_complete()
-        return self.reactor.NEVER
+            self.file_position += line_end + 1 - line_start
+            line_start = line_end + 1
+    def _process_compiled(self):
+        # Returns True if the print should continue from the g-code file
+        reader = self.compiled_reader
+        gcode_mutex = self.gcode.get_mutex()
+        next_pause_position = self.file_position
+        while not self.must_pause_work:
+            # Periodically allow other tasks to run
+            if self.file_position >= next_pause_position:
+                self.reactor.pause(self.reactor.NOW)
+                next_pause_position = self.file_position + 8192
+                continue
+            # Pause if any other request is pending in the gcode class
+            if gcode_mutex.test():
+                self.reactor.pause(self.reactor.monotonic() + 0.100)
+                continue
+            try:
+                record = reader.read_record()
+            except CompiledFileError as e:
+                logging.warning("virtual_sdcard: %s - printing normally",
+                                str(e))
+                reader.close()
+                self.compiled_reader = None
+                return True
+            if record is None:
+                # End of file (trailing comments are not stored)
+                self.file_position = self.file_size
+                self.current_file.close()
+                self.current_file = None
+                logging.info("Finished SD card print")
+                self.gcode.respond_raw("Done printing file")
+                return False
+            # Dispatch command
+            opcode, line, params = record
+            self.cmd_from_sd = True
+            try:
+                if opcode:
+                    self.gcode.run_fast_command(OP_NAMES[opcode], params, line)
+                else:
+                    self.gcode.run_script(line)
+            except self.gcode.error as e:
+                self.print_stats.note_error(str(e))
+                return
+            except:
+                logging.exception("virtual_sdcard dispatch")
+                return
+            self.cmd_from_sd = False
+            self.file_position = reader.src_position
 
 def load_config(config):
     return VirtualSD(config)
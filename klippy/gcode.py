@@ -82,6 +82,9 @@ class GCodeDispatch:
         self.output_callbacks = []
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
+        self.fast_handlers = {}
+        self.ready_fast_handlers = {}
+        self.fast_handler_params = {}
         self.mux_commands = {}
         self.gcode_help = {}
         # Register commands needed before config file is loaded
@@ -106,6 +109,9 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
+            if cmd in self.ready_fast_handlers:
+                del self.ready_fast_handlers[cmd]
+                self.fast_handler_params.pop(cmd, None)
             return old_cmd
         if cmd in self.ready_gcode_handlers:
             raise self.printer.config_error(
@@ -118,6 +124,23 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_fast_handler(self, cmd, func, params=None):
+        # Register an optimized handler for simple invocations of a
+        # traditional g-code command (eg, "G1 X10 Y20 F3000").  The
+        # handler is invoked as func(params, commandline) with 'params'
+        # being a dictionary of parameter letters to float values.  If
+        # a string of parameter letters is given, then commands with
+        # any other parameter are passed to the regular handler.
+        if cmd not in self.ready_gcode_handlers:
+            raise self.printer.config_error(
+                "gcode command %s must be registered before fast handler"
+                % (cmd,))
+        if not self.is_traditional_gcode(cmd):
+            raise self.printer.config_error(
+                "gcode command %s does not support a fast handler" % (cmd,))
+        self.ready_fast_handlers[cmd] = func
+        if params is not None:
+            self.fast_handler_params[cmd] = params
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -142,39 +165,63 @@ class GCodeDispatch:
             return
         self.is_printer_ready = False
         self.gcode_handlers = self.base_gcode_handlers
+        self.fast_handlers = {}
         self._respond_state("Shutdown")
     def _handle_disconnect(self):
         self._respond_state("Disconnect")
     def _handle_ready(self):
         self.is_printer_ready = True
         self.gcode_handlers = self.ready_gcode_handlers
+        self.fast_handlers = self.ready_fast_handlers
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_r = re.compile(r'(?:N[0-9]+\s+)?([GM][0-9]+)'
+                        r'((?:\s+[A-Z][-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))*)'
+                        r'\s*(?:;|$)')
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            uline = line.upper()
+            # Check for simple commands that have an optimized handler
+            fast_handler = gcmd = None
+            m = self.fast_r.match(uline)
+            if m is not None:
+                cmd = m.group(1)
+                fast_handler = self.fast_handlers.get(cmd)
+            if fast_handler is not None:
+                fparams = { p[0]: float(p[1:]) for p in m.group(2).split() }
+                valid_params = self.fast_handler_params.get(cmd)
+                if valid_params is not None:
+                    for p in fparams:
+                        if p not in valid_params:
+                            fast_handler = None
+                            break
+            if fast_handler is None:
+                cpos = uline.find(';')
+                if cpos >= 0:
+                    uline = uline[:cpos]
+                # Break line into parts and determine command
+                parts = self.args_r.split(uline)
+                numparts = len(parts)
+                cmd = ""
+                if numparts >= 3 and parts[1] != 'N':
+                    cmd = parts[1] + parts[2].strip()
+                elif numparts >= 5 and parts[1] == 'N':
+                    # Skip line number at start of command
+                    cmd = parts[3] + parts[4].strip()
+                # Build gcode "params" dictionary
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(1, numparts, 2) }
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
-                handler(gcmd)
+                if fast_handler is not None:
+                    fast_handler(fparams, origline)
+                else:
+                    handler(gcmd)
             except self.error as e:
                 self._respond_error(str(e))
                 self.printer.send_event("gcode:command_error")
@@ -187,12 +234,36 @@ class GCodeDispatch:
                 self._respond_error(msg)
                 if not need_ack:
                     raise
-            gcmd.ack()
+            if gcmd is not None:
+                gcmd.ack()
+            elif need_ack:
+                self.respond_raw("ok")
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_fast_command(self, cmd, params, commandline):
+        # Run a command with already parsed (float) parameters
+        with self.mutex:
+            handler = self.fast_handlers.get(cmd)
+            valid_params = self.fast_handler_params.get(cmd)
+            if handler is None or (valid_params is not None and [
+                    p for p in params if p not in valid_params]):
+                self._process_commands([commandline], need_ack=False)
+                return
+            try:
+                handler(params, commandline)
+            except self.error as e:
+                self._respond_error(str(e))
+                self.printer.send_event("gcode:command_error")
+                raise
+            except:
+                msg = 'Internal error on command:"%s"' % (cmd,)
+                logging.exception(msg)
+                self.printer.invoke_shutdown(msg)
+                self._respond_error(msg)
+                raise
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
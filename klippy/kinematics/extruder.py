@@ -62,6 +62,7 @@ class PrinterExtruder:
         if self.name == 'extruder':
             toolhead.set_extruder(self, 0.)
             gcode.register_command("M104", self.cmd_M104)
+            gcode.register_fast_handler("M104", self._fast_M104, "S")
             gcode.register_command("M109", self.cmd_M109)
             gcode.register_mux_command("SET_PRESSURE_ADVANCE", "EXTRUDER", None,
                                        self.cmd_default_SET_PRESSURE_ADVANCE,
@@ -169,6 +170,10 @@ class PrinterExtruder:
         heater.set_temp(temp)
         if wait and temp:
             self.printer.lookup_object('heaters').wait_for_temperature(heater)
+    def _fast_M104(self, params, commandline):
+        # Set Extruder Temperature (of the active extruder)
+        extruder = self.printer.lookup_object('toolhead').get_extruder()
+        extruder.get_heater().set_temp(params.get('S', 0.))
     def cmd_M109(self, gcmd):
         # Set Extruder Temperature and Wait
         self.cmd_M104(gcmd, wait=True)
@@ -52,7 +52,7 @@ class Printer:
         self.bglogger = bglogger
         self.start_args = start_args
         self.reactor = main_reactor
-        self.reactor.register_callback(self._connect)
+        self.reactor.call_soon(self._connect)
         self.state_message = message_startup
         self.in_shutdown_state = False
         self.run_result = None
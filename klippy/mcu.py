@@ -530,14 +530,11 @@ class MCU:
         if prev_crc is None:
             logging.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            self._serial.send_batch(self._config_cmds)
         else:
-            for c in self._restart_cmds:
-                self._serial.send(c)
+            self._serial.send_batch(self._restart_cmds)
         # Transmit init messages
-        for c in self._init_cmds:
-            self._serial.send(c)
+        self._serial.send_batch(self._init_cmds)
     def _send_get_config(self):
         get_config_cmd = self.lookup_query_command(
             "get_config",
@@ -659,12 +656,16 @@ class MCU:
         return self._printer
     def get_name(self):
         return self._name
-    def register_response(self, cb, msg, oid=None):
-        self._serial.register_response(cb, msg, oid)
+    def register_response(self, cb, msg, oid=None, queued=False):
+        self._serial.register_response(cb, msg, oid, queued)
+    def flush_queued_responses(self):
+        self._serial.flush_queued_responses()
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
     def lookup_command(self, msgformat, cq=None):
         return CommandWrapper(self._serial, msgformat, cq)
+    def command_batch(self):
+        return serialhdl.CommandBatch(self._serial)
     def lookup_query_command(self, msgformat, respformat, oid=None,
                              cq=None, is_async=False):
         return CommandQueryWrapper(self._serial, msgformat, respformat, oid,
@@ -41,6 +41,7 @@ class PT_uint32:
     is_dynamic_string = False
     max_length = 5
     signed = False
+    decode_type = 'u'
     def encode(self, out, v):
         if v >= 0xc000000 or v < -0x4000000: out.append((v>>28) & 0x7f | 0x80)
         if v >= 0x180000 or v < -0x80000:    out.append((v>>21) & 0x7f | 0x80)
@@ -63,6 +64,7 @@ class PT_uint32:
 
 class PT_int32(PT_uint32):
     signed = True
+    decode_type = 'i'
 class PT_uint16(PT_uint32):
     max_length = 3
 class PT_int16(PT_int32):
@@ -75,6 +77,7 @@ class PT_string:
     is_int = False
     is_dynamic_string = True
     max_length = 64
+    decode_type = 's'
     def encode(self, out, v):
         out.append(len(v))
         out.extend(bytearray(v))
@@ -99,6 +102,7 @@ class Enumeration:
     def __init__(self, pt, enum_name, enums):
         self.pt = pt
         self.max_length = pt.max_length
+        self.decode_type = pt.decode_type
         self.enum_name = enum_name
         self.enums = enums
         self.reverse_enums = {v: k for k, v in enums.items()}
@@ -110,10 +114,12 @@ class Enumeration:
         self.pt.encode(out, tv)
     def parse(self, s, pos):
         v, pos = self.pt.parse(s, pos)
+        return self.lookup_value(v), pos
+    def lookup_value(self, v):
         tv = self.reverse_enums.get(v)
         if tv is None:
             tv = "?%d" % (v,)
-        return tv, pos
+        return tv
 
 # Lookup the message types for a format string
 def lookup_params(msgformat, enumerations={}):
@@ -143,6 +149,10 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.decode_types = ''.join([t.decode_type for t in self.param_types])
+        self.int_names = None
+        if all([t.is_int for t in self.param_types]):
+            self.int_names = [name for name, t in self.param_names]
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -162,6 +172,22 @@ class MessageFormat:
             v, pos = t.parse(s, pos)
             out[name] = v
         return out, pos
+    def parse_decoded(self, s, values):
+        # Build params from values obtained from the C decoder
+        if self.int_names is not None:
+            return dict(zip(self.int_names, values))
+        out = {}
+        pos = 0
+        for name, t in self.param_names:
+            v = values[pos]
+            pos += 1
+            if t.is_dynamic_string:
+                v = bytes(bytearray(s[v:v+values[pos]]))
+                pos += 1
+            elif not t.is_int:
+                v = t.lookup_value(v)
+            out[name] = v
+        return out
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -275,6 +301,17 @@ class MessageParser:
             raise error("Extra data at end of message")
         params['#name'] = mid.name
         return params
+    def parse_decoded(self, s, values):
+        # Build params for a message decoded using get_decode_formats()
+        mid = self.messages_by_id[s[MESSAGE_HEADER_SIZE]]
+        params = mid.parse_decoded(s, values)
+        params['#name'] = mid.name
+        return params
+    def get_decode_formats(self):
+        # Return the (msgid, param types) of messages supporting C decoding
+        return [(msgid, mid.decode_types)
+                for msgid, mid in self.messages_by_id.items()
+                if isinstance(mid, MessageFormat)]
     def encode(self, seq, cmd):
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
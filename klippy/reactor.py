@@ -3,7 +3,8 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, Queue as queue
+import os, gc, select, math, time, logging, heapq, errno, collections
+import Queue as queue
 import greenlet
 import chelper, util
 
@@ -14,6 +15,7 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.timer_id = 0
 
 class ReactorCompletion:
     class sentinel: pass
@@ -50,9 +52,10 @@ class ReactorCallback:
         return self.reactor.NEVER
 
 class ReactorFileHandler:
-    def __init__(self, fd, callback):
+    def __init__(self, fd, read_callback, write_callback):
         self.fd = fd
-        self.callback = callback
+        self.read_callback = read_callback
+        self.write_callback = write_callback
     def fileno(self):
         return self.fd
 
@@ -90,6 +93,119 @@ class ReactorMutex:
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+# Histogram of durations (in power of two microsecond buckets)
+class ProfileHistogram:
+    BUCKETS = 24
+    def __init__(self):
+        self.histogram = [0] * self.BUCKETS
+        self.count = 0
+        self.total = self.max = 0.
+        self.interval_count = 0
+        self.interval_total = self.interval_max = 0.
+    def add(self, duration):
+        usecs = int(duration * 1000000.)
+        bucket = min(usecs.bit_length(), self.BUCKETS - 1)
+        self.histogram[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.interval_count += 1
+        self.interval_total += duration
+        self.interval_max = max(self.interval_max, duration)
+    def reset_interval(self):
+        self.interval_count = 0
+        self.interval_total = self.interval_max = 0.
+    def get_status(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'histogram': list(self.histogram)}
+
+# Optional tracking of the time spent in each timer, fd, and queued
+# callback
+class ReactorProfiler:
+    def __init__(self, monotonic):
+        self.monotonic = monotonic
+        self.callback_names = {}
+        self.callbacks = {}
+        self.dispatch_lag = ProfileHistogram()
+        self.gc_pauses = ProfileHistogram()
+        self.cur_name = None
+        self.cur_start = 0.
+    def _get_name(self, callback):
+        obj = getattr(callback, '__self__', None)
+        if obj is None:
+            key = getattr(callback, '__code__', callback)
+        elif obj.__class__ is ReactorCallback:
+            return self._get_name(obj.callback)
+        else:
+            key = (obj.__class__, callback.__name__)
+        name = self.callback_names.get(key)
+        if name is None:
+            if obj is not None:
+                name = "%s.%s" % (obj.__class__.__name__, callback.__name__)
+            else:
+                name = "%s.%s" % (getattr(callback, '__module__', None),
+                                  getattr(callback, '__name__', '?'))
+            self.callback_names[key] = name
+        return name
+    def _start(self, callback):
+        self.cur_name = self._get_name(callback)
+        self.cur_start = self.monotonic()
+    def _stop(self):
+        name = self.cur_name
+        if name is None:
+            # Callback paused and is accounted for in pause()
+            return
+        self.cur_name = None
+        hist = self.callbacks.get(name)
+        if hist is None:
+            hist = self.callbacks[name] = ProfileHistogram()
+        hist.add(self.monotonic() - self.cur_start)
+    def run_timer(self, callback, eventtime, waketime):
+        self._start(callback)
+        if waketime != _NOW:
+            self.dispatch_lag.add(max(0., self.cur_start - waketime))
+        try:
+            return callback(eventtime)
+        finally:
+            self._stop()
+    def run_callback(self, callback, eventtime):
+        self._start(callback)
+        try:
+            callback(eventtime)
+        finally:
+            self._stop()
+    def pause(self, switch, *args):
+        # Don't count the time a callback is paused
+        name = self.cur_name
+        self._stop()
+        res = switch(*args)
+        self.cur_name = name
+        self.cur_start = self.monotonic()
+        return res
+    def note_gc(self, duration):
+        self.gc_pauses.add(duration)
+    def get_status(self):
+        return {'callbacks': {name: hist.get_status()
+                              for name, hist in self.callbacks.items()},
+                'dispatch_lag': self.dispatch_lag.get_status(),
+                'gc_pauses': self.gc_pauses.get_status()}
+    def get_interval_stats(self):
+        # Report (and reset) statistics since the last call
+        lag = self.dispatch_lag
+        lag_avg = lag.interval_total / max(1, lag.interval_count)
+        slowest_name, slowest = "none", 0.
+        for name, hist in self.callbacks.items():
+            if hist.interval_max > slowest:
+                slowest_name, slowest = name, hist.interval_max
+            hist.reset_interval()
+        msg = ("reactor_lag_avg=%.6f reactor_lag_max=%.6f reactor_gc_max=%.6f"
+               " reactor_slowest=%s:%.6f" % (
+                   lag_avg, lag.interval_max, self.gc_pauses.interval_max,
+                   slowest_name, slowest))
+        lag.reset_interval()
+        self.gc_pauses.reset_interval()
+        return msg
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -100,36 +216,65 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Profiling
+        self._profiler = None
+        # Timers (stored in a heap of (waketime, timer_id, timer) entries)
+        self._timer_heap = []
+        self._timer_count = 0
+        self._last_timer_id = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
+        self._soon_queue = collections.deque()
         # File descriptors
-        self._fds = []
+        self._read_fds = []
+        self._write_fds = []
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def enable_profiling(self):
+        if self._profiler is None:
+            self._profiler = ReactorProfiler(self.monotonic)
+        return self._profiler
+    def get_profiler(self):
+        return self._profiler
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _schedule_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.timer_id is None:
+            # Timer no longer registered
+            return
+        # Any existing heap entry for this timer becomes stale
+        self._last_timer_id = timer_id = self._last_timer_id + 1
+        timer_handler.timer_id = timer_id
+        if waketime < self.NEVER:
+            heapq.heappush(self._timer_heap,
+                           (waketime, timer_id, timer_handler))
+            self._next_timer = min(self._next_timer, waketime)
+    def update_timer(self, timer_handler, waketime):
+        self._schedule_timer(timer_handler, waketime)
+        timer_heap = self._timer_heap
+        if len(timer_heap) > 4 * self._timer_count + 64:
+            # Discard stale entries
+            timer_heap[:] = [e for e in timer_heap if e[1] == e[2].timer_id]
+            heapq.heapify(timer_heap)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if timer_handler.timer_id is None:
+            raise ValueError("Timer not registered")
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.timer_id = None
+        self._timer_count -= 1
+    def get_timer_count(self):
+        return self._timer_count
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -145,20 +290,51 @@ class SelectReactor:
                             gc_level = 2
                     self._last_gc_times[gc_level] = eventtime
                     gc.collect(gc_level)
+                    if self._profiler is not None:
+                        self._profiler.note_gc(self.monotonic() - eventtime)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        # Run callbacks queued with call_soon() (those queued while
+        # running are deferred to the next check)
+        soon_queue = self._soon_queue
+        for i in range(len(soon_queue)):
+            callback = soon_queue.popleft()
+            if self._profiler is not None:
+                self._profiler.run_callback(callback, eventtime)
+            else:
+                callback(eventtime)
+            if g_dispatch is not self._g_dispatch:
+                self._next_timer = self.NOW
+                self._end_greenlet(g_dispatch)
+                return 0.
+        timer_heap = self._timer_heap
+        # Only run timers scheduled before this check started (each
+        # timer is invoked at most once per check)
+        last_timer_id = self._last_timer_id
+        while timer_heap:
+            waketime, timer_id, t = timer_heap[0]
+            if waketime > eventtime or timer_id > last_timer_id:
+                break
+            heapq.heappop(timer_heap)
+            if timer_id != t.timer_id:
+                # Stale entry (timer was rescheduled or unregistered)
+                continue
+            t.waketime = self.NEVER
+            if self._profiler is not None:
+                waketime = self._profiler.run_timer(t.callback, eventtime,
+                                                    waketime)
+            else:
+                waketime = t.callback(eventtime)
+            self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                if timer_heap:
+                    self._next_timer = min(self._next_timer, timer_heap[0][0])
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if timer_heap:
+            self._next_timer = min(self._next_timer, timer_heap[0][0])
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -166,6 +342,11 @@ class SelectReactor:
     def register_callback(self, callback, waketime=NOW):
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
+    def call_soon(self, callback):
+        # Queue a one-shot callback(eventtime) to run (in order) from the
+        # main loop - lighter weight than register_callback()
+        self._soon_queue.append(callback)
+        self._next_timer = self.NOW
     # Asynchronous (from another thread) callbacks and completions
     def register_async_callback(self, callback, waketime=NOW):
         self._async_queue.put_nowait(
@@ -209,6 +390,8 @@ class SelectReactor:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
             # Switch to _check_timers (via g.timer.callback return)
+            if self._profiler is not None:
+                return self._profiler.pause(self._g_dispatch.switch, waketime)
             return self._g_dispatch.switch(waketime)
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
         if self._greenlets:
@@ -220,6 +403,8 @@ class SelectReactor:
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
         # Switch to _dispatch_loop (via _end_greenlet or direct)
+        if self._profiler is not None:
+            return self._profiler.pause(g_next.switch)
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
         return eventtime
@@ -236,13 +421,39 @@ class SelectReactor:
     def mutex(self, is_locked=False):
         return ReactorMutex(self, is_locked)
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
-        self._fds.append(file_handler)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        self._read_fds.append(file_handler)
         return file_handler
     def unregister_fd(self, file_handler):
-        self._fds.pop(self._fds.index(file_handler))
+        if file_handler in self._read_fds:
+            self._read_fds.pop(self._read_fds.index(file_handler))
+        if file_handler in self._write_fds:
+            self._write_fds.pop(self._write_fds.index(file_handler))
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        # Select if the read and/or write callback should be invoked
+        if (file_handler in self._read_fds) != is_readable:
+            if is_readable:
+                self._read_fds.append(file_handler)
+            else:
+                self._read_fds.remove(file_handler)
+        if (file_handler in self._write_fds) != is_writeable:
+            if is_writeable:
+                self._write_fds.append(file_handler)
+            else:
+                self._write_fds.remove(file_handler)
     # Main loop
+    def _dispatch_fds(self, g_dispatch, callbacks, eventtime):
+        # Returns true if the dispatch greenlet was changed
+        for callback in callbacks:
+            if self._profiler is not None:
+                self._profiler.run_callback(callback, eventtime)
+            else:
+                callback(eventtime)
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return True
+        return False
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         busy = True
@@ -250,15 +461,14 @@ class SelectReactor:
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = select.select(self._fds, [], [], timeout)
+            res = select.select(self._read_fds, self._write_fds, [], timeout)
             eventtime = self.monotonic()
-            for fd in res[0]:
+            if res[0] or res[1]:
                 busy = True
-                fd.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
+                callbacks = ([fd.read_callback for fd in res[0]]
+                             + [fd.write_callback for fd in res[1]])
+                if self._dispatch_fds(g_dispatch, callbacks, eventtime):
                     eventtime = self.monotonic()
-                    break
         self._g_dispatch = None
     def run(self):
         if self._pipe_fds is None:
@@ -289,10 +499,10 @@ class PollReactor(SelectReactor):
         self._poll = select.poll()
         self._fds = {}
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
         fds = self._fds.copy()
-        fds[fd] = callback
+        fds[fd] = file_handler
         self._fds = fds
         self._poll.register(file_handler, select.POLLIN | select.POLLHUP)
         return file_handler
@@ -301,6 +511,13 @@ class PollReactor(SelectReactor):
         fds = self._fds.copy()
         del fds[file_handler.fd]
         self._fds = fds
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        flags = select.POLLHUP
+        if is_readable:
+            flags |= select.POLLIN
+        if is_writeable:
+            flags |= select.POLLOUT
+        self._poll.modify(file_handler, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -311,13 +528,17 @@ class PollReactor(SelectReactor):
             busy = False
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
-            for fd, event in res:
+            if res:
                 busy = True
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
+                callbacks = []
+                for fd, event in res:
+                    file_handler = self._fds[fd]
+                    if event & ~select.POLLOUT:
+                        callbacks.append(file_handler.read_callback)
+                    if event & select.POLLOUT:
+                        callbacks.append(file_handler.write_callback)
+                if self._dispatch_fds(g_dispatch, callbacks, eventtime):
                     eventtime = self.monotonic()
-                    break
         self._g_dispatch = None
 
 class EPollReactor(SelectReactor):
@@ -325,19 +546,38 @@ class EPollReactor(SelectReactor):
         SelectReactor.__init__(self, gc_checking)
         self._epoll = select.epoll()
         self._fds = {}
+        # Regular files can't be used with epoll (they are always ready)
+        self._ready_fds = []
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except IOError as e:
+            if e.errno != errno.EPERM:
+                raise
+            self._ready_fds = self._ready_fds + [(fd, select.EPOLLIN)]
         fds = self._fds.copy()
-        fds[fd] = callback
+        fds[fd] = file_handler
         self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
         return file_handler
     def unregister_fd(self, file_handler):
-        self._epoll.unregister(file_handler.fd)
+        ready_fds = [(fd, event) for fd, event in self._ready_fds
+                     if fd != file_handler.fd]
+        if len(ready_fds) != len(self._ready_fds):
+            self._ready_fds = ready_fds
+        else:
+            self._epoll.unregister(file_handler.fd)
         fds = self._fds.copy()
         del fds[file_handler.fd]
         self._fds = fds
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        flags = select.EPOLLHUP
+        if is_readable:
+            flags |= select.EPOLLIN
+        if is_writeable:
+            flags |= select.EPOLLOUT
+        self._epoll.modify(file_handler.fd, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -346,20 +586,29 @@ class EPollReactor(SelectReactor):
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = self._epoll.poll(timeout)
+            if self._ready_fds:
+                res = self._epoll.poll(0.) + self._ready_fds
+            else:
+                res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
-            for fd, event in res:
+            if res:
                 busy = True
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
+                callbacks = []
+                for fd, event in res:
+                    file_handler = self._fds[fd]
+                    if event & ~select.EPOLLOUT:
+                        callbacks.append(file_handler.read_callback)
+                    if event & select.EPOLLOUT:
+                        callbacks.append(file_handler.write_callback)
+                if self._dispatch_fds(g_dispatch, callbacks, eventtime):
                     eventtime = self.monotonic()
-                    break
         self._g_dispatch = None
 
-# Use the poll based reactor if it is available
-try:
-    select.poll
+# Use the epoll based reactor if it is available (eg, on Linux),
+# otherwise the poll based reactor if it is available
+if hasattr(select, 'epoll'):
+    Reactor = EPollReactor
+elif hasattr(select, 'poll'):
     Reactor = PollReactor
-except:
+else:
     Reactor = SelectReactor
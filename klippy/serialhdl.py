@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import logging, threading, collections, itertools
 import serial
 
 import msgproto, chelper, util
@@ -24,18 +24,28 @@ class SerialReader:
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.serialqueue = None
+        self.msgdecoder = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
-        # Message handlers
+        # Message handlers (copy-on-write - only replaced while holding lock)
         self.handlers = {}
+        self.queued_oids = frozenset()
+        self.default_handler = ResponseHandler(self.handle_default, '#default')
+        # Queued message handlers (run in a separate thread)
+        self.queue_cond = threading.Condition(threading.Lock())
+        self.queued_responses = collections.deque()
+        self.queue_thread = None
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
+        # Batched command sending
+        self.batch_depth = 0
+        self.batch_cmds = {}
     def _bg_thread(self):
         response = self.ffi_main.new('struct pull_queue_message *')
         while 1:
@@ -49,16 +59,48 @@ class SerialReader:
                 completion = self.pending_notifications.pop(response.notify_id)
                 self.reactor.async_complete(completion, params)
                 continue
-            params = self.msgparser.parse(response.msg[0:count])
+            if response.param_count >= 0:
+                params = self.msgparser.parse_decoded(
+                    response.msg, response.params[0:response.param_count])
+            else:
+                params = self.msgparser.parse(response.msg[0:count])
             params['#sent_time'] = response.sent_time
             params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            oid = params.get('oid')
+            hdl = self.handlers.get((params['#name'], oid),
+                                    self.default_handler)
+            # All responses for an oid with a queued handler go through
+            # the queue so that they are delivered in order
+            if hdl.queued or oid in self.queued_oids:
+                self._queue_response(hdl, params)
+                continue
+            hdl.dispatch(params)
+    def _queue_thread(self):
+        queue_cond = self.queue_cond
+        queued_responses = self.queued_responses
+        while 1:
+            with queue_cond:
+                while not queued_responses:
+                    queue_cond.wait()
+                hdl, params = queued_responses.popleft()
+            if hdl is None:
+                if params is None:
+                    break
+                # Flush request
+                self.reactor.async_complete(params, None)
+                continue
+            # Skip handlers that were unregistered while queued
+            if self.handlers.get(hdl.key, self.default_handler) is not hdl:
+                continue
+            hdl.dispatch(params)
+    def _queue_response(self, hdl, params):
+        if self.queue_thread is None:
+            self.queue_thread = threading.Thread(target=self._queue_thread)
+            self.queue_thread.daemon = True
+            self.queue_thread.start()
+        with self.queue_cond:
+            self.queued_responses.append((hdl, params))
+            self.queue_cond.notify()
     def _get_identify_data(self, eventtime):
         # Query the "data dictionary" from the micro-controller
         identify_data = ""
@@ -113,6 +155,7 @@ class SerialReader:
         msgparser = msgproto.MessageParser()
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self._setup_decoder()
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         mcu_baud = msgparser.get_constant_float('SERIAL_BAUD', None)
@@ -124,6 +167,14 @@ class SerialReader:
         if receive_window is not None:
             self.ffi_lib.serialqueue_set_receive_window(
                 self.serialqueue, receive_window)
+    def _setup_decoder(self):
+        # Load the message formats into the C based message decoder
+        msgdecoder = self.ffi_main.gc(self.ffi_lib.msgdecode_alloc(),
+                                      self.ffi_lib.msgdecode_free)
+        for msgid, decode_types in self.msgparser.get_decode_formats():
+            self.ffi_lib.msgdecode_add_format(msgdecoder, msgid, decode_types)
+        self.ffi_lib.serialqueue_set_decoder(self.serialqueue, msgdecoder)
+        self.msgdecoder = msgdecoder
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
@@ -139,6 +190,11 @@ class SerialReader:
             if self.background_thread is not None:
                 self.background_thread.join()
             self.background_thread = self.serialqueue = None
+            self.msgdecoder = None
+        if self.queue_thread is not None:
+            self._queue_response(None, None)
+            self.queue_thread.join()
+            self.queue_thread = None
         if self.ser is not None:
             self.ser.close()
             self.ser = None
@@ -150,7 +206,9 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        hstats = [hdl.stats() for key, hdl in sorted(self.handlers.items())]
+        return ' '.join([self.ffi_main.string(self.stats_buf)]
+                        + [hs for hs in hstats if hs])
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
@@ -158,17 +216,48 @@ class SerialReader:
     def get_default_command_queue(self):
         return self.default_cmd_queue
     # Serial response callbacks
-    def register_response(self, callback, name, oid=None):
+    def register_response(self, callback, name, oid=None, queued=False):
+        # The handler table is replaced (never modified) so that the
+        # background thread may look up handlers without locking
         with self.lock:
+            handlers = dict(self.handlers)
             if callback is None:
-                del self.handlers[name, oid]
+                del handlers[name, oid]
             else:
-                self.handlers[name, oid] = callback
+                handlers[name, oid] = ResponseHandler(callback, name, oid,
+                                                      queued)
+            self.handlers = handlers
+            self.queued_oids = frozenset([
+                hdl.key[1] for hdl in handlers.values()
+                if hdl.queued and hdl.key[1] is not None])
+    def flush_queued_responses(self):
+        # Wait for all pending queued response handlers to complete
+        if self.queue_thread is None:
+            return
+        completion = self.reactor.completion()
+        self._queue_response(None, completion)
+        completion.wait()
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
+        if self.batch_depth:
+            self.batch_cmds.setdefault(cmd_queue, []).append(
+                (cmd, minclock, reqclock))
+            return
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
+    def raw_send_batch(self, cmds, cmd_queue):
+        # Send a list of (cmd, minclock, reqclock) with a single call
+        if not cmds:
+            return
+        msgs, min_clocks, req_clocks = zip(*cmds)
+        # Pass all the messages in a single buffer
+        data = bytearray(itertools.chain.from_iterable(msgs))
+        self.ffi_lib.serialqueue_send_multiple(
+            self.serialqueue, cmd_queue,
+            self.ffi_main.from_buffer('uint8_t[]', data), map(len, msgs),
+            min_clocks, req_clocks, len(cmds))
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
+        self._flush_batch()
         self.last_notify_id += 1
         nid = self.last_notify_id
         completion = self.reactor.completion()
@@ -179,9 +268,26 @@ class SerialReader:
         if params is None:
             raise error("Serial connection closed")
         return params
+    def begin_batch(self):
+        # Gather raw_send() commands until the matching end_batch()
+        self.batch_depth += 1
+    def end_batch(self):
+        self.batch_depth -= 1
+        if not self.batch_depth:
+            self._flush_batch()
+    def _flush_batch(self):
+        batch_cmds = self.batch_cmds
+        if not batch_cmds:
+            return
+        self.batch_cmds = {}
+        for cmd_queue, cmds in batch_cmds.items():
+            self.raw_send_batch(cmds, cmd_queue)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def send_batch(self, msgs):
+        cmds = [(self.msgparser.create_command(msg), 0, 0) for msg in msgs]
+        self.raw_send_batch(cmds, self.default_cmd_queue)
     def send_with_response(self, msg, response):
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
@@ -225,6 +331,54 @@ class SerialReader:
     def handle_default(self, params):
         logging.warn("got %s", params)
 
+# Context manager that submits all commands sent within it as a batch
+class CommandBatch:
+    def __init__(self, serial):
+        self.serial = serial
+    def __enter__(self):
+        self.serial.begin_batch()
+        return self
+    def __exit__(self, type=None, value=None, tb=None):
+        self.serial.end_batch()
+
+# Handlers slower than this are reported in the stats
+SLOW_RESPONSE_TIME = 0.050
+
+# Wrapper around a response callback that tracks handler latency
+class ResponseHandler:
+    def __init__(self, callback, name, oid=None, queued=False):
+        self.callback = callback
+        self.key = (name, oid)
+        self.queued = queued
+        self.stats_name = name
+        if oid is not None:
+            self.stats_name = "%s_%d" % (name, oid)
+        self.get_monotonic = chelper.get_ffi()[1].get_monotonic
+        self.count = self.last_count = 0
+        self.total_time = self.last_total_time = self.max_time = 0.
+    def dispatch(self, params):
+        try:
+            self.callback(params)
+        except:
+            logging.exception("Exception in serial callback")
+        # Latency is measured from message receipt to handler completion
+        latency = self.get_monotonic() - params['#receive_time']
+        self.count += 1
+        self.total_time += latency
+        if latency > self.max_time:
+            self.max_time = latency
+    def stats(self):
+        count, total_time, max_time = self.count, self.total_time, self.max_time
+        self.max_time = 0.
+        calls = count - self.last_count
+        if not calls:
+            return ""
+        avg = (total_time - self.last_total_time) / calls
+        self.last_count, self.last_total_time = count, total_time
+        if not self.queued and max_time < SLOW_RESPONSE_TIME:
+            return ""
+        return "%s_latency=%.6f/%.6f" % (self.stats_name, avg, max_time)
+
 # Class to send a query command and return the received response
 class SerialRetryCommand:
     def __init__(self, serial, name, oid=None):
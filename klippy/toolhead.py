@@ -11,17 +11,31 @@ import mcu, homing, chelper, kinematics.extruder
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'timing_callbacks',
+        'is_kinematic_move', 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+        'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
+        self.timing_callbacks = []
+        self.setup(toolhead, start_pos, end_pos, speed)
+    def setup(self, toolhead, start_pos, end_pos, speed):
+        # Fill in a new (or recycled) move object
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = [end_pos[0] - start_pos[0],
+                                end_pos[1] - start_pos[1],
+                                end_pos[2] - start_pos[2],
+                                end_pos[3] - start_pos[3]]
+        self.move_d = move_d = math.sqrt(axes_d[0]*axes_d[0]
+                                         + axes_d[1]*axes_d[1]
+                                         + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
@@ -36,7 +50,8 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_r = [axes_d[0] * inv_move_d, axes_d[1] * inv_move_d,
+                       axes_d[2] * inv_move_d, axes_d[3] * inv_move_d]
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -113,18 +128,21 @@ class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        self.lookahead_time = LOOKAHEAD_FLUSH_TIME
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def reset(self):
         del self.queue[:]
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_time
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
+    def set_lookahead_time(self, lookahead_time):
+        self.lookahead_time = lookahead_time
     def get_last(self):
         if self.queue:
             return self.queue[-1]
         return None
     def flush(self, lazy=False):
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_time
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
@@ -175,6 +193,12 @@ class MoveQueue:
         self.toolhead._process_moves(queue[:flush_count])
         # Remove processed moves from the queue
         del queue[:flush_count]
+    def pop_last(self):
+        # Remove the last (not yet flushed) move from the queue
+        move = self.queue.pop()
+        if self.queue:
+            self.junction_flush += move.min_move_t
+        return move
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
@@ -185,6 +209,180 @@ class MoveQueue:
             # Enough moves have been queued to reach the target flush time.
             self.flush(lazy=True)
 
+# Variant of MoveQueue that performs the look-ahead junction velocity
+# calculations in C.  The junction limits of each move are stored in a
+# compact C buffer as the move is queued.  The C code caches the
+# results of the backward pass over the queue, so a lazy flush only
+# revisits the moves whose junction speeds may have changed.  The
+# resulting move timing is identical to MoveQueue.
+class BatchMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.lookahead = ffi_main.gc(ffi_lib.lookahead_alloc(),
+                                     ffi_lib.lookahead_free)
+        self.lookahead_reset = ffi_lib.lookahead_reset
+        self.lookahead_add_move = ffi_lib.lookahead_add_move
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.lookahead_discard = ffi_lib.lookahead_discard
+        self.lookahead_pop = ffi_lib.lookahead_pop
+    def reset(self):
+        MoveQueue.reset(self)
+        self.lookahead_reset(self.lookahead)
+    def flush(self, lazy=False):
+        self.junction_flush = self.lookahead_time
+        flush_count = self.lookahead_flush(self.lookahead, lazy)
+        if not flush_count:
+            return
+        # Copy the calculated junction timing to the flushed moves
+        queue = self.queue
+        lmoves = self.lookahead.moves
+        for i in range(flush_count):
+            move = queue[i]
+            lm = lmoves[i]
+            move.start_v = lm.start_v
+            move.cruise_v = lm.cruise_v
+            move.end_v = lm.end_v
+            move.accel_t = lm.accel_t
+            move.cruise_t = lm.cruise_t
+            move.decel_t = lm.decel_t
+        # Generate step times for all moves ready to be flushed
+        self.toolhead._process_moves(queue[:flush_count])
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+        self.lookahead_discard(self.lookahead, flush_count)
+    def pop_last(self):
+        self.lookahead_pop(self.lookahead)
+        return MoveQueue.pop_last(self)
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) > 1:
+            move.calc_junction(queue[-2])
+        self.lookahead_add_move(
+            self.lookahead, move.move_d, move.accel, move.max_cruise_v2,
+            move.delta_v2, move.smooth_delta_v2, move.max_start_v2,
+            move.max_smoothed_v2)
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+MoveQueueTypes = {'python': MoveQueue, 'batch': BatchMoveQueue}
+
+# Cache of Move objects that may be reused once they have been
+# submitted to the trapq.  This reduces the number of allocations (and
+# thus garbage collection overhead) when processing many moves.  All
+# released moves are kept, so the pool grows to the largest number of
+# moves that have been in use at the same time.
+class MovePool:
+    def __init__(self):
+        self.free_moves = []
+        self.alloc_count = self.reuse_count = 0
+    def get_move(self, toolhead, start_pos, end_pos, speed):
+        if self.free_moves:
+            self.reuse_count += 1
+            move = self.free_moves.pop()
+            move.setup(toolhead, start_pos, end_pos, speed)
+            return move
+        self.alloc_count += 1
+        return Move(toolhead, start_pos, end_pos, speed)
+    def release_moves(self, moves):
+        for move in moves:
+            del move.timing_callbacks[:]
+        self.free_moves.extend(moves)
+
+# Helper to merge consecutive, nearly collinear, moves into a single
+# move.  A queued move is replaced with a move from its start position
+# to the end position of the new move as long as no point of the
+# original path deviates from the merged move by more than the
+# configured tolerance and the extrusion ratio of the moves match.
+# The end positions (including the extruder position) of the merged
+# moves are unchanged.
+class MoveCoalescer:
+    def __init__(self, toolhead, tolerance, extrude_tolerance):
+        self.toolhead = toolhead
+        self.tolerance = tolerance
+        self.extrude_tolerance = extrude_tolerance
+        self.last_move = None
+        self.speed = self.max_dev = self.extrude_r = 0.
+        self.merged_count = self.emitted_count = 0
+    def reset(self):
+        # Don't merge with moves queued before a change in the limits
+        self.last_move = None
+    def _start_chain(self, move, speed):
+        self.last_move = None
+        if move.is_kinematic_move:
+            self.last_move = move
+        self.speed = speed
+        self.max_dev = 0.
+        self.extrude_r = move.axes_r[3]
+        self.emitted_count += 1
+        return move
+    def coalesce(self, move, speed):
+        # Quickly skip moves that can not be merged
+        last = self.last_move
+        if (last is None or speed != self.speed or last.timing_callbacks
+            or not move.is_kinematic_move
+            or self.toolhead.move_queue.get_last() is not last):
+            return self._start_chain(move, speed)
+        # Check that the moves extrude at the same rate
+        extrude_r = self.extrude_r
+        if abs(move.axes_r[3] - extrude_r) > abs(
+                extrude_r * self.extrude_tolerance):
+            return self._start_chain(move, speed)
+        # Only merge moves that continue forward (less than 90 degrees
+        # from the last move).  The end of the last move then projects
+        # onto the merged move (between its start and end).
+        rx, ry, rz = last.axes_r[:3]
+        mrx, mry, mrz = move.axes_r[:3]
+        if rx * mrx + ry * mry + rz * mrz <= 0.:
+            return self._start_chain(move, speed)
+        # Find the maximum deviation of the original path from the
+        # merged move.  The previously merged points were no further
+        # than max_dev from the last move, which is rotated by an
+        # angle with sine 'sin_theta' to form the merged move.
+        start_pos = last.start_pos
+        end_pos = move.end_pos
+        dx = end_pos[0] - start_pos[0]
+        dy = end_pos[1] - start_pos[1]
+        dz = end_pos[2] - start_pos[2]
+        cross_x = ry * dz - rz * dy
+        cross_y = rz * dx - rx * dz
+        cross_z = rx * dy - ry * dx
+        sin_theta = math.sqrt((cross_x**2 + cross_y**2 + cross_z**2)
+                              / (dx**2 + dy**2 + dz**2))
+        max_dev = self.max_dev + last.move_d * sin_theta
+        if max_dev > self.tolerance:
+            return self._start_chain(move, speed)
+        # Extend the new move back to the start of the last queued move
+        # and replace the last queued move with it
+        toolhead = self.toolhead
+        move.setup(toolhead, start_pos, end_pos, speed)
+        try:
+            toolhead.kin.check_move(move)
+            if move.axes_d[3]:
+                toolhead.extruder.check_move(move)
+        except toolhead.printer.command_error:
+            # Restore the original move
+            move.setup(toolhead, last.end_pos, end_pos, speed)
+            toolhead.kin.check_move(move)
+            if move.axes_d[3]:
+                toolhead.extruder.check_move(move)
+            return self._start_chain(move, speed)
+        toolhead.move_queue.pop_last()
+        if toolhead.move_pool is not None:
+            toolhead.move_pool.release_moves([last])
+        self.last_move = move
+        self.max_dev = max_dev
+        self.merged_count += 1
+        return move
+    def stats(self):
+        return "moves_merged=%d moves_emitted=%d" % (
+            self.merged_count, self.emitted_count)
+
 MIN_KIN_TIME = 0.100
 MOVE_BATCH_TIME = 0.500
 SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
@@ -205,7 +403,22 @@ class ToolHead:
         self.can_pause = True
         if self.mcu.is_fileoutput():
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        mq_class = config.getchoice('lookahead_planner', MoveQueueTypes,
+                                    'python')
+        self.move_queue = mq_class(self)
+        self.move_queue.set_lookahead_time(config.getfloat(
+            'lookahead_time', LOOKAHEAD_FLUSH_TIME, above=0.))
+        self.move_pool = None
+        if config.getboolean('move_pool', False):
+            self.move_pool = MovePool()
+        self.coalescer = None
+        coalesce_tolerance = config.getfloat('coalesce_tolerance', 0.,
+                                             minval=0.)
+        if coalesce_tolerance:
+            coalesce_extrude_tolerance = config.getfloat(
+                'coalesce_extrude_tolerance', 0.01, minval=0.)
+            self.coalescer = MoveCoalescer(self, coalesce_tolerance,
+                                           coalesce_extrude_tolerance)
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -304,7 +517,7 @@ class ToolHead:
             self.print_time = min_print_time
             self.printer.send_event("toolhead:sync_print_time",
                                     curtime, est_print_time, self.print_time)
-    def _process_moves(self, moves):
+    def _resync_print_time(self):
         # Resync print_time if necessary
         if self.special_queuing_state:
             if self.special_queuing_state != "Drip":
@@ -313,6 +526,8 @@ class ToolHead:
                 self.need_check_stall = -1.
                 self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
             self._calc_print_time()
+    def _process_moves(self, moves):
+        self._resync_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
         for move in moves:
@@ -334,6 +549,8 @@ class ToolHead:
             self._update_drip_move_time(next_move_time)
         self._update_move_time(next_move_time)
         self.last_kin_move_time = next_move_time
+        if self.move_pool is not None:
+            self.move_pool.release_moves(moves)
     def flush_step_generation(self):
         # Transition from "Flushed"/"Priming"/main state to "Flushed" state
         self.move_queue.flush()
@@ -408,17 +625,54 @@ class ToolHead:
         self.kin.set_position(newpos, homing_axes)
         self.printer.send_event("toolhead:set_position")
     def move(self, newpos, speed):
-        move = Move(self, self.commanded_pos, newpos, speed)
+        if self.move_pool is not None:
+            move = self.move_pool.get_move(self, self.commanded_pos, newpos,
+                                           speed)
+        else:
+            move = Move(self, self.commanded_pos, newpos, speed)
         if not move.move_d:
+            if self.move_pool is not None:
+                self.move_pool.release_moves([move])
             return
         if move.is_kinematic_move:
             self.kin.check_move(move)
         if move.axes_d[3]:
             self.extruder.check_move(move)
         self.commanded_pos[:] = move.end_pos
+        if self.coalescer is not None:
+            move = self.coalescer.coalesce(move, speed)
         self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
             self._check_stall()
+    def check_move(self, newpos):
+        # Verify that a move to the given position would be in range
+        move = Move(self, self.commanded_pos, newpos, self.max_velocity)
+        if move.is_kinematic_move:
+            self.kin.check_move(move)
+    def check_trapq_move(self, start_pos, end_pos, speed, accel):
+        # Verify a move that is to be generated by queue_trapq_moves()
+        # and return its maximum velocity and acceleration (as limited
+        # by the kinematics)
+        move = Move(self, start_pos, end_pos, speed)
+        if move.is_kinematic_move:
+            self.kin.check_move(move)
+        return math.sqrt(move.max_cruise_v2), min(accel, move.accel)
+    def queue_trapq_moves(self, gen_moves):
+        # Queue kinematic moves generated directly into the trapq
+        # (bypassing the look-ahead queue).  The gen_moves() callback is
+        # passed the trapq and the print_time of the start of the moves
+        # and must return the print_time at the end of the moves.  The
+        # moves must start and end at the commanded position, and each
+        # move must be verified with check_trapq_move().
+        self.move_queue.flush()
+        self._resync_print_time()
+        next_move_time = gen_moves(self.trapq, self.print_time)
+        if self.special_queuing_state:
+            self._update_drip_move_time(next_move_time)
+        self._update_move_time(next_move_time)
+        self.last_kin_move_time = next_move_time
+        if self.print_time > self.need_check_stall:
+            self._check_stall()
     def manual_move(self, coord, speed):
         curpos = list(self.commanded_pos)
         for i in range(len(coord)):
@@ -489,8 +743,11 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+        if self.coalescer is not None:
+            msg = "%s %s" % (msg, self.coalescer.stats())
+        return is_active, msg
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -547,6 +804,8 @@ class ToolHead:
         self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / self.max_accel
         self.max_accel_to_decel = min(self.requested_accel_to_decel,
                                       self.max_accel)
+        if self.coalescer is not None:
+            self.coalescer.reset()
     def cmd_G4(self, gcmd):
         # Dwell
         delay = gcmd.get_float('P', 0., minval=0.) / 1000.
@@ -9,24 +9,94 @@ import os
 import sys
 import errno
 import json
+import re
+import collections
 import homing
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
-# play well with some parts of Klipper (particuarly displays), so we
-# need to create an object hook. This solution borrowed from:
-#
-# https://stackoverflow.com/questions/956867/
-#
-def byteify(data, ignore_dicts=False):
-    if isinstance(data, unicode):
-        return data.encode('utf-8')
-    if isinstance(data, list):
-        return [byteify(i, True) for i in data]
-    if isinstance(data, dict) and not ignore_dicts:
-        return {byteify(k, True): byteify(v, True)
-                for k, v in data.items()}
+# play well with some parts of Klipper (particuarly displays), so all
+# strings in a request are converted to utf-8 encoded str objects.
+def byteify(data, strings=None):
+    dtype = type(data)
+    if dtype is dict:
+        out = {}
+        for k, v in data.iteritems():
+            vtype = type(v)
+            if vtype is unicode:
+                v = v.encode('utf-8')
+                if strings is not None:
+                    v = strings.get(v, v)
+            elif vtype is dict or vtype is list:
+                v = byteify(v, strings)
+            k = k.encode('utf-8')
+            if strings is not None:
+                k = strings.get(k, k)
+            out[k] = v
+        return out
+    if dtype is list:
+        return [byteify(v, strings) for v in data]
+    if dtype is unicode:
+        data = data.encode('utf-8')
+        if strings is not None:
+            data = strings.get(data, data)
     return data
 
+# Large strings (eg, a long gcode/script) are slow to decode with the
+# json module (and then to encode back to utf-8).  They are extracted
+# from the request and decoded directly to str.
+LARGE_REQUEST = 16384
+LARGE_STRING = 1024
+invalid_escape_r = re.compile(r'\\[^"\\bfnrt]')
+printable_ascii = "".join([chr(i) for i in range(0x20, 0x7f)])
+
+def decode_string(body):
+    # Python's string_escape handles printable ascii strings with the
+    # common json escapes
+    escapes = body
+    if '\\\\' in escapes:
+        escapes = escapes.replace('\\\\', '')
+    if (invalid_escape_r.search(escapes) is None
+        and not body.translate(None, printable_ascii)):
+        return body.decode('string_escape')
+    return json.loads('"%s"' % (body,)).encode('utf-8')
+
+def decode_request(data):
+    if len(data) < LARGE_REQUEST or '\\u0000' in data:
+        return byteify(json.loads(data))
+    # Replace each large string with a placeholder
+    parts = []
+    strings = {}
+    pos, end = 0, -1
+    while 1:
+        start = data.find('"', end + 1)
+        if start < 0:
+            break
+        end = data.find('"', start + 1)
+        while end > 0 and data[end - 1] == '\\':
+            # Check if the quote is escaped
+            bs = end - 1
+            while data[bs - 1] == '\\':
+                bs -= 1
+            if not (end - bs) & 1:
+                break
+            end = data.find('"', end + 1)
+        if end < 0:
+            break
+        if end - start > LARGE_STRING:
+            placeholder = '\x00%d' % (len(strings),)
+            strings[placeholder] = decode_string(data[start+1:end])
+            parts.append(data[pos:start])
+            parts.append('"\\u0000%d"' % (len(strings) - 1,))
+            pos = end + 1
+    if not strings:
+        return byteify(json.loads(data))
+    parts.append(data[pos:])
+    return byteify(json.loads("".join(parts)), strings)
+
+# Encode a message for transmission to a client
+def encode_message(data):
+    return json.dumps(data) + "\x03"
+
 class WebRequestError(homing.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -43,7 +113,7 @@ class WebRequest:
     error = WebRequestError
     def __init__(self, client_conn, request):
         self.client_conn = client_conn
-        base_request = json.loads(request, object_hook=byteify)
+        base_request = decode_request(request)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -157,6 +227,27 @@ class ServerSocket:
     def pop_client(self, client_id):
         self.clients.pop(client_id, None)
 
+    def stats(self, eventtime):
+        if self.sock is None:
+            return False, ""
+        send_queued = max_send_queued = coalesced = 0
+        for client in self.clients.values():
+            send_queued += client.send_queued
+            max_send_queued = max(max_send_queued, client.max_send_queued)
+            coalesced += client.coalesced_updates
+            client.max_send_queued = client.send_queued
+        return False, ("webhooks: clients=%d send_queued=%d"
+                       " max_send_queued=%d coalesced=%d" % (
+                           len(self.clients), send_queued, max_send_queued,
+                           coalesced))
+
+# Amount of queued data at which status updates to a client are merged
+# instead of queued, and at which a client is considered unresponsive
+SEND_HIGH_WATER = 256 * 1024
+SEND_BUFFER_LIMIT = 4 * 1024 * 1024
+# Small messages are combined into a single send() up to this size
+SEND_COMBINE_SIZE = 16384
+
 class ClientConnection:
     def __init__(self, server, sock):
         self.printer = server.printer
@@ -166,9 +257,16 @@ class ClientConnection:
         self.uid = id(self)
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
-            self.sock.fileno(), self.process_received)
-        self.partial_data = self.send_buffer = ""
-        self.is_sending_data = False
+            self.sock.fileno(), self.process_received, self._do_send)
+        self.partial_data = ""
+        # Transmit queue (encoded messages, with a memoryview of the
+        # unsent portion of a partially sent message)
+        self.send_queue = collections.deque()
+        self.send_queued = self.max_send_queued = 0
+        self.is_sending_data = self.is_send_blocked = False
+        # Status update merged while the client is not keeping up
+        self.pending_status = None
+        self.coalesced_updates = 0
         self.set_client_info("?", "New connection")
 
     def set_client_info(self, client_info, state_msg=None):
@@ -188,6 +286,9 @@ class ClientConnection:
         self.set_client_info(None, "Disconnected")
         self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        self.send_queue.clear()
+        self.send_queued = 0
+        self.pending_status = None
         try:
             self.sock.close()
         except socket.error:
@@ -221,7 +322,7 @@ class ClientConnection:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
                 continue
-            self.reactor.register_callback(
+            self.reactor.call_soon(
                 lambda e, s=self, wr=web_request: s._process_request(wr))
 
     def _process_request(self, web_request):
@@ -242,34 +343,98 @@ class ClientConnection:
         self.send(result)
 
     def send(self, data):
-        self.send_buffer += json.dumps(data) + "\x03"
+        self.send_encoded(encode_message(data))
+
+    def send_encoded(self, msg):
+        # Send a message that was encoded with encode_message()
+        if self.fd_handle is None:
+            return
+        self.send_queue.append(msg)
+        self.send_queued += len(msg)
+        if self.send_queued > self.max_send_queued:
+            self.max_send_queued = self.send_queued
+            if self.send_queued > SEND_BUFFER_LIMIT:
+                logging.info("webhooks: Client %s not reading data"
+                             " (%d bytes queued), closing socket",
+                             self.uid, self.send_queued)
+                self.close()
+                return
         if not self.is_sending_data:
             self.is_sending_data = True
-            self.reactor.register_callback(self._do_send)
+            self.reactor.call_soon(self._do_send)
+
+    def send_status(self, data, msg=None):
+        # Send a status update.  If the client is not keeping up then
+        # the update is merged with any other unsent updates.
+        if self.pending_status is None and self.send_queued < SEND_HIGH_WATER:
+            if msg is None:
+                msg = encode_message(data)
+            self.send_encoded(msg)
+            return
+        self.coalesced_updates += 1
+        status = {}
+        if self.pending_status is not None:
+            status = self.pending_status['params']['status']
+        for obj_name, cres in data['params']['status'].items():
+            status.setdefault(obj_name, {}).update(cres)
+        self.pending_status = pending = dict(data)
+        pending['params'] = {'eventtime': data['params']['eventtime'],
+                             'status': status}
+
+    def _combine_queued(self):
+        send_queue = self.send_queue
+        parts = []
+        size = 0
+        while send_queue and size + len(send_queue[0]) <= SEND_COMBINE_SIZE:
+            data = send_queue.popleft()
+            if type(data) is memoryview:
+                data = data.tobytes()
+            parts.append(data)
+            size += len(data)
+        data = "".join(parts)
+        send_queue.appendleft(data)
+        return data
 
     def _do_send(self, eventtime):
-        retries = 10
-        while self.send_buffer:
-            try:
-                sent = self.sock.send(self.send_buffer)
-            except socket.error as e:
-                if e.errno == errno.EBADF or e.errno == errno.EPIPE \
-                        or not retries:
-                    sent = 0
-                else:
-                    retries -= 1
-                    waketime = self.reactor.monotonic() + .001
-                    self.reactor.pause(waketime)
-                    continue
-            retries = 10
-            if sent > 0:
-                self.send_buffer = self.send_buffer[sent:]
-            else:
-                logging.info(
-                    "webhooks: Error sending server data,  closing socket")
-                self.close()
+        if self.fd_handle is None:
+            return
+        send_queue = self.send_queue
+        while 1:
+            while send_queue:
+                data = send_queue[0]
+                if len(data) < SEND_COMBINE_SIZE and len(send_queue) > 1:
+                    data = self._combine_queued()
+                try:
+                    sent = self.sock.send(data)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                   errno.EINTR):
+                        sent = -1
+                    else:
+                        sent = 0
+                if not sent:
+                    logging.info(
+                        "webhooks: Error sending server data,  closing socket")
+                    self.close()
+                    return
+                if sent < 0:
+                    break
+                self.send_queued -= sent
+                if sent < len(data):
+                    send_queue[0] = memoryview(data)[sent:]
+                    break
+                send_queue.popleft()
+            pending = self.pending_status
+            if pending is None or self.send_queued >= SEND_HIGH_WATER:
                 break
-        self.is_sending_data = False
+            self.pending_status = None
+            self.send_encoded(encode_message(pending))
+        # Wait for the socket to become writable if data remains
+        is_send_blocked = len(send_queue) > 0
+        if is_send_blocked != self.is_send_blocked:
+            self.is_send_blocked = is_send_blocked
+            self.reactor.set_fd_wake(self.fd_handle, True, is_send_blocked)
+        self.is_sending_data = is_send_blocked
 
 class WebHooks:
     def __init__(self, printer):
@@ -319,6 +484,9 @@ class WebHooks:
     def get_connection(self):
         return self.sconn
 
+    def stats(self, eventtime):
+        return self.sconn.stats(eventtime)
+
     def get_callback(self, path):
         cb = self._endpoints.get(path, None)
         if cb is None:
@@ -391,6 +559,9 @@ class GCodeHelper:
 
 SUBSCRIPTION_REFRESH_TIME = .25
 
+# Placeholder for an object that was not queried on the previous update
+NOT_QUERIED = ({}, None, True)
+
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -407,33 +578,64 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_query):
+        # Returns the object status, its version, and if it may have
+        # changed since the last update.  Objects that implement
+        # get_status_version() are only queried when their version
+        # changes.
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}, None, True
+        version = None
+        if hasattr(po, 'get_status_version'):
+            version = po.get_status_version()
+            lres, lversion, is_changed = last_query.get(obj_name, NOT_QUERIED)
+            if version is not None and version == lversion:
+                return lres, version, False
+        return po.get_status(eventtime), version, True
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
+        # Clients with the same subscription signature receive the same
+        # update - only encode it once when it is shared
+        signatures = {}
+        for entry in msglist:
+            signatures[entry[4]] = signatures.get(entry[4], 0) + 1
+        encoded = {}
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, signature in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
                 del self.clients[cconn]
                 continue
+            if signature is not None:
+                if signatures[signature] < 2:
+                    signature = None
+                else:
+                    update = encoded.get(signature)
+                    if update is not None:
+                        if update:
+                            cconn.send_status(*update)
+                        continue
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                qres = query.get(obj_name, None)
+                if qres is None:
+                    qres = query[obj_name] = self._query_object(
+                        obj_name, eventtime, last_query)
+                res, version, is_changed = qres
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
+                if not is_changed and not is_query:
+                    # Object status unchanged - no need to compare items
+                    continue
+                lres = last_query.get(obj_name, NOT_QUERIED)[0]
                 cres = {}
                 for ri in req_items:
                     rd = res.get(ri, None)
@@ -445,7 +647,14 @@ class QueryStatusHelper:
             if cquery or is_query:
                 tmp = dict(template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
+                if signature is None:
+                    send_func(tmp)
+                    continue
+                msg = encode_message(tmp)
+                encoded[signature] = (tmp, msg)
+                cconn.send_status(tmp, msg)
+            elif signature is not None:
+                encoded[signature] = ()
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -470,7 +679,8 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((None, objects, complete.complete, {},
+                                     None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -479,7 +689,17 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            signature = self._get_signature(objects, template)
+            self.clients[cconn] = (cconn, objects, cconn.send_status,
+                                   template, signature)
+    def _get_signature(self, objects, template):
+        # Updates can only be shared once the requested items are known
+        # (a request for all items of an object is expanded to a list of
+        # items when the object is first queried)
+        if None in objects.values():
+            return None
+        return json.dumps([sorted(objects.items()), template],
+                          sort_keys=True)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
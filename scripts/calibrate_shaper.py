@@ -13,6 +13,10 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
 from shaper_calibrate import CalibrationData, ShaperCalibrate
 
 def parse_log(logname):
+    if logname.endswith('.npz'):
+        # Raw accelerometer data in npz format (see adxl345.py)
+        data = np.load(logname)
+        return np.column_stack((data['time'], data['accel'] * data['scale']))
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
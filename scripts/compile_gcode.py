@@ -0,0 +1,32 @@
+#!/usr/bin/env python2
+# Convert g-code files to the virtual_sdcard "compiled_print" format
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+from extras import virtual_sdcard
+
+def main():
+    usage = "%prog [options] <gcode file> [<gcode file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--force", action="store_true", dest="force",
+                    help="recompile even if the compiled file is current")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    for filename in args:
+        if not options.force:
+            reader = virtual_sdcard.open_compiled_file(filename)
+            if reader is not None:
+                reader.close()
+                print("%s: up to date" % (filename,))
+                continue
+        compiled_fname = virtual_sdcard.compile_gcode_file(filename)
+        print("%s: wrote %s" % (filename, compiled_fname))
+
+if __name__ == '__main__':
+    main()
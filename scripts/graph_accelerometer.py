@@ -15,6 +15,10 @@ from shaper_calibrate import ShaperCalibrate
 MAX_TITLE_LENGTH=80
 
 def parse_log(logname):
+    if logname.endswith('.npz'):
+        # Raw accelerometer data in npz format (see adxl345.py)
+        data = np.load(logname)
+        return np.column_stack((data['time'], data['accel'] * data['scale']))
     return np.loadtxt(logname, comments='#', delimiter=',')
 
 ######################################################################
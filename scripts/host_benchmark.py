@@ -0,0 +1,1833 @@
+#!/usr/bin/env python2
+# Benchmarks for the host software
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import sys, os, optparse, time, math, gc, logging, importlib, json, socket
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+
+
+######################################################################
+# Test move generation
+######################################################################
+
+# Extract the G0/G1 moves from a g-code file
+def parse_gcode_moves(filename):
+    moves = []
+    pos = [0., 0., 0., 0.]
+    speed = 25.
+    absolute_coord = absolute_extrude = True
+    f = open(filename, 'rb')
+    for line in f:
+        line = line.split(';', 1)[0].strip().upper()
+        parts = line.split()
+        if not parts:
+            continue
+        cmd = parts[0]
+        if cmd == 'G90':
+            absolute_coord = absolute_extrude = True
+        elif cmd == 'G91':
+            absolute_coord = absolute_extrude = False
+        elif cmd == 'M82':
+            absolute_extrude = True
+        elif cmd == 'M83':
+            absolute_extrude = False
+        elif cmd == 'G92':
+            for p in parts[1:]:
+                if p[0] == 'E':
+                    pos[3] = float(p[1:])
+        elif cmd in ('G0', 'G1'):
+            newpos = list(pos)
+            for p in parts[1:]:
+                if p[0] == 'F':
+                    speed = float(p[1:]) / 60.
+                    continue
+                axis = 'XYZE'.find(p[0])
+                if axis < 0:
+                    continue
+                v = float(p[1:])
+                if axis == 3:
+                    newpos[3] = v if absolute_extrude else pos[3] + v
+                else:
+                    newpos[axis] = v if absolute_coord else pos[axis] + v
+            moves.append((newpos, speed))
+            pos = newpos
+    f.close()
+    return moves
+
+# Generate a series of tiny segments approximating circles
+def gen_segment_moves(count, seg_len=0.050, radius=20., speed=300.):
+    moves = []
+    step = seg_len / radius
+    e = 0.
+    for i in range(count):
+        a = i * step
+        e += seg_len * .03
+        moves.append(([100. + radius * math.cos(a),
+                       100. + radius * math.sin(a), 0.3, e], speed))
+    return moves
+
+def get_test_moves(args, count):
+    if args:
+        return parse_gcode_moves(args[0])
+    return gen_segment_moves(count)
+
+
+######################################################################
+# Look-ahead planner benchmark
+######################################################################
+
+class BenchExtruder:
+    def calc_junction(self, prev_move, move):
+        diff_r = move.axes_r[3] - prev_move.axes_r[3]
+        if diff_r:
+            return (1. / abs(diff_r))**2
+        return move.max_cruise_v2
+
+class BenchToolHead:
+    def __init__(self, mq_class, max_accel=3000.):
+        self.max_velocity = 500.
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        self.junction_deviation = 25. * (math.sqrt(2.) - 1.) / max_accel
+        self.extruder = BenchExtruder()
+        self.move_queue = mq_class(self)
+        self.move_queue.set_flush_time(2.)
+        self.results = []
+    def _process_moves(self, moves):
+        self.results.extend([(m.start_v, m.cruise_v, m.end_v,
+                              m.accel_t, m.cruise_t, m.decel_t)
+                             for m in moves])
+
+def run_lookahead(toolhead_module, mq_class, moves, max_accel=3000.):
+    th = BenchToolHead(mq_class, max_accel)
+    # Create the moves up front so that only the planner is timed
+    qmoves = []
+    pos = [0., 0., 0., 0.]
+    for newpos, speed in moves:
+        move = toolhead_module.Move(th, pos, newpos, speed)
+        if move.move_d:
+            qmoves.append(move)
+            pos = move.end_pos
+    mq = th.move_queue
+    start_time = time.time()
+    for move in qmoves:
+        mq.add_move(move)
+    mq.flush()
+    return time.time() - start_time, th.results
+
+def compare_lookahead(moves, max_accel=3000.):
+    import toolhead
+    results = {}
+    for name, mq_class in sorted(toolhead.MoveQueueTypes.items()):
+        run_lookahead(toolhead, mq_class, moves[:1000], max_accel)
+        elapsed, results[name] = run_lookahead(toolhead, mq_class, moves,
+                                               max_accel)
+        count = len(results[name])
+        print("%-8s %8d moves in %.3fs: %.0f moves/s" % (
+            name, count, elapsed, count / elapsed))
+    baseline = results['python']
+    for name, res in sorted(results.items()):
+        if res != baseline:
+            print("ERROR: %s planner results differ from python planner"
+                  % (name,))
+
+def bench_lookahead(options, args):
+    compare_lookahead(get_test_moves(args, options.count))
+
+# Generate long straight lines (split into many segments) with a low
+# acceleration, so that the toolhead is accelerating over a large
+# number of queued moves.
+def gen_accel_run_moves(count, seg_len=1.5, line_len=2000., speed=100.):
+    moves = []
+    line_count = int(line_len / seg_len)
+    x = y = e = 0.
+    direction = 1.
+    for i in range(count):
+        if not i % line_count:
+            direction = -direction
+            y += .4
+        x += direction * seg_len
+        e += seg_len * .03
+        moves.append(([x, y, 0.3, e], speed))
+    return moves
+
+def bench_lookahead_accel(options, args):
+    # The length of the lines determines the number of moves that the
+    # toolhead accelerates over (and thus the number of queued moves)
+    line_lens = [float(a) for a in args] or [500., 2000., 8000.]
+    for line_len in line_lens:
+        print("Lines of %.0fmm (%d moves):" % (line_len, line_len / 1.5))
+        compare_lookahead(gen_accel_run_moves(min(options.count, 20000),
+                                              line_len=line_len), 10.)
+
+
+######################################################################
+# Move object allocation benchmark
+######################################################################
+
+class PoolBenchToolHead(BenchToolHead):
+    def __init__(self, mq_class, move_pool):
+        BenchToolHead.__init__(self, mq_class)
+        self.move_pool = move_pool
+    def _process_moves(self, moves):
+        if self.move_pool is not None:
+            self.move_pool.release_moves(moves)
+
+def run_move_alloc(toolhead_module, moves, move_pool):
+    th = PoolBenchToolHead(toolhead_module.MoveQueue, move_pool)
+    mq = th.move_queue
+    pos = [0., 0., 0., 0.]
+    gc.collect()
+    start_time = time.time()
+    for newpos, speed in moves:
+        if move_pool is not None:
+            move = move_pool.get_move(th, pos, newpos, speed)
+        else:
+            move = toolhead_module.Move(th, pos, newpos, speed)
+        if not move.move_d:
+            if move_pool is not None:
+                move_pool.release_moves([move])
+            continue
+        pos = move.end_pos
+        mq.add_move(move)
+    mq.flush()
+    return time.time() - start_time
+
+# Size of a move object if it were stored in a regular python __dict__
+def get_dict_move_size(move):
+    class DictMove:
+        pass
+    dm = DictMove()
+    for name in move.__slots__:
+        setattr(dm, name, getattr(move, name, 0.))
+    return sys.getsizeof(dm) + sys.getsizeof(dm.__dict__)
+
+def bench_moves(options, args):
+    import toolhead
+    moves = get_test_moves(args, options.count)
+    if args:
+        # Replay the moves of the file up to the requested count
+        moves = (moves * (options.count // len(moves) + 1))[:options.count]
+    move = toolhead.Move(BenchToolHead(toolhead.MoveQueue), [0., 0., 0., 0.],
+                         [1., 1., 0., 0.], 10.)
+    print("Move object size: %d bytes (%d bytes with a __dict__)" % (
+        sys.getsizeof(move), get_dict_move_size(move)))
+    for use_pool in [False, True]:
+        move_pool = None
+        if use_pool:
+            move_pool = toolhead.MovePool()
+        elapsed = run_move_alloc(toolhead, moves, move_pool)
+        allocs = len(moves)
+        if move_pool is not None:
+            allocs = move_pool.alloc_count
+        print("move_pool=%-5s %8d moves in %.3fs: %.0f moves/s"
+              " (%d move objects allocated)" % (
+                  use_pool, len(moves), elapsed, len(moves) / elapsed,
+                  allocs))
+
+
+######################################################################
+# Move coalescing benchmark
+######################################################################
+
+class CoalesceBenchKinematics:
+    def check_move(self, move):
+        pass
+
+class CoalesceBenchExtruder(BenchExtruder):
+    def check_move(self, move):
+        pass
+
+class CoalesceBenchPrinter:
+    command_error = Exception
+
+# Generate (and discard) the steps of the flushed moves as the toolhead
+# would (cartesian x, y, z, and extruder steppers on a 16MHz mcu)
+class CoalesceBenchSteppers:
+    def __init__(self):
+        import chelper
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.ffi_lib = ffi_lib
+        self.mcu_freq = 16000000.
+        self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        self.extruder_trapq = ffi_main.gc(ffi_lib.trapq_alloc(),
+                                          ffi_lib.trapq_free)
+        self.output = open(os.devnull, 'wb')
+        self.serialqueue = ffi_main.gc(
+            ffi_lib.serialqueue_alloc(self.output.fileno(), 1),
+            ffi_lib.serialqueue_free)
+        self.stepper_kinematics = []
+        stepqueues = []
+        for oid, axis in enumerate('xyze'):
+            sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                             ffi_lib.stepcompress_free)
+            ffi_lib.stepcompress_fill(sc, int(.000025 * self.mcu_freq), 0,
+                                      1, 2)
+            if axis == 'e':
+                sk = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
+                                 ffi_lib.free)
+                ffi_lib.itersolve_set_stepcompress(sk, sc, .002)
+                ffi_lib.itersolve_set_trapq(sk, self.extruder_trapq)
+            else:
+                sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc(axis),
+                                 ffi_lib.free)
+                ffi_lib.itersolve_set_stepcompress(sk, sc, .0125)
+                ffi_lib.itersolve_set_trapq(sk, self.trapq)
+            stepqueues.append(sc)
+            self.stepper_kinematics.append(sk)
+        self.stepqueues = stepqueues
+        self.steppersync = ffi_main.gc(
+            ffi_lib.steppersync_alloc(self.serialqueue, stepqueues,
+                                      len(stepqueues), 16),
+            ffi_lib.steppersync_free)
+        ffi_lib.steppersync_set_time(self.steppersync, 0., self.mcu_freq)
+        # Let the serial thread write out all messages as they are queued
+        ffi_lib.serialqueue_set_clock_est(self.serialqueue, self.mcu_freq,
+                                          ffi_lib.get_monotonic(), 1 << 60)
+        self.stats_buf = ffi_main.new('char[4096]')
+        self.ffi_main = ffi_main
+        self.print_time = 0.
+    def process_moves(self, moves):
+        ffi_lib = self.ffi_lib
+        trapq_append = ffi_lib.trapq_append
+        print_time = self.print_time
+        for m in moves:
+            trapq_append(self.trapq, print_time,
+                         m.accel_t, m.cruise_t, m.decel_t,
+                         m.start_pos[0], m.start_pos[1], m.start_pos[2],
+                         m.axes_r[0], m.axes_r[1], m.axes_r[2],
+                         m.start_v, m.cruise_v, m.accel)
+            if m.axes_d[3]:
+                axis_r = m.axes_r[3]
+                trapq_append(self.extruder_trapq, print_time,
+                             m.accel_t, m.cruise_t, m.decel_t,
+                             m.start_pos[3], 0., 0., 1., 0., 0.,
+                             m.start_v * axis_r, m.cruise_v * axis_r,
+                             m.accel * axis_r)
+            print_time += m.accel_t + m.cruise_t + m.decel_t
+        self.print_time = print_time
+        for sk in self.stepper_kinematics:
+            ffi_lib.itersolve_generate_steps(sk, print_time)
+        ffi_lib.steppersync_flush(self.steppersync,
+                                  int(print_time * self.mcu_freq))
+        ffi_lib.trapq_free_moves(self.trapq, print_time)
+        ffi_lib.trapq_free_moves(self.extruder_trapq, print_time)
+    def close(self):
+        # Wait for the serial thread to write out the queued messages
+        ffi_lib = self.ffi_lib
+        while 1:
+            ffi_lib.serialqueue_get_stats(self.serialqueue, self.stats_buf,
+                                          len(self.stats_buf))
+            stats = self.ffi_main.string(self.stats_buf)
+            if b'ready_bytes=0 stalled_bytes=0' in stats:
+                break
+            time.sleep(.001)
+        ffi_lib.serialqueue_exit(self.serialqueue)
+        self.output.close()
+
+class CoalesceBenchToolHead(BenchToolHead):
+    def __init__(self, toolhead_module, tolerance, gen_steps):
+        BenchToolHead.__init__(self, toolhead_module.MoveQueue)
+        self.printer = CoalesceBenchPrinter()
+        self.kin = CoalesceBenchKinematics()
+        self.extruder = CoalesceBenchExtruder()
+        self.move_pool = toolhead_module.MovePool()
+        self.coalescer = None
+        if tolerance:
+            self.coalescer = toolhead_module.MoveCoalescer(
+                self, tolerance, COALESCE_EXTRUDE_TOLERANCE)
+        self.steppers = None
+        if gen_steps:
+            self.steppers = CoalesceBenchSteppers()
+    def _process_moves(self, moves):
+        if self.steppers is not None:
+            self.steppers.process_moves(moves)
+        else:
+            self.results.extend([(m.start_pos, m.end_pos) for m in moves])
+        self.move_pool.release_moves(moves)
+
+COALESCE_EXTRUDE_TOLERANCE = .01
+
+# The cpu time used by this process (including its background threads)
+def get_cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def run_coalesce(toolhead_module, moves, tolerance, gen_steps=False):
+    th = CoalesceBenchToolHead(toolhead_module, tolerance, gen_steps)
+    mq = th.move_queue
+    pos = [0., 0., 0., 0.]
+    gc.collect()
+    start_time = get_cpu_time()
+    for newpos, speed in moves:
+        move = th.move_pool.get_move(th, pos, newpos, speed)
+        if not move.move_d:
+            th.move_pool.release_moves([move])
+            continue
+        pos = move.end_pos
+        if th.coalescer is not None:
+            move = th.coalescer.coalesce(move, speed)
+        mq.add_move(move)
+    mq.flush()
+    elapsed = get_cpu_time() - start_time
+    if th.steppers is not None:
+        th.steppers.close()
+    return elapsed, th.results
+
+# Report the lowest cpu time of several runs
+def time_coalesce(toolhead_module, moves, tolerance, gen_steps=False):
+    runs = [run_coalesce(toolhead_module, moves, tolerance, gen_steps)
+            for i in range(3)]
+    return min([elapsed for elapsed, results in runs]), runs[0][1]
+
+# Distance from a point to the line segment from 'start' to 'end'
+def calc_segment_dist(start, end, pos):
+    d = [end[i] - start[i] for i in (0, 1, 2)]
+    p = [pos[i] - start[i] for i in (0, 1, 2)]
+    dd = sum([v*v for v in d])
+    t = max(0., min(1., sum([d[i] * p[i] for i in (0, 1, 2)]) / dd))
+    return math.sqrt(sum([(p[i] - t * d[i])**2 for i in (0, 1, 2)]))
+
+def calc_move_dist(start, end):
+    return math.sqrt(sum([(end[i] - start[i])**2 for i in (0, 1, 2)]))
+
+# Check that the merged moves visit every original end position
+# (exactly) or pass within the tolerance of it.  Also find the largest
+# amount that the original path is longer than a merged move, and the
+# largest relative change in the extrusion rate (E per mm) of a move.
+# Returns None if the merged moves do not reach the original end
+# positions in order.
+def check_coalesce(orig_results, results):
+    max_dev = max_path_diff = max_extrude_diff = 0.
+    index = 0
+    for start_pos, end_pos in results:
+        merged_d = calc_move_dist(start_pos, end_pos)
+        path_d = 0.
+        while 1:
+            if index >= len(orig_results):
+                return None
+            orig_start, orig_end = orig_results[index]
+            index += 1
+            orig_d = calc_move_dist(orig_start, orig_end)
+            path_d += orig_d
+            if orig_d and merged_d:
+                orig_r = (orig_end[3] - orig_start[3]) / orig_d
+                merged_r = (end_pos[3] - start_pos[3]) / merged_d
+                if orig_r != merged_r:
+                    max_extrude_diff = max(max_extrude_diff, abs(
+                        (merged_r - orig_r) / (orig_r or merged_r)))
+            if orig_end == end_pos:
+                break
+            max_dev = max(max_dev, calc_segment_dist(start_pos, end_pos,
+                                                     orig_end))
+        max_path_diff = max(max_path_diff, path_d - merged_d)
+    if index != len(orig_results):
+        return None
+    return max_dev, max_path_diff, max_extrude_diff
+
+# Moves that double back on themselves (which must not be merged)
+def gen_reversal_moves(count, speed=100.):
+    moves = []
+    x = e = 0.
+    for i in range(count):
+        # Alternate between moving forward and back, and between
+        # folding back (10, 9, 20, 19, ...) and reversing onto the
+        # earlier path (10, 1, 11, 2, ...) - all at the same
+        # extrusion rate
+        if i & 1:
+            dist = 1. if i & 2 else 9.
+            x -= dist
+        else:
+            dist = 10. if i & 2 else 11.
+            x += dist
+        e += dist * .03
+        moves.append(([x, 100., .3, e], speed))
+    return moves
+
+def bench_coalesce(options, args):
+    import toolhead
+    if args:
+        tests = [(args[0], get_test_moves(args, options.count))]
+    else:
+        tests = [("segments", gen_segment_moves(options.count)),
+                 ("reversals", gen_reversal_moves(min(options.count, 20000)))]
+    for name, moves in tests:
+        print("%s:" % (name,))
+        elapsed, orig_results = time_coalesce(toolhead, moves, 0.)
+        steps_elapsed = time_coalesce(toolhead, moves, 0., True)[0]
+        print("tolerance=%-6s %8d moves: %.0f moves/s"
+              " (%.0f moves/s with step generation)" % (
+                  "none", len(orig_results), len(moves) / elapsed,
+                  len(moves) / steps_elapsed))
+        for tolerance in [.001, .005, .010, .050]:
+            elapsed, results = time_coalesce(toolhead, moves, tolerance)
+            steps_elapsed = time_coalesce(toolhead, moves, tolerance,
+                                          True)[0]
+            check = check_coalesce(orig_results, results)
+            print("tolerance=%-6.3f %8d moves: %.0f moves/s"
+                  " (%.0f moves/s with step generation)" % (
+                      tolerance, len(results), len(moves) / elapsed,
+                      len(moves) / steps_elapsed))
+            if check is None:
+                print("ERROR: merged moves do not match original end"
+                      " positions")
+                continue
+            max_dev, max_path_diff, max_extrude_diff = check
+            print("  max deviation %.6f, max path length difference %.6f,"
+                  " max extrusion rate difference %.4f" % (
+                      max_dev, max_path_diff, max_extrude_diff))
+            if max_dev > tolerance:
+                print("ERROR: merged moves exceed tolerance")
+            if max_path_diff > 2. * tolerance:
+                print("ERROR: merged moves shorten the path")
+            if max_extrude_diff > 2. * COALESCE_EXTRUDE_TOLERANCE:
+                print("ERROR: merged moves change the extrusion rate")
+
+
+######################################################################
+# Bed mesh move splitting benchmark
+######################################################################
+
+class BenchConfig:
+    def __init__(self, options={}):
+        self.options = options
+    def getfloat(self, option, default=None, **kw):
+        return self.options.get(option, default)
+
+class BenchGCode:
+    error = Exception
+
+def get_bench_mesh(bed_mesh, probe_count=7, pps=3):
+    params = {'min_x': 10., 'max_x': 190., 'min_y': 10., 'max_y': 190.,
+              'x_count': probe_count, 'y_count': probe_count,
+              'mesh_x_pps': pps, 'mesh_y_pps': pps, 'algo': 'bicubic',
+              'tension': .2}
+    z_matrix = [[.2 * math.sin(x * .9) * math.cos(y * .7)
+                 for x in range(probe_count)] for y in range(probe_count)]
+    z_mesh = bed_mesh.ZMesh(params)
+    z_mesh.build_mesh(z_matrix)
+    return z_mesh
+
+# Generate a series of long travel moves across the bed
+def gen_travel_moves(count, speed=200.):
+    moves = []
+    for i in range(count):
+        a = i * 2.39996
+        moves.append(([100. + 95. * math.cos(a), 100. + 95. * math.sin(a),
+                       0.3, 0.], speed))
+    return moves
+
+def run_mesh_split(splitter, moves):
+    pos = [0., 0., 0.3, 0.]
+    out = []
+    start_time = time.time()
+    for newpos, speed in moves:
+        if splitter is None:
+            out.append(newpos)
+            continue
+        splitter.build_move(pos, newpos, 1.)
+        while not splitter.traverse_complete:
+            out.append(list(splitter.split()))
+        pos = newpos
+    return time.time() - start_time, out
+
+# Maximum difference between the split moves and the mesh (sampled
+# every 0.5mm along the moves)
+def check_mesh_split(z_mesh, out):
+    max_err = 0.
+    for prev_pos, next_pos in zip(out[:-1], out[1:]):
+        move_d = math.sqrt((next_pos[0] - prev_pos[0])**2
+                           + (next_pos[1] - prev_pos[1])**2)
+        steps = max(1, int(move_d / .5))
+        for i in range(steps + 1):
+            t = float(i) / steps
+            x = prev_pos[0] + (next_pos[0] - prev_pos[0]) * t
+            y = prev_pos[1] + (next_pos[1] - prev_pos[1]) * t
+            z = prev_pos[2] + (next_pos[2] - prev_pos[2]) * t
+            max_err = max(max_err, abs(z - .3 - z_mesh.calc_z(x, y)))
+    return max_err
+
+def bench_bed_mesh(options, args):
+    from extras import bed_mesh
+    moves = gen_travel_moves(min(options.count, 20000))
+    z_mesh = get_bench_mesh(bed_mesh)
+    elapsed, out = run_mesh_split(None, moves)
+    print("%-9s %8d moves in %.3fs: %.0f moves/s" % (
+        "disabled", len(moves), elapsed, len(moves) / elapsed))
+    for name, splitter_class in sorted(bed_mesh.SplitMethods.items()):
+        splitter = splitter_class(BenchConfig(), BenchGCode())
+        splitter.initialize(z_mesh)
+        elapsed, out = run_mesh_split(splitter, moves)
+        max_err = check_mesh_split(z_mesh, out[:20000])
+        print("%-9s %8d moves in %.3fs: %.0f moves/s"
+              " (%d split moves, max z error %.4f)" % (
+                  name, len(moves), elapsed, len(moves) / elapsed,
+                  len(out), max_err))
+
+def get_bench_mesh_params(probe_count, pps, algo):
+    return {'min_x': 10., 'max_x': 190., 'min_y': 10., 'max_y': 190.,
+            'x_count': probe_count, 'y_count': probe_count,
+            'mesh_x_pps': pps, 'mesh_y_pps': pps, 'algo': algo,
+            'tension': .2}
+
+# Build (and offset, as is done when a profile is loaded) a mesh
+def run_mesh_build(bed_mesh, params, z_matrix, use_numpy, count):
+    start_time = time.time()
+    for i in range(count):
+        z_mesh = bed_mesh.ZMesh(params)
+        if not use_numpy:
+            z_mesh.numpy = None
+        z_mesh.build_mesh(z_matrix)
+        z_mesh.offset_mesh(z_mesh.avg_z)
+    elapsed = time.time() - start_time
+    return elapsed, (z_mesh.mesh_matrix, z_mesh.cell_table, z_mesh.avg_z,
+                     z_mesh.get_z_range())
+
+def bench_mesh_build(options, args):
+    from extras import bed_mesh
+    logging.getLogger().setLevel(logging.WARNING)
+    probe_counts = [int(a) for a in args] or [4, 5, 6, 7, 9, 15]
+    impls = [("python", False)]
+    try:
+        importlib.import_module('numpy')
+        impls.append(("numpy", True))
+    except ImportError:
+        print("numpy not available - only timing python implementation")
+    for algo in ['lagrange', 'bicubic']:
+        for probe_count in probe_counts:
+            if ((algo == 'lagrange' and probe_count > 6)
+                or (algo == 'bicubic' and probe_count < 4)):
+                continue
+            params = get_bench_mesh_params(probe_count, 3, algo)
+            z_matrix = [[.2 * math.sin(x * .9) * math.cos(y * .7)
+                         for x in range(probe_count)]
+                        for y in range(probe_count)]
+            count = max(1, min(options.count, 200000) // probe_count**3)
+            results = []
+            for name, use_numpy in impls:
+                elapsed, res = run_mesh_build(bed_mesh, params, z_matrix,
+                                              use_numpy, count)
+                results.append(res)
+                print("%-8s %2dx%-2d %-6s %6d meshes in %.3fs:"
+                      " %8.1f meshes/s" % (
+                          algo, probe_count, probe_count, name, count,
+                          elapsed, count / elapsed))
+            if any(res != results[0] for res in results[1:]):
+                print("ERROR: implementations do not produce identical mesh")
+
+
+######################################################################
+# G-Code parsing benchmark
+######################################################################
+
+class BenchReactor:
+    def mutex(self):
+        return None
+
+class BenchPrinter:
+    command_error = config_error = Exception
+    def __init__(self):
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return BenchReactor()
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def load_object(self, config, section):
+        if section not in self.objects:
+            mod = importlib.import_module('extras.' + section)
+            self.objects[section] = mod.load_config(config.getsection(section))
+        return self.objects[section]
+    def get_printer(self):
+        return self
+
+def get_gcode_lines(args, count):
+    if args:
+        f = open(args[0], 'rb')
+        data = f.read()
+        f.close()
+        return data.split('\n')
+    return ["G1 X%.3f Y%.3f E%.5f" % (newpos[0], newpos[1], newpos[3])
+            for newpos, speed in gen_segment_moves(count)]
+
+def run_gcode(lines, use_fast):
+    import gcode
+    from extras import gcode_move
+    printer = BenchPrinter()
+    gd = printer.objects['gcode'] = gcode.GCodeDispatch(printer)
+    gm = gcode_move.GCodeMove(printer)
+    moves = []
+    gm.move_with_transform = (lambda pos, speed: moves.append(list(pos)))
+    # Don't attempt to home the (non-existent) printer
+    gd.ready_gcode_handlers['G28'] = (lambda gcmd: None)
+    if not use_fast:
+        gd.ready_fast_handlers.clear()
+    gd._handle_ready()
+    del moves[:]
+    start_time = time.time()
+    for i in range(0, len(lines), 100):
+        gd._process_commands(lines[i:i+100])
+    return time.time() - start_time, moves
+
+def bench_gcode(options, args):
+    # Errors from unsupported commands are not of interest
+    logging.disable(logging.CRITICAL)
+    lines = get_gcode_lines(args, options.count)
+    results = {}
+    for name, use_fast in [("parser", False), ("fast", True)]:
+        run_gcode(lines[:1000], use_fast)
+        elapsed, results[name] = run_gcode(lines, use_fast)
+        print("%-8s %8d lines in %.3fs: %.0f lines/s (%d moves)" % (
+            name, len(lines), elapsed, len(lines) / elapsed,
+            len(results[name])))
+    if results["fast"] != results["parser"]:
+        print("ERROR: fast path results differ from regular parser")
+
+
+######################################################################
+# Move transform benchmark
+######################################################################
+
+class BenchTransformToolHead:
+    def __init__(self):
+        self.moves = []
+    def move(self, newpos, speed):
+        self.moves.append(list(newpos))
+    def get_position(self):
+        if self.moves:
+            return list(self.moves[-1])
+        return [0., 0., 0., 0.]
+
+BENCH_TRANSFORM_CONFIGS = {
+    'skew+tilt': """
+[skew_correction]
+[bed_tilt]
+x_adjust: .002
+y_adjust: -.001
+z_adjust: .1
+""",
+    'skew+mesh': """
+[skew_correction]
+[bed_mesh]
+mesh_min: 10,10
+mesh_max: 190,190
+probe_count: 7
+mesh_pps: 3
+algorithm: bicubic
+split_method: cell
+fade_start: 1
+fade_end: 10
+""",
+}
+
+def setup_transforms(config_data):
+    import ConfigParser, StringIO, configfile, gcode
+    from extras import bed_mesh
+    fileconfig = ConfigParser.RawConfigParser()
+    fileconfig.readfp(StringIO.StringIO(config_data))
+    printer = BenchPrinter()
+    printer.objects['gcode'] = gcode.GCodeDispatch(printer)
+    toolhead = printer.objects['toolhead'] = BenchTransformToolHead()
+    config = configfile.ConfigWrapper(printer, fileconfig, {}, 'printer')
+    for section in fileconfig.sections():
+        printer.load_object(config, section)
+    printer.send_event("klippy:connect")
+    printer.send_event("klippy:ready")
+    printer.objects['skew_correction']._update_skew(.002, .001, .0015)
+    if 'bed_mesh' in printer.objects:
+        printer.objects['bed_mesh'].set_mesh(get_bench_mesh(bed_mesh))
+    return printer.objects['gcode_move'], toolhead
+
+def run_transforms(gcode_move, toolhead, moves, use_fused):
+    del toolhead.moves[:]
+    gcode_move.reset_last_position()
+    move_with_transform = gcode_move.move_transform.move
+    if use_fused:
+        move_with_transform = gcode_move.move_with_transform
+    start_time = time.time()
+    for newpos, speed in moves:
+        move_with_transform(newpos, speed)
+    return time.time() - start_time, list(toolhead.moves)
+
+def bench_transform(options, args):
+    moves = [([x, y, .3 + i * .00001, e], speed)
+             for i, ([x, y, z, e], speed) in enumerate(
+                     get_test_moves(args, options.count))]
+    for name, config_data in sorted(BENCH_TRANSFORM_CONFIGS.items()):
+        gcode_move, toolhead = setup_transforms(config_data)
+        results = {}
+        for use_fused in [False, True]:
+            elapsed, results[use_fused] = run_transforms(
+                gcode_move, toolhead, moves, use_fused)
+            print("%-9s %-6s %8d moves in %.3fs: %.0f moves/s"
+                  " (%d toolhead moves)" % (
+                      name, ["python", "fused"][use_fused], len(moves),
+                      elapsed, len(moves) / elapsed,
+                      len(results[use_fused])))
+        python_res, fused_res = results[False], results[True]
+        if len(python_res) != len(fused_res):
+            print("ERROR: fused transform results differ from python")
+            continue
+        max_diff = max([abs(a - b) for p1, p2 in zip(python_res, fused_res)
+                        for a, b in zip(p1, p2)])
+        if max_diff > .000000001:
+            print("ERROR: fused transform results differ from python"
+                  " (max difference %.9f)" % (max_diff,))
+
+
+######################################################################
+# Accelerometer data decoding benchmark
+######################################################################
+
+# Generate synthetic adxl345 bulk data messages (8 samples per message)
+def get_bench_accel_results(adxl345, count):
+    import struct
+    raw_samples = []
+    msg_count = max(1, count // 8)
+    for seq in range(msg_count):
+        if seq % 1000 == 999:
+            # Simulate a dropped message
+            continue
+        vals = [int(2000. * math.sin((seq * 8 + i // 3) * (.01 + .003 * j)))
+                for i in range(24) for j in [i % 3]]
+        raw_samples.append((seq, struct.pack('<24h', *vals)))
+    axes_map = [(0, adxl345.SCALE), (2, -adxl345.SCALE), (1, adxl345.SCALE)]
+    total_time = msg_count * 8 / 3200.
+    results = adxl345.ADXL345Results()
+    results.setup_data(axes_map, raw_samples, msg_count, 0,
+                       100., 100.001, 100. + total_time,
+                       100.001 + total_time)
+    return results
+
+def bench_adxl345(options, args):
+    from extras import adxl345
+    try:
+        np = importlib.import_module('numpy')
+    except ImportError:
+        print("The adxl345 benchmark requires numpy")
+        return
+    results = get_bench_accel_results(adxl345, options.count)
+    # Time storing the messages as they arrive from the mcu
+    raw_samples = results.raw_samples
+    stored = []
+    def store_list(sequence, data):
+        # The list storage used before the capture buffer
+        if len(stored) >= 300000:
+            return
+        stored.append((sequence, data))
+    start_time = time.time()
+    for sequence, data in raw_samples:
+        store_list(sequence, data)
+    list_time = time.time() - start_time
+    store_results = [("list", list_time, sys.getsizeof(stored) + sum(
+        [sys.getsizeof(m) + sys.getsizeof(m[1]) for m in stored]))]
+    max_messages = len(raw_samples)
+    for name, ring_buffer in [("buffer", False), ("ring", True)]:
+        if ring_buffer:
+            # Keep a quarter of the messages to exercise discarding
+            max_messages = max(1, len(raw_samples) // 4)
+        capture = adxl345.AccelCaptureBuffer(max_messages, ring_buffer)
+        start_time = time.time()
+        for sequence, data in raw_samples:
+            capture.add_message(sequence, data)
+        elapsed = time.time() - start_time
+        chunks, pending_index, pending = capture.state
+        size = sum([sys.getsizeof(chunk) + sum(map(sys.getsizeof, chunk))
+                    for chunk in chunks])
+        size += sys.getsizeof(pending) + sum(
+            [sys.getsizeof(m) + sys.getsizeof(m[1]) for m in pending])
+        store_results.append((name, elapsed, size))
+        messages = capture.get_messages()
+        expected = raw_samples
+        if ring_buffer:
+            expected = raw_samples[len(raw_samples) - len(messages):]
+            if len(messages) < max_messages:
+                print("ERROR: ring buffer discarded too many messages")
+        if messages != expected:
+            print("ERROR: %s messages do not match" % (name,))
+    for name, elapsed, size in store_results:
+        print("%-6s store  %8d messages in %.3fs: %.0f messages/s"
+              " (%d bytes)" % (name, len(raw_samples), elapsed,
+                               len(raw_samples) / elapsed, size))
+    # Time decoding the samples
+    start_time = time.time()
+    samples = np.array(results.decode_samples())
+    list_time = time.time() - start_time
+    start_time = time.time()
+    data = results.decode_samples_array(np)
+    array_time = time.time() - start_time
+    for name, elapsed in [("list", list_time), ("array", array_time)]:
+        print("%-6s decode %8d samples in %.3fs: %.0f samples/s" % (
+            name, data.shape[0], elapsed, data.shape[0] / elapsed))
+    if not np.array_equal(samples, data):
+        print("ERROR: decoded samples do not match")
+    # Time writing the samples to a file
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for raw_format in adxl345.RAW_FORMATS:
+            filename = os.path.join(tmpdir, "bench." + raw_format)
+            start_time = time.time()
+            if raw_format == 'npz':
+                results._write_npz(filename, np)
+            else:
+                results._write_csv(filename)
+            elapsed = time.time() - start_time
+            print("%-6s write  %8d samples in %.3fs: %.0f samples/s"
+                  " (%d bytes)" % (raw_format, data.shape[0], elapsed,
+                                   data.shape[0] / elapsed,
+                                   os.path.getsize(filename)))
+        npz = np.load(os.path.join(tmpdir, "bench.npz"))
+        if not np.array_equal(
+                np.column_stack((npz['time'], npz['accel'] * npz['scale'])),
+                data):
+            print("ERROR: npz file does not match decoded samples")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class BenchAccelChip:
+    def __init__(self, adxl345, results):
+        self.query_rate = 3200
+        self.axes_map = results.axes_map
+        self.capture = adxl345.AccelCaptureBuffer(len(results.raw_samples))
+        self.capture.reset()
+
+def bench_stream_psd(options, args):
+    from extras import adxl345, shaper_calibrate
+    try:
+        np = importlib.import_module('numpy')
+    except ImportError:
+        print("The stream_psd benchmark requires numpy")
+        return
+    results = get_bench_accel_results(adxl345, options.count)
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    start_time = time.time()
+    batch_data = helper.calc_freq_response(results)
+    batch_time = time.time() - start_time
+    # Feed the messages as they would arrive during a measurement
+    # (processing them, and discarding the processed messages, as done
+    # by the adxl345 data callbacks)
+    chip = BenchAccelChip(adxl345, results)
+    reader = adxl345.AccelSampleReader(chip, np)
+    estimator = shaper_calibrate.FreqResponseEstimator(helper, reader.rate)
+    stream_time = 0.
+    for i, (sequence, data) in enumerate(results.raw_samples):
+        chip.capture.add_message(sequence, data)
+        if i % adxl345.DATA_CALLBACK_MESSAGES == 0:
+            start_time = time.time()
+            accel = reader.read_samples()
+            if accel is not None:
+                estimator.add_samples(accel)
+            reader.discard_samples()
+            stream_time += time.time() - start_time
+    start_time = time.time()
+    accel = reader.read_samples()
+    if accel is not None:
+        estimator.add_samples(accel)
+    stream_data = estimator.get_calibration_data(
+        reader.get_sampling_freq(results, estimator.sample_count))
+    final_time = time.time() - start_time
+    count = estimator.sample_count
+    print("batch  %8d samples in %.3fs: %.0f samples/s" % (
+        count, batch_time, count / batch_time))
+    print("stream %8d samples in %.3fs: %.0f samples/s"
+          " (%.6fs after the measurement, %d messages kept)" % (
+              count, stream_time + final_time,
+              count / (stream_time + final_time), final_time,
+              chip.capture.stored_count))
+    max_err = max([abs(getattr(stream_data, name)
+                       - getattr(batch_data, name)).max()
+                   / abs(getattr(batch_data, name)).max()
+                   for name in ['psd_x', 'psd_y', 'psd_z', 'psd_sum']])
+    print("Maximum relative difference %.3g" % (max_err,))
+    if not np.array_equal(stream_data.freq_bins, batch_data.freq_bins):
+        print("ERROR: frequency bins do not match")
+    elif max_err > 1e-9:
+        print("ERROR: frequency responses do not match")
+
+
+######################################################################
+# Resonance test vibration sweep benchmark
+######################################################################
+
+class SweepBenchGCode:
+    def __init__(self, gcode_module):
+        self.gcode_module = gcode_module
+    def respond_info(self, msg, log=True):
+        pass
+    def respond_raw(self, msg):
+        pass
+    def create_gcode_command(self, command, commandline, params):
+        return self.gcode_module.GCodeCommand(self, command, commandline,
+                                              params, False)
+
+class SweepBenchToolHead(BenchToolHead):
+    def __init__(self, toolhead_module, max_accel, record):
+        BenchToolHead.__init__(self, toolhead_module.MoveQueue, max_accel)
+        self.toolhead_module = toolhead_module
+        self.requested_accel_to_decel = max_accel
+        self.commanded_pos = [100., 100., 10., 0.]
+        self.print_time = 0.
+        self.segments = []
+        # Either record the segments or queue them in a real trapq
+        self.trapq = None
+        if not record:
+            import chelper
+            ffi_main, ffi_lib = chelper.get_ffi()
+            self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+            self.trapq_append = ffi_lib.trapq_append
+            self.trapq_free_moves = ffi_lib.trapq_free_moves
+    def get_position(self):
+        return list(self.commanded_pos)
+    def get_max_velocity(self):
+        return self.max_velocity, self.max_accel
+    def cmd_M204(self, gcmd):
+        self.max_accel = gcmd.get_float('S', above=0.)
+        self.max_accel_to_decel = min(self.requested_accel_to_decel,
+                                      self.max_accel)
+        self.junction_deviation = 25. * (math.sqrt(2.) - 1.) / self.max_accel
+    def check_move(self, newpos):
+        pass
+    def check_trapq_move(self, start_pos, end_pos, speed, accel):
+        move = self.toolhead_module.Move(self, start_pos, end_pos, speed)
+        return math.sqrt(move.max_cruise_v2), min(accel, move.accel)
+    def move(self, newpos, speed):
+        move = self.toolhead_module.Move(self, self.commanded_pos, newpos,
+                                         speed)
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+    def trapq_append(self, trapq, print_time, *params):
+        self.segments.append((print_time,) + params)
+    def trapq_free_moves(self, trapq, print_time):
+        pass
+    def _process_moves(self, moves):
+        for m in moves:
+            self.trapq_append(self.trapq, self.print_time,
+                              m.accel_t, m.cruise_t, m.decel_t,
+                              m.start_pos[0], m.start_pos[1], m.start_pos[2],
+                              m.axes_r[0], m.axes_r[1], m.axes_r[2],
+                              m.start_v, m.cruise_v, m.accel)
+            self.print_time += m.accel_t + m.cruise_t + m.decel_t
+        self.trapq_free_moves(self.trapq, self.print_time)
+    def queue_trapq_moves(self, gen_moves):
+        self.move_queue.flush()
+        self.print_time = gen_moves(self.trapq, self.print_time)
+        self.trapq_free_moves(self.trapq, self.print_time)
+
+# The vibration generation of VibrationPulseTest.run_test() prior to the
+# introduction of VibrationSweep (a toolhead move per quarter-period)
+def run_legacy_sweep(gcode, toolhead, vib_dir, test):
+    freq_start, freq_end, accel_per_hz, hz_per_sec = test
+    X, Y, Z, E = toolhead.get_position()
+    sign = 1.
+    freq = freq_start
+    _, max_accel = toolhead.get_max_velocity()
+    max_call_time = 0.
+    while freq <= freq_end + 0.000001:
+        start_time = time.time()
+        t_seg = .25 / freq
+        accel = min(accel_per_hz * freq, max_accel)
+        V = accel * t_seg
+        toolhead.cmd_M204(gcode.create_gcode_command(
+            "M204", "M204", {"S": accel}))
+        L = .5 * accel * t_seg**2
+        nX = X + sign * vib_dir[0] * L
+        nY = Y + sign * vib_dir[1] * L
+        toolhead.move([nX, nY, Z, E], V)
+        toolhead.move([X, Y, Z, E], V)
+        sign = -sign
+        freq += 2. * t_seg * hz_per_sec
+        max_call_time = max(max_call_time, time.time() - start_time)
+    start_time = time.time()
+    toolhead.move_queue.flush()
+    return max(max_call_time, time.time() - start_time)
+
+def run_sweep(resonance_tester, toolhead, vib_dir, test):
+    sweep = resonance_tester.VibrationSweep(toolhead, vib_dir, *test)
+    sweep.trapq_append = toolhead.trapq_append
+    max_call_time = 0.
+    while not sweep.is_finished():
+        start_time = time.time()
+        toolhead.queue_trapq_moves(sweep.generate_moves)
+        max_call_time = max(max_call_time, time.time() - start_time)
+    return max_call_time
+
+# Calculate the toolhead position (along the x and y axes) at regular
+# intervals from a list of trapq segments
+def sample_segments(segments, interval=.0005):
+    positions = []
+    t = 0.
+    for seg in segments:
+        (print_time, accel_t, cruise_t, decel_t, start_x, start_y, start_z,
+         axis_x, axis_y, axis_z, start_v, cruise_v, accel) = seg
+        accel_d = (start_v + cruise_v) * .5 * accel_t
+        cruise_d = cruise_v * cruise_t
+        end_time = print_time + accel_t + cruise_t + decel_t
+        while t < end_time:
+            move_t = t - print_time
+            if move_t < accel_t:
+                d = (start_v + .5 * accel * move_t) * move_t
+            elif move_t < accel_t + cruise_t:
+                d = accel_d + cruise_v * (move_t - accel_t)
+            else:
+                move_t -= accel_t + cruise_t
+                d = (accel_d + cruise_d
+                     + (cruise_v - .5 * accel * move_t) * move_t)
+            positions.append((start_x + axis_x * d, start_y + axis_y * d))
+            t += interval
+    return positions
+
+def bench_sweep(options, args):
+    import toolhead, gcode
+    from extras import resonance_tester
+    # Default [resonance_tester] test with a max_accel of 7000
+    test = (5., 120., 75., 1.)
+    max_accel = 7000.
+    vib_dir = (1, 0)
+    results = {}
+    for name in ['moves', 'sweep']:
+        for record in [False, True]:
+            th = SweepBenchToolHead(toolhead, max_accel, record)
+            gc.collect()
+            start_time = time.time()
+            if name == 'moves':
+                max_call_time = run_legacy_sweep(SweepBenchGCode(gcode), th,
+                                                 vib_dir, test)
+            else:
+                max_call_time = run_sweep(resonance_tester, th, vib_dir,
+                                          test)
+            elapsed = time.time() - start_time
+            if record:
+                results[name] = th.segments
+                continue
+            print("%-5s %.1fs of vibrations in %.3fs: %.2f%% cpu"
+                  " (max %.3fms per call)" % (
+                      name, th.print_time, elapsed,
+                      100. * elapsed / th.print_time, 1000. * max_call_time))
+    moves_pos = sample_segments(results['moves'])
+    sweep_pos = sample_segments(results['sweep'])
+    max_diff = max([max(abs(mx - sx), abs(my - sy))
+                    for (mx, my), (sx, sy) in zip(moves_pos, sweep_pos)])
+    end_diff = (results['sweep'][-1][0] - results['moves'][-1][0])
+    print("Maximum position difference %.3gmm (end time difference %.3gs)"
+          % (max_diff, end_diff))
+    if max_diff > .000001:
+        print("ERROR: vibration sweeps do not match")
+
+
+######################################################################
+# Webhooks status subscription benchmark
+######################################################################
+
+# An object whose status changes on every update (eg, a heater)
+class StatusBenchDynamic:
+    def get_status(self, eventtime):
+        return {'temperature': 200. + math.sin(eventtime), 'target': 200.,
+                'power': .5 + .1 * math.cos(eventtime)}
+
+# An object with a large status that rarely changes (eg, a bed mesh)
+class StatusBenchStatic:
+    def __init__(self, index):
+        self.matrix = [[.01 * (x + y + index) for x in range(7)]
+                       for y in range(7)]
+        self.names = dict(('option_%d' % (i,), str(i)) for i in range(20))
+    def get_status(self, eventtime):
+        return {'profile_name': 'default', 'mesh_matrix': self.matrix,
+                'settings': dict(self.names)}
+
+class StatusBenchStaticVersion(StatusBenchStatic):
+    def get_status_version(self):
+        return 0
+
+class StatusBenchWebHooks:
+    def register_endpoint(self, path, callback):
+        pass
+
+class StatusBenchClient:
+    def __init__(self, webhooks):
+        self.encode_message = webhooks.encode_message
+        self.sent = 0
+    def is_closed(self):
+        return False
+    def send(self, data):
+        self.send_encoded(self.encode_message(data))
+    def send_encoded(self, msg):
+        self.sent += len(msg)
+    def send_status(self, data, msg=None):
+        if msg is None:
+            msg = self.encode_message(data)
+        self.send_encoded(msg)
+
+def run_status_ticks(webhooks, object_count, client_count, use_versions,
+                     share_updates, ticks=100):
+    printer = BenchPrinter()
+    printer.objects['webhooks'] = StatusBenchWebHooks()
+    static_class = StatusBenchStatic
+    if use_versions:
+        static_class = StatusBenchStaticVersion
+    # One in four objects has a status that changes on every update
+    names = []
+    for i in range(object_count):
+        name = 'object_%d' % (i,)
+        if i % 4:
+            printer.objects[name] = static_class(i)
+        else:
+            printer.objects[name] = StatusBenchDynamic()
+        names.append(name)
+    qsh = webhooks.QueryStatusHelper(printer)
+    clients = [StatusBenchClient(webhooks) for i in range(client_count)]
+    for client in clients:
+        subscription = dict((name, None) for name in names)
+        qsh.clients[client] = (client, subscription, client.send_status, {},
+                               None)
+    qsh._do_query(0.)
+    if share_updates:
+        for client, subscription, send_func, template, s in list(
+                qsh.clients.values()):
+            signature = qsh._get_signature(subscription, template)
+            qsh.clients[client] = (client, subscription, send_func, template,
+                                   signature)
+    start_time = time.time()
+    for i in range(ticks):
+        qsh._do_query(webhooks.SUBSCRIPTION_REFRESH_TIME * (i + 1))
+    elapsed = time.time() - start_time
+    return elapsed / ticks, sum([c.sent for c in clients]) / ticks
+
+def bench_status(options, args):
+    import webhooks
+    for object_count in [10, 40, 160]:
+        for client_count in [1, 4, 20]:
+            res = [run_status_ticks(webhooks, object_count, client_count,
+                                    use_versions, share_updates)
+                   for use_versions, share_updates in [
+                       (False, False), (True, False), (True, True)]]
+            print("%3d objects %2d clients: %.3fms per update"
+                  " (%.3fms with status versions, %.3fms also encoding"
+                  " once) %d bytes sent" % (
+                      object_count, client_count, 1000. * res[0][0],
+                      1000. * res[1][0], 1000. * res[2][0], res[2][1]))
+            if res[0][1] != res[1][1] or res[0][1] != res[2][1]:
+                print("ERROR: optimizations changed the sent updates")
+
+
+######################################################################
+# Webhooks client send queue benchmark
+######################################################################
+
+class SendQueueBenchPrinter:
+    def set_rollover_info(self, name, info, log=True):
+        pass
+
+class SendQueueBenchServer:
+    def __init__(self, reactor):
+        self.printer = SendQueueBenchPrinter()
+        self.webhooks = None
+        self.reactor = reactor
+    def pop_client(self, client_id):
+        pass
+
+def get_sendqueue_sockets():
+    sock, peer = socket.socketpair()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+    sock.setblocking(0)
+    peer.setblocking(0)
+    return sock, peer
+
+def recv_all(peer):
+    count = 0
+    try:
+        while 1:
+            count += len(peer.recv(65536))
+    except socket.error:
+        pass
+    return count
+
+# The original transmit buffer (a string that is sliced on each send)
+def run_legacy_drain(messages):
+    sock, peer = get_sendqueue_sockets()
+    start_time = time.time()
+    send_buffer = ""
+    for msg in messages:
+        send_buffer += msg
+    received = 0
+    while send_buffer:
+        try:
+            sent = sock.send(send_buffer)
+            send_buffer = send_buffer[sent:]
+        except socket.error:
+            pass
+        received += recv_all(peer)
+    received += recv_all(peer)
+    elapsed = time.time() - start_time
+    sock.close()
+    peer.close()
+    return elapsed, received
+
+def run_drain(reactor, webhooks, messages):
+    sock, peer = get_sendqueue_sockets()
+    cconn = webhooks.ClientConnection(SendQueueBenchServer(reactor), sock)
+    start_time = time.time()
+    for msg in messages:
+        cconn.send_encoded(msg)
+    received = 0
+    while cconn.send_queued:
+        cconn._do_send(0.)
+        received += recv_all(peer)
+    received += recv_all(peer)
+    elapsed = time.time() - start_time
+    cconn.close()
+    peer.close()
+    return elapsed, received
+
+# Status updates to a client that has stopped reading
+def run_stalled_client(reactor, webhooks, update_count, object_count):
+    sock, peer = get_sendqueue_sockets()
+    cconn = webhooks.ClientConnection(SendQueueBenchServer(reactor), sock)
+    status = dict(('object_%d' % (i,), {'temperature': 0., 'target': 200.,
+                                        'power': .5})
+                  for i in range(object_count))
+    for i in range(update_count):
+        for obj_status in status.values():
+            obj_status['temperature'] = float(i)
+        cconn.send_status({'params': {'eventtime': float(i),
+                                      'status': status}})
+        if not i % 100:
+            cconn._do_send(0.)
+    queued = cconn.send_queued
+    # Resume reading and check the final status was delivered
+    data = ""
+    while cconn.send_queued or cconn.pending_status is not None:
+        cconn._do_send(0.)
+        try:
+            while 1:
+                data += peer.recv(65536)
+        except socket.error:
+            pass
+    last = json.loads(data.split('\x03')[-2])
+    is_current = all([s['temperature'] == update_count - 1
+                      for s in last['params']['status'].values()])
+    coalesced = cconn.coalesced_updates
+    cconn.close()
+    peer.close()
+    return queued, coalesced, is_current
+
+def bench_sendqueue(options, args):
+    import reactor, webhooks
+    r = reactor.Reactor()
+    for msg_size in [256, 4096]:
+        for total_size in [256 * 1024, 1024 * 1024, 4 * 1024 * 1024]:
+            messages = [webhooks.encode_message({'x': 'x' * (msg_size - 12)})
+                        ] * (total_size // msg_size)
+            legacy_time, legacy_count = run_legacy_drain(messages)
+            drain_time, count = run_drain(r, webhooks, messages)
+            print("%4d byte messages %5dKiB backlog: legacy %.3fms"
+                  " queue %.3fms" % (
+                      msg_size, total_size // 1024, 1000. * legacy_time,
+                      1000. * drain_time))
+            if legacy_count != count:
+                print("ERROR: send queue changed the sent data")
+    for object_count in [10, 40, 160]:
+        queued, coalesced, is_current = run_stalled_client(
+            r, webhooks, 10000, object_count)
+        print("Stalled client %3d objects: %d bytes queued,"
+              " %d updates coalesced" % (object_count, queued, coalesced))
+        if not is_current:
+            print("ERROR: coalesced update not current")
+    r.finalize()
+
+
+######################################################################
+# Reactor timer dispatch benchmark
+######################################################################
+
+def run_reactor(reactor_class, timer_count, dispatch_count):
+    r = reactor_class()
+    # Timers that are registered but not due (eg, heaters, fans)
+    start_time = r.monotonic()
+    for i in range(timer_count):
+        r.register_timer((lambda eventtime: r.NEVER),
+                         start_time + 1000. + i * .001)
+    # A timer that continuously reschedules itself
+    lags = []
+    def busy_timer(eventtime):
+        lags.append(r.monotonic() - busy_timer.waketime)
+        if len(lags) >= dispatch_count:
+            r.end()
+            return r.NEVER
+        busy_timer.waketime = waketime = r.monotonic()
+        return waketime
+    busy_timer.waketime = r.monotonic()
+    r.register_timer(busy_timer, r.NOW)
+    start_time = time.time()
+    r.run()
+    elapsed = time.time() - start_time
+    r.finalize()
+    return elapsed, lags
+
+def bench_reactor(options, args):
+    import reactor
+    counts = [int(a) for a in args] or [0, 10, 100, 1000, 10000]
+    classes = [(name, getattr(reactor, name))
+               for name in ['SelectReactor', 'PollReactor', 'EPollReactor']
+               if hasattr(reactor, name)]
+    print("Default reactor: %s" % (reactor.Reactor.__name__,))
+    for name, reactor_class in classes:
+        for timer_count in counts:
+            dispatch_count = min(options.count, 100000)
+            elapsed, lags = run_reactor(reactor_class, timer_count,
+                                        dispatch_count)
+            lags.sort()
+            print("%-13s %6d timers: %8.0f dispatches/s"
+                  " (lag avg %.1fus, max %.1fus)" % (
+                      name, timer_count, dispatch_count / elapsed,
+                      sum(lags) / len(lags) * 1000000., lags[-1] * 1000000.))
+
+
+######################################################################
+# Reactor one-shot callback benchmark
+######################################################################
+
+# Run call_soon() callbacks via register_callback() (as was done prior
+# to the introduction of call_soon)
+def get_legacy_soon_reactor(reactor_class):
+    class LegacySoonReactor(reactor_class):
+        def call_soon(self, callback):
+            self.register_callback(callback)
+    return LegacySoonReactor
+
+def run_callbacks(reactor_class, timer_count, dispatch_count):
+    r = reactor_class()
+    start_time = r.monotonic()
+    for i in range(timer_count):
+        r.register_timer((lambda eventtime: r.NEVER),
+                         start_time + 1000. + i * .001)
+    # Every other callback queues two more callbacks
+    counts = [0]
+    def callback(eventtime):
+        counts[0] += 1
+        if counts[0] >= dispatch_count:
+            r.end()
+            return
+        if counts[0] & 1:
+            r.call_soon(callback)
+            r.call_soon(callback)
+    r.call_soon(callback)
+    start_time = time.time()
+    r.run()
+    elapsed = time.time() - start_time
+    r.finalize()
+    return elapsed
+
+class RequestBenchPrinter:
+    command_error = Exception
+    def set_rollover_info(self, name, info, log=True):
+        pass
+
+class RequestBenchWebHooks:
+    def get_callback(self, path):
+        return self._handle_request
+    def _handle_request(self, web_request):
+        web_request.send({'value': web_request.get_int('value')})
+
+class RequestBenchServer:
+    def __init__(self, reactor):
+        self.printer = RequestBenchPrinter()
+        self.webhooks = RequestBenchWebHooks()
+        self.reactor = reactor
+    def pop_client(self, client_id):
+        pass
+
+# Send api server requests (with up to 'window' requests in flight)
+# and wait for their responses
+def run_requests(reactor_class, webhooks, request_count, window=100):
+    r = reactor_class()
+    sock, peer = socket.socketpair()
+    sock.setblocking(0)
+    peer.setblocking(0)
+    cconn = webhooks.ClientConnection(RequestBenchServer(r), sock)
+    state = {'sent': 0, 'received': 0, 'data': ""}
+    def send_requests():
+        count = min(request_count - state['sent'],
+                    window - (state['sent'] - state['received']))
+        reqs = [json.dumps({'id': state['sent'] + i, 'method': 'bench',
+                            'params': {'value': i}}) + '\x03'
+                for i in range(count)]
+        peer.sendall("".join(reqs))
+        state['sent'] += count
+    def handle_responses(eventtime):
+        data = state['data'] + peer.recv(65536)
+        responses = data.split('\x03')
+        state['data'] = responses.pop()
+        state['received'] += len(responses)
+        if state['received'] >= request_count:
+            r.end()
+            return
+        send_requests()
+    fd_handle = r.register_fd(peer.fileno(), handle_responses)
+    send_requests()
+    start_time = time.time()
+    r.run()
+    elapsed = time.time() - start_time
+    r.unregister_fd(fd_handle)
+    cconn.close()
+    peer.close()
+    r.finalize()
+    return elapsed
+
+def bench_callbacks(options, args):
+    import reactor, webhooks
+    logging.getLogger().setLevel(logging.WARNING)
+    counts = [int(a) for a in args] or [0, 100, 1000]
+    reactor_class = reactor.Reactor
+    legacy_class = get_legacy_soon_reactor(reactor_class)
+    dispatch_count = min(options.count, 100000)
+    for timer_count in counts:
+        legacy_time = run_callbacks(legacy_class, timer_count, dispatch_count)
+        soon_time = run_callbacks(reactor_class, timer_count, dispatch_count)
+        print("%5d timers: %8.0f callbacks/s (%8.0f with call_soon)" % (
+            timer_count, dispatch_count / legacy_time,
+            dispatch_count / soon_time))
+    request_count = min(options.count, 20000)
+    legacy_time = run_requests(legacy_class, webhooks, request_count)
+    soon_time = run_requests(reactor_class, webhooks, request_count)
+    print("API server: %.0f requests/s (%.0f with call_soon)" % (
+        request_count / legacy_time, request_count / soon_time))
+
+
+######################################################################
+# Webhooks request decoding benchmark
+######################################################################
+
+# The original request decoding (a json object_hook that rebuilds
+# each dict and list)
+def legacy_byteify(data, ignore_dicts=False):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, list):
+        return [legacy_byteify(i, True) for i in data]
+    if isinstance(data, dict) and not ignore_dicts:
+        return {legacy_byteify(k, True): legacy_byteify(v, True)
+                for k, v in data.items()}
+    return data
+
+def get_bench_requests():
+    reqs = [("query", "objects/query",
+             {'objects': {'toolhead': ['position', 'status'],
+                          'webhooks': None}})]
+    for count in [10, 100]:
+        objects = dict(('object_%d' % (i,), ['temperature', 'target'])
+                       for i in range(count))
+        reqs.append(("subscribe %d" % (count,), "objects/subscribe",
+                     {'objects': objects, 'response_template': {}}))
+    for count in [1, 10, 100, 1000, 10000]:
+        script = "G1 X10.000 Y20.000 E0.5 F3000\n" * count
+        reqs.append(("script %d lines" % (count,), "gcode/script",
+                     {'script': script}))
+    return [(name, json.dumps({'id': 123, 'method': method,
+                               'params': params}))
+            for name, method, params in reqs]
+
+def check_decode(orig, res):
+    if type(orig) is not type(res):
+        return False
+    if type(orig) is dict:
+        return (sorted(orig.keys()) == sorted(res.keys())
+                and all([type(k) is str for k in res])
+                and all([check_decode(orig[k], res[k]) for k in orig]))
+    if type(orig) is list:
+        return (len(orig) == len(res)
+                and all([check_decode(o, r) for o, r in zip(orig, res)]))
+    return orig == res
+
+def run_decode(decode, data, count):
+    start_time = time.time()
+    for i in range(count):
+        decode(data)
+    return (time.time() - start_time) / count
+
+def bench_decode(options, args):
+    import webhooks
+    legacy_decode = (lambda data: json.loads(data,
+                                             object_hook=legacy_byteify))
+    for name, data in get_bench_requests():
+        count = max(10, min(options.count, 10000000 // len(data)))
+        legacy_time = run_decode(legacy_decode, data, count)
+        decode_time = run_decode(webhooks.decode_request, data, count)
+        print("%-18s %7d bytes: %8.0f requests/s (%8.0f with"
+              " decode_request)" % (name, len(data), 1. / legacy_time,
+                                    1. / decode_time))
+        if not check_decode(legacy_decode(data),
+                            webhooks.decode_request(data)):
+            print("ERROR: decode_request results differ")
+
+
+######################################################################
+# Message decoding benchmark
+######################################################################
+
+BenchMessages = {
+    "clock clock=%u": 20,
+    "stats count=%u sum=%u sumsq=%u": 21,
+    "analog_in_state oid=%c next_clock=%u value=%hu": 22,
+    "adxl345_data oid=%c sequence=%hu data=%*s": 23,
+    "shutdown clock=%u static_string_id=%hu": 24,
+    "endstop_state oid=%c homing=%c pin_value=%c": 25,
+}
+
+def get_bench_messages(args, count):
+    import msgproto, random
+    mp = msgproto.MessageParser()
+    if args:
+        f = open(args[0], 'rb')
+        mp.process_identify(f.read(), decompress=False)
+        f.close()
+    else:
+        mp._init_messages(BenchMessages)
+        mp.enumerations['static_string_id'] = {'Timer too close': 7}
+    formats = [mid for msgid, mid in sorted(mp.messages_by_id.items())
+               if isinstance(mid, msgproto.MessageFormat)]
+    rnd = random.Random(0)
+    msgs = []
+    for i in range(count):
+        mid = formats[i % len(formats)]
+        params = []
+        for name, t in mid.param_names:
+            if t.is_dynamic_string:
+                params.append(''.join([chr(rnd.randrange(256))
+                                       for j in range(rnd.randrange(10))]))
+            elif not t.is_int:
+                params.append(rnd.choice(t.enums.keys()))
+            elif t.max_length == 5:
+                params.append(rnd.randrange(-0x80000000, 0x80000000))
+            else:
+                params.append(rnd.randrange(1 << (7 * t.max_length - 7)))
+        cmd = mid.encode(params)
+        if len(cmd) > msgproto.MESSAGE_PAYLOAD_MAX:
+            continue
+        msgs.append(bytearray(mp.encode(i, ''.join(map(chr, cmd)))))
+    return mp, msgs
+
+def bench_msgproto(options, args):
+    import chelper
+    ffi_main, ffi_lib = chelper.get_ffi()
+    mp, msgs = get_bench_messages(args, options.count)
+    cmsgs = [ffi_main.new('uint8_t[]', bytes(msg)) for msg in msgs]
+    # Python parsing
+    start_time = time.time()
+    py_results = [mp.parse(cmsg[0:len(msg)]) for cmsg, msg in zip(cmsgs, msgs)]
+    elapsed = time.time() - start_time
+    print("python %8d messages in %.3fs: %.0f messages/s" % (
+        len(msgs), elapsed, len(msgs) / elapsed))
+    # C decoding
+    md = ffi_main.gc(ffi_lib.msgdecode_alloc(), ffi_lib.msgdecode_free)
+    for msgid, decode_types in mp.get_decode_formats():
+        ffi_lib.msgdecode_add_format(md, msgid, decode_types)
+    params = ffi_main.new('int64_t[64]')
+    start_time = time.time()
+    c_results = []
+    for cmsg, msg in zip(cmsgs, msgs):
+        count = ffi_lib.msgdecode_decode(md, cmsg, len(msg), params, 64)
+        c_results.append(mp.parse_decoded(cmsg, params[0:count]))
+    elapsed = time.time() - start_time
+    print("c      %8d messages in %.3fs: %.0f messages/s" % (
+        len(msgs), elapsed, len(msgs) / elapsed))
+    if c_results != py_results:
+        print("ERROR: C decoder results differ from python parser")
+
+
+######################################################################
+# Command submission benchmark
+######################################################################
+
+BenchCommands = {
+    "config_digital_out oid=%c pin=%u value=%c default_value=%c"
+    " max_duration=%u": 30,
+    "config_analog_in oid=%c pin=%u": 31,
+    "finalize_config crc=%u": 32,
+}
+
+def get_bench_config(count):
+    cmds = []
+    for i in range(count):
+        oid = i % 256
+        if i & 1:
+            cmds.append("config_analog_in oid=%d pin=%d" % (oid, i % 64))
+        else:
+            cmds.append("config_digital_out oid=%d pin=%d value=0"
+                        " default_value=0 max_duration=%d" % (
+                            oid, i % 64, i * 1000))
+    cmds.append("finalize_config crc=%d" % (count,))
+    return cmds
+
+def run_cmdbatch(serialhdl, dictionary, cmds, name):
+    # Returns the time to submit the commands and the time until the
+    # serial thread has written all of them out
+    import msgproto
+    rfd, wfd = os.pipe()
+    sr = serialhdl.SerialReader(None, os.devnull, 0)
+    sr.connect_file(os.fdopen(wfd, 'wb'), dictionary)
+    payload = sum([len(sr.msgparser.create_command(c)) for c in cmds])
+    start_time = time.time()
+    if name == 'batch':
+        sr.send_batch(cmds)
+    else:
+        for c in cmds:
+            sr.send(c)
+    submit_time = time.time()
+    # Read message blocks until all the command data has been written
+    data = ""
+    while payload > 0:
+        data += os.read(rfd, 65536)
+        while data and len(data) >= ord(data[0]):
+            msglen = ord(data[0])
+            payload -= msglen - msgproto.MESSAGE_MIN
+            data = data[msglen:]
+    end_time = time.time()
+    sr.disconnect()
+    os.close(rfd)
+    return submit_time - start_time, end_time - start_time
+
+def bench_cmdbatch(options, args):
+    import json, serialhdl
+    dictionary = json.dumps({'commands': BenchCommands, 'responses': {}})
+    counts = [int(a) for a in args] or [100, 200, 300, 1000]
+    for count in counts:
+        cmds = get_bench_config(count)
+        for name in ['single', 'batch']:
+            # Report the best of several runs (typical startups send
+            # only a few hundred commands)
+            submit = written = 999999999.
+            for i in range(10):
+                s, w = run_cmdbatch(serialhdl, dictionary, cmds, name)
+                submit = min(submit, s)
+                written = min(written, w)
+            print("%-6s %6d config commands: submitted in %.6fs"
+                  " (%8.0f commands/s), written in %.6fs" % (
+                      name, len(cmds), submit, len(cmds) / submit, written))
+
+
+######################################################################
+# Input shaper fitting benchmark
+######################################################################
+
+# Synthetic frequency response with two resonances
+def get_bench_calibration_data(shaper_calibrate, np):
+    freq_bins = np.fft.rfftfreq(2048, 1. / 3200.)
+    psd = (1e3 / (1. + ((freq_bins - 42.) / 4.)**2)
+           + 3e2 / (1. + ((freq_bins - 68.) / 6.)**2) + 10.)
+    calibration_data = shaper_calibrate.CalibrationData(
+        freq_bins, psd.copy(), psd * .6, psd * .3, psd * .1)
+    calibration_data.set_numpy(np)
+    calibration_data.normalize_to_frequencies()
+    return calibration_data
+
+# Fit a shaper one test frequency and damping ratio at a time
+def fit_shaper_serial(shaper_calibrate, np, shaper_cfg, calibration_data):
+    test_freqs = np.arange(shaper_cfg.min_freq,
+                           shaper_calibrate.MAX_SHAPER_FREQ, .2)
+    freq_bins = calibration_data.freq_bins
+    max_freq = shaper_calibrate.MAX_FREQ
+    psd = calibration_data.psd_sum[freq_bins <= max_freq]
+    freq_bins = freq_bins[freq_bins <= max_freq]
+    best = None
+    for test_freq in test_freqs[::-1]:
+        A, T = shaper_cfg.init_func(test_freq,
+                                    shaper_calibrate.SHAPER_DAMPING_RATIO)
+        A, T = np.array(A), np.array(T)
+        inv_D = 1. / A.sum()
+        cur_vibrations = 0.
+        shaper_vals = np.zeros(shape=freq_bins.shape)
+        for dr in shaper_calibrate.TEST_DAMPING_RATIOS:
+            omega = 2. * math.pi * freq_bins
+            damping = dr * omega
+            omega_d = omega * math.sqrt(1. - dr**2)
+            W = A * np.exp(np.outer(-damping, (T[-1] - T)))
+            S = W * np.sin(np.outer(omega_d, T))
+            C = W * np.cos(np.outer(omega_d, T))
+            vals = np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+            vibrations = (vals * psd).sum() / psd.sum()
+            shaper_vals = np.maximum(shaper_vals, vals)
+            if vibrations > cur_vibrations:
+                cur_vibrations = vibrations
+        if best is None or best[1] > cur_vibrations:
+            best = (test_freq, cur_vibrations, shaper_vals)
+    return best
+
+def bench_shaper_fit(options, args):
+    from extras import shaper_calibrate
+    try:
+        np = importlib.import_module('numpy')
+    except ImportError:
+        print("The shaper_fit benchmark requires numpy")
+        return
+    calibration_data = get_bench_calibration_data(shaper_calibrate, np)
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    serial_results = []
+    start_time = time.time()
+    for shaper_cfg in shaper_calibrate.INPUT_SHAPERS:
+        serial_results.append(fit_shaper_serial(
+            shaper_calibrate, np, shaper_cfg, calibration_data))
+    serial_time = time.time() - start_time
+    start_time = time.time()
+    batch_results = [helper.fit_shaper(shaper_cfg, calibration_data)
+                     for shaper_cfg in shaper_calibrate.INPUT_SHAPERS]
+    batch_time = time.time() - start_time
+    start_time = time.time()
+    best_shaper, best_freq, all_vals = helper.find_best_shaper(
+        calibration_data)
+    parallel_time = time.time() - start_time
+    count = len(shaper_calibrate.INPUT_SHAPERS)
+    for name, elapsed in [("serial", serial_time), ("batched", batch_time),
+                          ("parallel", parallel_time)]:
+        print("%-8s %d shapers fitted in %.3fs" % (name, count, elapsed))
+    print("Recommended shaper is %s @ %.1f Hz" % (best_shaper, best_freq))
+    for ref, res, (name, freq, vals) in zip(serial_results, batch_results,
+                                            all_vals):
+        if (ref[0] != res[0] or ref[1] != res[1]
+            or not np.array_equal(ref[2], res[2])
+            or freq != res[0] or not np.array_equal(vals, res[2])):
+            print("ERROR: shaper fitting results do not match")
+
+
+######################################################################
+# Startup
+######################################################################
+
+Benchmarks = {
+    'lookahead': bench_lookahead, 'lookahead_accel': bench_lookahead_accel,
+    'moves': bench_moves, 'coalesce': bench_coalesce, 'gcode': bench_gcode,
+    'bed_mesh': bench_bed_mesh, 'mesh_build': bench_mesh_build,
+    'transform': bench_transform,
+    'shaper_fit': bench_shaper_fit, 'adxl345': bench_adxl345,
+    'stream_psd': bench_stream_psd, 'sweep': bench_sweep,
+    'status': bench_status, 'sendqueue': bench_sendqueue,
+    'reactor': bench_reactor, 'callbacks': bench_callbacks,
+    'decode': bench_decode,
+    'msgproto': bench_msgproto,
+    'cmdbatch': bench_cmdbatch,
+}
+
+def main():
+    usage = "%prog [options] <benchmark> [args]\n\nBenchmarks: " + ", ".join(
+        sorted(Benchmarks))
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=100000,
+                    help="number of synthetic items to benchmark")
+    options, args = opts.parse_args()
+    if len(args) < 1 or args[0] not in Benchmarks:
+        opts.error("Incorrect number of arguments")
+    Benchmarks[args[0]](options, args[1:])
+
+if __name__ == '__main__':
+    main()
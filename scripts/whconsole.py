@@ -19,7 +19,7 @@ def webhook_socket_create(uds_filename):
         try:
             sock.connect(uds_filename)
         except socket.error as e:
-            if e.errno == errno.ECONNREFUSED:
+            if e.errno in (errno.ECONNREFUSED, errno.EAGAIN):
                 time.sleep(0.1)
                 continue
             sys.stderr.write("Unable to connect socket %s [%d,%s]\n"
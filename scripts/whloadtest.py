@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# Load test for webhooks status subscriptions
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, select, json, time, struct
+import whconsole
+
+# Obtain the process id of the server on the other end of a unix socket
+def get_peer_pid(sock):
+    SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize('3i'))
+    except socket.error:
+        return None
+    return struct.unpack('3i', creds)[0]
+
+# Return the user and system cpu time (in seconds) used by a process
+def get_process_cpu_time(pid):
+    try:
+        f = open("/proc/%d/stat" % (pid,), 'rb')
+        data = f.read()
+        f.close()
+    except (IOError, TypeError):
+        return None
+    parts = data.rsplit(')', 1)[1].split()
+    return (int(parts[11]) + int(parts[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+class LoadClient:
+    def __init__(self, uds_filename, client_id):
+        self.client_id = client_id
+        self.sock = whconsole.webhook_socket_create(uds_filename)
+        self.socket_data = ""
+        self.responses = {}
+        self.update_times = []
+        self.bytes_received = 0
+    def send_request(self, request_id, method, params):
+        msg = json.dumps({'id': request_id, 'method': method,
+                          'params': params}, separators=(',', ':'))
+        self.sock.sendall("%s\x03" % (msg,))
+    def process_socket(self, eventtime):
+        data = self.sock.recv(65536)
+        if not data:
+            sys.stderr.write("Client %d socket closed\n" % (self.client_id,))
+            sys.exit(-1)
+        self.bytes_received += len(data)
+        parts = data.split('\x03')
+        parts[0] = self.socket_data + parts[0]
+        self.socket_data = parts.pop()
+        for line in parts:
+            msg = json.loads(line)
+            if 'id' in msg:
+                self.responses[msg['id']] = msg
+            elif 'params' in msg:
+                self.update_times.append(
+                    (msg['params']['eventtime'], eventtime))
+
+class LoadTest:
+    def __init__(self, uds_filename, client_count):
+        self.clients = [LoadClient(uds_filename, i)
+                        for i in range(client_count)]
+        self.fd_to_client = {c.sock.fileno(): c for c in self.clients}
+        self.poll = select.poll()
+        for c in self.clients:
+            self.poll.register(c.sock, select.POLLIN | select.POLLHUP)
+        self.server_pid = get_peer_pid(self.clients[0].sock)
+    def run(self, duration):
+        end_time = time.time() + duration
+        while 1:
+            eventtime = time.time()
+            if eventtime >= end_time:
+                break
+            res = self.poll.poll(1000. * (end_time - eventtime))
+            eventtime = time.time()
+            for fd, event in res:
+                self.fd_to_client[fd].process_socket(eventtime)
+    def request(self, client, method, params):
+        request_id = len(client.responses) + 1
+        client.send_request(request_id, method, params)
+        while request_id not in client.responses:
+            self.run(.100)
+        msg = client.responses[request_id]
+        if 'error' in msg:
+            sys.stderr.write("Error on %s request: %s\n" % (
+                method, msg['error']))
+            sys.exit(-1)
+        return msg['result']
+    def subscribe(self, objects, distinct):
+        for c in self.clients:
+            template = {}
+            if distinct:
+                template = {'client': c.client_id}
+            c.send_request(-1, "objects/subscribe",
+                           {'objects': objects, 'response_template': template})
+        while any(-1 not in c.responses for c in self.clients):
+            self.run(.100)
+        for c in self.clients:
+            c.update_times = []
+            c.bytes_received = 0
+    def report(self, duration, cpu_time):
+        # Determine update rate, gaps, and the spread of each update's
+        # arrival time across the clients
+        update_count = sum([len(c.update_times) for c in self.clients])
+        byte_count = sum([c.bytes_received for c in self.clients])
+        max_gap = 0.
+        arrivals = {}
+        for c in self.clients:
+            times = [t for et, t in c.update_times]
+            for t1, t2 in zip(times[:-1], times[1:]):
+                max_gap = max(max_gap, t2 - t1)
+            for et, t in c.update_times:
+                arrivals.setdefault(et, []).append(t)
+        spread = [max(t) - min(t) for t in arrivals.values()
+                  if len(t) == len(self.clients)]
+        print("%d clients: %d updates (%.1f/s) %d bytes (%.0f bytes/s)" % (
+            len(self.clients), update_count, update_count / duration,
+            byte_count, byte_count / duration))
+        if spread:
+            print("Arrival spread across clients: avg %.3fms max %.3fms" % (
+                1000. * sum(spread) / len(spread), 1000. * max(spread)))
+        print("Maximum time between updates: %.3fms" % (1000. * max_gap,))
+        if cpu_time is not None:
+            print("Server cpu time: %.3fs (%.1f%%)" % (
+                cpu_time, 100. * cpu_time / duration))
+
+def main():
+    usage = "%prog [options] <socket filename>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--clients", type="int", dest="clients",
+                    default=20, help="number of clients to simulate")
+    opts.add_option("-t", "--time", type="float", dest="duration",
+                    default=30., help="duration of the test (in seconds)")
+    opts.add_option("-o", "--objects", type="string", dest="objects",
+                    help="comma separated list of objects to subscribe to"
+                    " (default is all objects)")
+    opts.add_option("-d", "--distinct", action="store_true",
+                    dest="distinct", help="use a distinct response template"
+                    " for each client")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+
+    lt = LoadTest(args[0], options.clients)
+    if options.objects:
+        names = [n.strip() for n in options.objects.split(',')]
+    else:
+        names = lt.request(lt.clients[0], "objects/list", {})['objects']
+    lt.subscribe({n: None for n in names}, options.distinct)
+    start_cpu = get_process_cpu_time(lt.server_pid)
+    start_time = time.time()
+    lt.run(options.duration)
+    duration = time.time() - start_time
+    cpu_time = get_process_cpu_time(lt.server_pid)
+    if cpu_time is not None and start_cpu is not None:
+        cpu_time -= start_cpu
+    lt.report(duration, cpu_time)
+
+if __name__ == '__main__':
+    main()